@@ -59,6 +59,9 @@ var _ctx := ZMQContext.new()
 var _bus: ZMQSocket = null
 var _bus_thread: Thread = null
 var _bus_lock := TrackableMutex.new("Zmq-Main-Bus", false)
+# Control requests (ie: AbortSimulation) have their own socket, so they are not stuck behind a pending Relax
+var _control_bus: ZMQSocket = null
+var _control_bus_lock := TrackableMutex.new("Zmq-Control-Bus", false)
 var _subscription_bus: ZMQSocket = null
 var _subscription_thread: Thread = null
 var _subscription_thread_running: bool = false
@@ -170,6 +173,7 @@ func _ready() -> void:
 			get_tree().root.add_child.call_deferred(dlg)
 			dlg.popup_centered.call_deferred()
 	_bus = ZMQSocket.create(_ctx, ZMQSocket.TYPE_REQUEST)
+	_control_bus = ZMQSocket.create(_ctx, ZMQSocket.TYPE_REQUEST)
 	_subscription_bus = ZMQSocket.create(_ctx, ZMQSocket.TYPE_SUB)
 	_start_zmq_sockets()
 
@@ -180,6 +184,7 @@ func _start_zmq_sockets() -> void:
 	if _CONNECT_TO_DEBUG_SOCKET:
 		var tmp_path: String = _tmp_dir.path_join(_DEBUG_SOCKET_NAME)
 		_bus.connect_to_server("ipc://" + tmp_path)
+		_control_bus.connect_to_server("ipc://" + tmp_path)
 		print_rich("[color=magenta]Connected to IPC socket " + tmp_path + "[/color]")
 		tmp_path += "-subscription"
 		_subscription_bus.connect_to_server("ipc://" + tmp_path)
@@ -191,6 +196,7 @@ func _start_zmq_sockets() -> void:
 		_bus_thread.start(_launch_openmm_server_in_thread.bind(utils.globalize_path("user://python")))
 		var socket: String = _tmp_dir.path_join("msep-%d" % OS.get_process_id())
 		_bus.connect_to_server("ipc://"+socket)
+		_control_bus.connect_to_server("ipc://"+socket)
 		print_rich("[color=magenta]Connected to IPC socket " + socket + "[/color]")
 		socket += "-subscription"
 		_subscription_bus.connect_to_server("ipc://" + socket)
@@ -230,6 +236,7 @@ func relaunch_openmm_server() -> void:
 	if _CONNECT_TO_DEBUG_SOCKET:
 		var tmp_path: String = _tmp_dir.path_join(_DEBUG_SOCKET_NAME)
 		_bus.connect_to_server("ipc://" + tmp_path)
+		_control_bus.connect_to_server("ipc://" + tmp_path)
 		print_rich("[color=magenta]Connected to IPC socket " + tmp_path + "[/color]")
 		tmp_path += "-subscription"
 		_subscription_bus.connect_to_server("ipc://" + tmp_path)
@@ -240,6 +247,7 @@ func relaunch_openmm_server() -> void:
 		_bus_thread.start(_launch_openmm_server_in_thread.bind(utils.globalize_path("user://python")))
 		var socket: String = _tmp_dir.path_join("msep-%d" % OS.get_process_id())
 		_bus.connect_to_server("ipc://"+socket)
+		_control_bus.connect_to_server("ipc://"+socket)
 		print_rich("[color=magenta]Connected to IPC socket " + socket + "[/color]")
 		socket += "-subscription"
 		_subscription_bus.connect_to_server("ipc://" + socket)
@@ -294,9 +302,11 @@ func request_quit_server() -> void:
 		if _CONNECT_TO_DEBUG_SOCKET:
 			var tmp_path: String = _tmp_dir.path_join(_DEBUG_SOCKET_NAME)
 			_bus.disconnect_from_server("ipc://" + tmp_path)
+			_control_bus.disconnect_from_server("ipc://" + tmp_path)
 		else:
 			var socket: String = _tmp_dir.path_join("msep-%d" % OS.get_process_id())
 			_bus.disconnect_from_server("ipc://"+socket)
+			_control_bus.disconnect_from_server("ipc://"+socket)
 
 
 func _request_relax(
@@ -557,6 +567,9 @@ func _dispose_bus_threads(in_restart_zmq_sockets: bool = false) -> void:
 		_bus = ZMQSocket.create(_ctx, ZMQSocket.TYPE_REQUEST)
 		_subscription_bus = ZMQSocket.create(_ctx, ZMQSocket.TYPE_SUB)
 		_bus_lock.unlock(mutex_context)
+		_control_bus_lock.lock(mutex_context)
+		_control_bus = ZMQSocket.create(_ctx, ZMQSocket.TYPE_REQUEST)
+		_control_bus_lock.unlock(mutex_context)
 		_start_zmq_sockets()
 
 
@@ -683,7 +696,8 @@ func _start_simulation_on_thread(in_simulation_data: SimulationData) -> void:
 		_handle_request_error(in_simulation_data.start_promise, false)
 		return
 	
-	assert(response == "Running".to_utf8_buffer(), "Unexpected response")
+	# Queued simulations wait for a free simulation worker of the server, they start the same way afterwards
+	assert(response == "Running".to_utf8_buffer() or response == "Queued".to_utf8_buffer(), "Unexpected response")
 	
 	# OpenMM server makes an early return, but server can crash before the first frame was received
 	# Lets track this corner case
@@ -721,21 +735,21 @@ func _abort_simulation_on_thread(in_simulation_id: int, out_abort_promise: Promi
 	while initial_server_pid <= 0:
 		OS.delay_msec(100)
 		initial_server_pid = _server_pid
-	_bus_lock.lock(mutex_context)
-	_bus.send_string(ServerCommands.ABORT_SIMULATION, ZMQSocket.SEND_FLAG_SNDMORE)
+	_control_bus_lock.lock(mutex_context)
+	_control_bus.send_string(ServerCommands.ABORT_SIMULATION, ZMQSocket.SEND_FLAG_SNDMORE)
 	var id_bytes := PackedByteArray()
 	id_bytes.resize(8)
 	id_bytes.encode_s64(0, in_simulation_id)
-	_bus.send_buffer(id_bytes)
+	_control_bus.send_buffer(id_bytes)
 	
 	var response: PackedByteArray = []
 	while response.is_empty() and initial_server_pid == _server_pid:
-		response = _bus.receive_buffer(ZMQSocket.RECEIVE_FLAG_DONT_WAIT)
-		_bus_lock.unlock(mutex_context)
+		response = _control_bus.receive_buffer(ZMQSocket.RECEIVE_FLAG_DONT_WAIT)
+		_control_bus_lock.unlock(mutex_context)
 		# This makes the query non blocking
 		OS.delay_msec(100)
-		_bus_lock.lock(mutex_context)
-	_bus_lock.unlock(mutex_context)
+		_control_bus_lock.lock(mutex_context)
+	_control_bus_lock.unlock(mutex_context)
 	var did_server_crash: bool = initial_server_pid != _server_pid
 	if did_server_crash:
 		# If server crashed, in practice simulation is no longer procesing, so it's a success
@@ -747,7 +761,7 @@ func _abort_simulation_on_thread(in_simulation_id: int, out_abort_promise: Promi
 		if in_simulation_id in _running_simulations:
 			_running_simulations[in_simulation_id].abort()
 		_subscription_thread_lock.unlock(mutex_context)
-		_handle_request_error(out_abort_promise, false)
+		_handle_request_error(out_abort_promise, false, _control_bus_lock, _control_bus)
 		return
 	out_abort_promise.fulfill.call_deferred(true)
 
@@ -182,6 +182,7 @@ func add_motor(in_motor: NanoVirtualMotor) -> void:
 	var position: Vector3 = in_motor.get_transform().origin
 	var axis_direction: Vector3 = in_motor.get_transform().basis * Vector3.RIGHT
 	motor_dict[&"is"] = &"motor"
+	motor_dict[&"motor_id"] = in_motor.int_guid # identifies the motor in UpdateSimulation requests
 	motor_dict[&"molecule_id"] = in_motor.int_parent_guid # motor is attached to this molecule, and could be moved by another motor
 	motor_dict[&"position"] = [position.x, position.y, position.z]
 	motor_dict[&"axis_direction"] = [axis_direction.x, axis_direction.y, axis_direction.z]
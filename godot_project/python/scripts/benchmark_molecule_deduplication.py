@@ -0,0 +1,134 @@
+import tempfile
+import time
+import sys
+import os
+import numpy as np
+
+import openmm_server
+from openmm_server import MoleculePartition, MoleculeIdentities, PayloadTopologyReader, PartialChargeCache, \
+		MOLECULE_CHUNK_DTYPE, ATOM_CHUNK_DTYPE, BOND_CHUNK_DTYPE
+
+# Measures the molecule identity stage of PayloadTopologyReader.build_atom_maps() on structures made of
+# repeated copies of a few molecules, half of them with their atoms listed in a different order.
+# Every molecule that is found to be a copy skips partial charge assignment and parameterization, with
+# --parameterize to_openff_molecules() and create_openmm_system() are timed with and without deduplication
+# (needs the toolkits, caches and incremental parameterization are disabled).
+# Usage: python benchmark_molecule_deduplication.py [copies_count] [--parameterize]
+
+TEMPLATES_ATOMS_COUNTS = [12, 50, 300]
+# Molecules parameterized with --parameterize: benzoic acid, adamantane and a small symmetric gear tooth
+TEMPLATES_SMILES = ["OC(=O)c1ccccc1", "C1C2CC3CC1CC(C2)C3", "CC(C)(C)c1cc(C(C)(C)C)cc(C(C)(C)C)c1"]
+FORCEFIELD = "openff-2.1.0.offxml"
+
+
+def create_template(atoms_count: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+	# Random tree with a few ring closures
+	elements: np.ndarray = rng.choice([1, 6, 6, 6, 7, 8], atoms_count).astype(np.uint8)
+	atom2: np.ndarray = np.arange(1, atoms_count)
+	atom1: np.ndarray = (rng.random(atoms_count - 1) * atom2).astype(np.int64)
+	bond_atoms: np.ndarray = np.column_stack((atom1, atom2))
+	rings: np.ndarray = rng.integers(0, atoms_count, (atoms_count // 10, 2))
+	rings = rings[np.abs(rings[:, 0] - rings[:, 1]) > 1]
+	bond_atoms = np.unique(np.sort(np.concatenate((bond_atoms, rings)), axis=1), axis=0)
+	bond_orders: np.ndarray = rng.integers(1, 3, len(bond_atoms)).astype(np.uint8)
+	return elements, bond_atoms, bond_orders
+
+
+def create_smiles_template(smiles: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+	from rdkit import Chem
+	molecule = Chem.AddHs(Chem.MolFromSmiles(smiles))
+	Chem.Kekulize(molecule, clearAromaticFlags=True)
+	elements: np.ndarray = np.array([atom.GetAtomicNum() for atom in molecule.GetAtoms()], dtype=np.uint8)
+	bond_atoms: np.ndarray = np.array([[bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()] for bond in molecule.GetBonds()], dtype=np.int64)
+	bond_orders: np.ndarray = np.array([int(bond.GetBondTypeAsDouble()) for bond in molecule.GetBonds()], dtype=np.uint8)
+	return elements, bond_atoms, bond_orders
+
+
+def create_structure(templates: list, copies_count: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+	elements: list[np.ndarray] = []
+	bonds: list[np.ndarray] = []
+	orders: list[np.ndarray] = []
+	offset: int = 0
+	for copy in range(copies_count):
+		template_elements, template_bonds, template_orders = templates[copy % len(templates)]
+		atoms_count: int = len(template_elements)
+		order: np.ndarray = np.arange(atoms_count) if copy % 2 == 0 else rng.permutation(atoms_count)
+		new_ids: np.ndarray = np.empty(atoms_count, dtype=np.int64)
+		new_ids[order] = np.arange(atoms_count)
+		elements.append(template_elements[order])
+		bonds.append(new_ids[template_bonds] + offset)
+		orders.append(template_orders)
+		offset += atoms_count
+	return np.concatenate(elements), np.concatenate(bonds), np.concatenate(orders)
+
+
+def create_topology_payload(elements: np.ndarray, bond_atoms: np.ndarray, bond_orders: np.ndarray) -> PayloadTopologyReader:
+	# A single structure without passivation atoms
+	molecules_chunk: np.ndarray = np.zeros(1, dtype=MOLECULE_CHUNK_DTYPE)
+	molecules_chunk["atoms_count"] = len(elements)
+	atoms_chunk: np.ndarray = np.zeros(len(elements), dtype=ATOM_CHUNK_DTYPE)
+	atoms_chunk["element"] = elements
+	bonds_chunk: np.ndarray = np.zeros(len(bond_atoms), dtype=BOND_CHUNK_DTYPE)
+	bonds_chunk["atom1"] = bond_atoms[:, 0]
+	bonds_chunk["atom2"] = bond_atoms[:, 1]
+	bonds_chunk["order"] = bond_orders
+	chunk: bytes = molecules_chunk.tobytes() + atoms_chunk.tobytes() + bonds_chunk.tobytes()
+	return PayloadTopologyReader(chunk, 1, len(elements), len(bond_atoms), FORCEFIELD)
+
+
+def time_parameterization(elements: np.ndarray, bond_atoms: np.ndarray, bond_orders: np.ndarray, deduplicate: bool) -> tuple[float, float, int]:
+	# Returns the times and how many isomorphism checks were answered by the identity keys (patch_frozen_molecule)
+	from patches import patch_frozen_molecule
+	patch_frozen_molecule.identity_key_matches_count = 0
+	openmm_server.DEDUPLICATE_MOLECULES = deduplicate
+	openmm_server.parameter_block_store = openmm_server.ParameterBlockStore()
+	with tempfile.TemporaryDirectory() as cache_directory:
+		openmm_server.partial_charge_cache = PartialChargeCache(os.path.join(cache_directory, "partial_charges.sqlite"))
+		topology_payload: PayloadTopologyReader = create_topology_payload(elements, bond_atoms, bond_orders)
+		start: float = time.perf_counter()
+		topology_payload.to_openff_molecules()
+		charges_time: float = time.perf_counter() - start
+		start = time.perf_counter()
+		openmm_system = openmm_server.create_openmm_system(topology_payload, "benchmark", use_cache=False)
+		parameterization_time: float = time.perf_counter() - start
+		assert(openmm_system.getNumParticles() == len(elements))
+	return charges_time, parameterization_time, patch_frozen_molecule.identity_key_matches_count
+
+
+def benchmark_parameterization(copies_count: int, rng: np.random.Generator) -> None:
+	openmm_server.toolkits_warm_up.run()
+	openmm_server.toolkits_warm_up.wait_until_ready()
+	openmm_server.INCREMENTAL_PARAMETERIZATION = False
+	templates: list = [create_smiles_template(smiles) for smiles in TEMPLATES_SMILES]
+	elements, bond_atoms, bond_orders = create_structure(templates, copies_count, rng)
+	print(f"{'deduplicate':>12} {'atoms':>10} {'charges (s)':>12} {'parameterization (s)':>21} {'total (s)':>10} {'key matches':>12}")
+	for deduplicate in [True, False]:
+		charges_time, parameterization_time, key_matches = time_parameterization(elements, bond_atoms, bond_orders, deduplicate)
+		print(f"{str(deduplicate):>12} {len(elements):>10} {charges_time:>12.2f} {parameterization_time:>21.2f} {charges_time + parameterization_time:>10.2f} {key_matches:>12}")
+		# Copies are matched to their representative by identity key, without comparing atoms
+		assert(key_matches > 0 or not deduplicate)
+
+
+def main() -> int:
+	arguments: list[str] = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+	copies_count: int = int(arguments[0]) if len(arguments) > 0 else 500
+	rng = np.random.default_rng(0)
+	templates: list = [create_template(atoms_count, rng) for atoms_count in TEMPLATES_ATOMS_COUNTS]
+	elements, bond_atoms, bond_orders = create_structure(templates, copies_count, rng)
+	charges: np.ndarray = np.zeros(len(elements), dtype=np.int8)
+	start: float = time.perf_counter()
+	partition = MoleculePartition(len(elements), bond_atoms)
+	partition_time: float = time.perf_counter() - start
+	start = time.perf_counter()
+	identities = MoleculeIdentities(partition, elements, charges, bond_atoms, bond_orders)
+	identities_time: float = time.perf_counter() - start
+	print(f"{'atoms':>10} {'molecules':>10} {'unique':>10} {'partition (s)':>14} {'identities (s)':>15}")
+	print(f"{len(elements):>10} {partition.molecules_count:>10} {identities.unique_molecules_count:>10} {partition_time:>14.4f} {identities_time:>15.4f}")
+	assert(identities.unique_molecules_count == len(TEMPLATES_ATOMS_COUNTS))
+	if "--parameterize" in sys.argv:
+		benchmark_parameterization(copies_count, rng)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
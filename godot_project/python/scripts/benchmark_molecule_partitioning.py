@@ -0,0 +1,82 @@
+from collections import defaultdict, deque
+import time
+import sys
+import numpy as np
+
+from openmm_server import MoleculePartition
+
+# Measures how the molecule partitioning stage of PayloadTopologyReader.to_openff_molecules()
+# scales with the number of bonds, compared with the BFS it replaced.
+# Usage: python benchmark_molecule_partitioning.py [max_bonds_for_legacy_bfs]
+
+BONDS_COUNTS = [10**3, 10**4, 10**5, 10**6]
+ATOMS_PER_MOLECULE = 50
+
+
+def legacy_find_unconnected_molecules(atoms, bonds):
+	graph = defaultdict(list)
+	for bond in bonds:
+		atom1, atom2 = bond
+		graph[atom1].append(atom2)
+		graph[atom2].append(atom1)
+
+	def bfs(start, visited):
+		queue = deque([start])
+		component = []
+		while queue:
+			node = queue.popleft()
+			if node not in visited:
+				visited.add(node)
+				component.append(node)
+				for neighbor in graph[node]:
+					if neighbor not in visited:
+						queue.append(neighbor)
+		return component
+
+	visited = set()
+	molecules = []
+	for atom in atoms:
+		if atom not in visited:
+			molecules.append(bfs(atom, visited))
+	return molecules
+
+
+def create_structure(bonds_count: int, rng: np.random.Generator) -> tuple[int, np.ndarray]:
+	# Chains of ATOMS_PER_MOLECULE atoms with a few ring closures, atom ids are shuffled so
+	# molecules are not stored contiguously (like structures merged in the editor)
+	bonds_per_chain: int = ATOMS_PER_MOLECULE - 1
+	chains_count: int = max(1, bonds_count // bonds_per_chain)
+	atoms_count: int = chains_count * ATOMS_PER_MOLECULE
+	first_atoms: np.ndarray = np.arange(chains_count)[:, None] * ATOMS_PER_MOLECULE
+	atom1: np.ndarray = (first_atoms + np.arange(bonds_per_chain)).reshape(-1)
+	bond_atoms: np.ndarray = np.column_stack((atom1, atom1 + 1))
+	missing_bonds: int = bonds_count - len(bond_atoms)
+	if missing_bonds > 0:
+		chains: np.ndarray = rng.integers(0, chains_count, missing_bonds) * ATOMS_PER_MOLECULE
+		extra: np.ndarray = np.column_stack((chains, chains + rng.integers(2, ATOMS_PER_MOLECULE, missing_bonds)))
+		bond_atoms = np.concatenate((bond_atoms, extra))
+	shuffled_ids: np.ndarray = rng.permutation(atoms_count)
+	return atoms_count, shuffled_ids[bond_atoms[:bonds_count]]
+
+
+def main() -> int:
+	max_legacy_bonds: int = int(sys.argv[1]) if len(sys.argv) > 1 else 10**5
+	rng = np.random.default_rng(0)
+	print(f"{'bonds':>10} {'atoms':>10} {'molecules':>10} {'partition (s)':>14} {'legacy bfs (s)':>15}")
+	for bonds_count in BONDS_COUNTS:
+		atoms_count, bond_atoms = create_structure(bonds_count, rng)
+		start: float = time.perf_counter()
+		partition = MoleculePartition(atoms_count, bond_atoms)
+		partition_time: float = time.perf_counter() - start
+		legacy_time: str = "skipped"
+		if bonds_count <= max_legacy_bonds:
+			start = time.perf_counter()
+			legacy_molecules: list = legacy_find_unconnected_molecules(range(atoms_count), bond_atoms.tolist())
+			legacy_time = f"{time.perf_counter() - start:.4f}"
+			assert(len(legacy_molecules) == partition.molecules_count)
+		print(f"{bonds_count:>10} {atoms_count:>10} {partition.molecules_count:>10} {partition_time:>14.4f} {legacy_time:>15}")
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -1,21 +1,45 @@
-from collections import defaultdict, deque
+from __future__ import annotations
 from pathlib import Path
+from collections import deque, OrderedDict
 from enum import IntEnum
 from datetime import datetime
 import concurrent.futures
 import threading
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import heapq
 import traceback
 import tempfile
 import struct
+import hashlib
+import sqlite3
 import json
 import sys
+import importlib
+import builtins
 import zmq
+import zmq.asyncio
+import asyncio
 import os
 import subprocess
+import select
+import signal
 import re
 from sys import platform
 import time
+SERVER_START_TIME: float = time.perf_counter()
 import logging
+import numpy as np
+# Optional frame compressors, requested compressions that are not installed fall back to none
+try:
+	import lz4.frame as lz4_frame
+except ImportError:
+	lz4_frame = None
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
 
 DETAILED_LOGS = False
 
@@ -33,21 +57,123 @@ logging.basicConfig(
 
 )
 
-# OpenMM imports
-from openmm.app import *
-from openmm import *
-from openmm.unit import *
-
-# OpenFF imports
-from openff.toolkit import ForceField, Molecule, Topology
-from openff.toolkit.utils.toolkits import RDKitToolkitWrapper
-	# from openff.toolkit.utils.toolkits import AmberToolsToolkitWrapper
-	# from openff.toolkit.utils.toolkits import BuiltInToolkitWrapper
-from simtk.openmm.app import PDBxReporter,PDBReporter,CheckpointReporter,DCDReporter,StateDataReporter
-from openff.interchange import Interchange
-from openff.toolkit.utils.utils import get_data_file_path
+# Startup
+# The sockets are bound before the heavy toolkits (OpenMM, OpenFF, RDKit, Interchange) are imported, ToolkitsWarmUp
+# imports them on a background thread and injects their names into this module, the same names the star imports
+# at the top of this module used to define. Requests that need them wait until the warm up is done.
+class StartupTimeline:
+	# Seconds since the process started for every startup step, logged to keep track of import time regressions
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.steps: list[tuple] = [] # (step, seconds)
+	
+	def mark(self, step: str) -> None:
+		seconds: float = time.perf_counter() - SERVER_START_TIME
+		with self._lock:
+			self.steps.append((step, seconds))
+		logging.info(f"Startup timeline ({os.getpid()}): +{seconds:.3f} s {step}")
+	
+	def get_steps(self) -> list[tuple]:
+		with self._lock:
+			return list(self.steps)
+
+startup_timeline = StartupTimeline()
+
+def get_star_names(module_name: str) -> dict:
+	# Names imported by "from <module_name> import *"
+	module = importlib.import_module(module_name)
+	public_names: list[str] = getattr(module, "__all__", None) or [name for name in vars(module) if not name.startswith("_")]
+	return {name: getattr(module, name) for name in public_names}
+
+def import_toolkits() -> None:
+	module_globals: dict = globals()
+	# OpenMM imports, later modules override the names of the previous ones. Names defined by this module are kept,
+	# and so are Python built-ins (ie: openmm.unit exports units named sum and bytes)
+	star_names: dict = {}
+	for module_name in ["openmm.app", "openmm", "openmm.unit"]:
+		star_names.update(get_star_names(module_name))
+	for name, value in star_names.items():
+		if not name in module_globals and not hasattr(builtins, name):
+			module_globals[name] = value
+	startup_timeline.mark("imported openmm")
+	# OpenFF imports
+	from openff.toolkit import ForceField, Molecule, Topology
+	from openff.toolkit.utils.toolkits import RDKitToolkitWrapper
+	from openff.units import unit as openff_unit
+	from openff.toolkit.utils.utils import get_data_file_path
+		# from openff.toolkit.utils.toolkits import AmberToolsToolkitWrapper
+		# from openff.toolkit.utils.toolkits import BuiltInToolkitWrapper
+	startup_timeline.mark("imported openff.toolkit")
+	from rdkit import Chem
+	startup_timeline.mark("imported rdkit")
+	from simtk.openmm.app import PDBxReporter,PDBReporter,CheckpointReporter,DCDReporter,StateDataReporter
+	from openff.interchange import Interchange
+	startup_timeline.mark("imported openff.interchange")
+	from patches import apply_all_patches
+	module_globals.update(ForceField=ForceField, Molecule=Molecule, Topology=Topology, RDKitToolkitWrapper=RDKitToolkitWrapper,
+			openff_unit=openff_unit, get_data_file_path=get_data_file_path, Chem=Chem, PDBxReporter=PDBxReporter,
+			PDBReporter=PDBReporter, CheckpointReporter=CheckpointReporter, DCDReporter=DCDReporter,
+			StateDataReporter=StateDataReporter, Interchange=Interchange, apply_all_patches=apply_all_patches)
+
+class WarmUpState(IntEnum):
+	WARMING_UP = 0,
+	READY = 1,
+	FAILED = 2,
+
+class ToolkitsWarmUp:
+	# Imports the toolkits, applies the patches and prewarms OpenFF, see StartupTimeline
+	def __init__(self):
+		self.state: WarmUpState = WarmUpState.WARMING_UP
+		self.step: str = "waiting"
+		self.error: str = ""
+		self._lock = threading.Lock()
+		self._is_started: bool = False
+		self._done_event = threading.Event()
+	
+	def start(self) -> None:
+		# Warms up on a background thread, does nothing if it was already started
+		with self._lock:
+			if self._is_started:
+				return
+			self._is_started = True
+		threading.Thread(target=self._run, name="warm-up", daemon=True).start()
+	
+	def run(self, create_context: bool = True) -> None:
+		# Warms up on this thread, without create_context OpenFF is prewarmed without creating an OpenMM Context
+		with self._lock:
+			if self._is_started:
+				self._done_event.wait()
+				return
+			self._is_started = True
+		self._run(create_context)
+	
+	def wait_until_ready(self) -> None:
+		self._done_event.wait()
+		if self.state == WarmUpState.FAILED:
+			raise Exception(f"The server failed to start: {self.error}")
+	
+	def _run(self, create_context: bool = True) -> None:
+		try:
+			self.step = "importing toolkits"
+			import_toolkits()
+			self.step = "applying patches"
+			apply_all_patches()
+			startup_timeline.mark("applied patches")
+			self.step = "prewarming forcefields"
+			prewarm_openmm_ff(create_context)
+			startup_timeline.mark("prewarmed forcefields")
+			self.step = "ready"
+			self.state = WarmUpState.READY
+		except Exception as inst:
+			self.error = str(inst)
+			self.state = WarmUpState.FAILED
+			logging.error(f"Warm up failed while {self.step}: {inst}\n{traceback.format_exc()}")
+		finally:
+			self._done_event.set()
+			steps: str = ", ".join(f"{step} +{seconds:.3f} s" for step, seconds in startup_timeline.get_steps())
+			logging.info(f"Startup timeline ({os.getpid()}): {steps}")
 
-from patches import apply_all_patches
+toolkits_warm_up = ToolkitsWarmUp()
 
 
 class bcolors:
@@ -73,32 +199,24 @@ periodic_table_symbols = [
 	"OG"
 ]
 
-def dot_Vec3(v1, v2) -> float:
-	return v1.x*v2.x + v1.y*v2.y + v1.z*v2.z
+# Layout of the chunks packed by OpenMMPayload (see autoloads/openmm/openmm_payload.gd)
+MOLECULE_CHUNK_DTYPE = np.dtype([("molecule_id", "<u4"), ("atoms_count", "<u4"), ("passivation_atoms_count", "<u4")])
+ATOM_CHUNK_DTYPE = np.dtype([("element", "u1"), ("hybridization", "u1"), ("charge", "u1"), ("locked", "u1")])
+BOND_CHUNK_DTYPE = np.dtype([("atom1", "<u4"), ("atom2", "<u4"), ("order", "u1")])
+ATOM_ID_DTYPE = np.dtype("<u4")
+POSITION_DTYPE = np.dtype("<f8")
 
-def length_Vec3(vec: Vec3) -> float:
-	return sqrt(vec.x**2+vec.y**2+vec.z**2)
-
-def normalize_Vec3(vec: Vec3) -> Vec3:
-	l = length_Vec3(vec)
-	return Vec3(vec.x/l, vec.y/l, vec.z/l) * vec.unit
-
-def closest_point_in_rect_to_other(rect_pos: Vec3, rect_dir: Vec3, other: Vec3) -> Vec3:
-	w: Vec3 = other - rect_pos
-	point_in_rect: Vec3 = rect_pos + (rect_dir * dot_Vec3(w, rect_dir) * rect_pos.unit)
-	return point_in_rect
-
-def cross_Vec3(a: Vec3, b: Vec3) -> Vec3:
-	c: Vec3 = Vec3(a[1]*b[2] - a[2]*b[1],
-					a[2]*b[0] - a[0]*b[2],
-					a[0]*b[1] - a[1]*b[0])
-	return c
+def decode_signed_int8_array(raw: np.ndarray) -> np.ndarray:
+	# Same encoding as PayloadChunkReader.read_signed_int8(): bit 7 is the sign, bits 0-6 the magnitude
+	magnitude: np.ndarray = (raw & 0b01111111).astype(np.int8)
+	return np.where(raw & 0b10000000, -magnitude, magnitude).astype(np.int8)
 
 class PayloadChunkReader:
-	chunk: bytes = b''
+	chunk: memoryview = memoryview(b'')
 	seek: int = 0
 	def __init__(self, chunk):
-		self.chunk = chunk
+		# chunk can be bytes or a zmq.Frame received with copy=False, memoryview avoids copying both
+		self.chunk = memoryview(chunk)
 	
 	def read_uint8(self) -> int:
 		byte: int = self.chunk[self.seek]
@@ -114,16 +232,20 @@ class PayloadChunkReader:
 		return byte
 	
 	def read_uint32(self) -> int:
-		pack: bytes = self.chunk[self.seek:self.seek+4]
-		uint32_value = struct.unpack('<I', pack)[0]
+		uint32_value = struct.unpack_from('<I', self.chunk, self.seek)[0]
 		self.seek += 4
 		return uint32_value
 	
 	def read_float(self) -> float:
-		pack: bytes = self.chunk[self.seek:self.seek+8]
-		decoded_float = struct.unpack('d', pack)[0]
+		decoded_float = struct.unpack_from('d', self.chunk, self.seek)[0]
 		self.seek += 8
 		return decoded_float
+	
+	def read_array(self, dtype: np.dtype, count: int) -> np.ndarray:
+		# Read-only view over the chunk, no data is copied
+		array: np.ndarray = np.frombuffer(self.chunk, dtype=dtype, count=count, offset=self.seek)
+		self.seek += array.nbytes
+		return array
 
 class PayloadSimulationParameters(PayloadChunkReader):
 	def __init__(self, chunk):
@@ -132,6 +254,25 @@ class PayloadSimulationParameters(PayloadChunkReader):
 		self.time_step_in_femtoseconds: float = self.read_float()
 		self.steps_per_report: int = self.read_uint32()
 		self.total_step_count: int = self.read_uint32()
+		# Optional trailing fields, clients that don't send them get the original float64 frames
+		self.frame_encoding: FrameEncoding = FrameEncoding.FLOAT64
+		self.frame_compression: FrameCompression = FrameCompression.NONE
+		self.keyframe_interval: int = 0
+		if self.seek < len(self.chunk):
+			self.frame_encoding = FrameEncoding(self.read_uint8())
+			self.frame_compression = FrameCompression(self.read_uint8())
+			self.keyframe_interval = self.read_uint32()
+		self.sparse_threshold_in_nanometers: float = 0.0
+		if self.seek < len(self.chunk):
+			self.sparse_threshold_in_nanometers = self.read_float()
+		# 0 lets the server decide: every step for python motors, once per stepping chunk for in-kernel motors
+		self.motor_update_interval_in_steps: int = 0
+		if self.seek < len(self.chunk):
+			self.motor_update_interval_in_steps = self.read_uint32()
+		# Lower values are started first by the simulation scheduler, 0 is the interactive simulation
+		self.priority: int = 0
+		if self.seek < len(self.chunk):
+			self.priority = self.read_uint8()
 		assert(self.seek == len(self.chunk))
 
 class PayloadHeaderReader(PayloadChunkReader):
@@ -145,21 +286,348 @@ class PayloadHeaderReader(PayloadChunkReader):
 		assert(self.passivated_atoms_count <= self.atoms_count, "There are more passivated atoms than total atoms. That doesn't sound about right")
 		assert(self.seek == len(self.chunk))
 
-class AtomData:
-	def __init__(self, element, hybridization, charge=0, molecule_id=0, is_locked=False, is_passivation_atom=False):
-		self.element: int = element
-		self.hybridization: int = hybridization
-		self.charge: float = charge
-		self.molecule_id: int = molecule_id
-		self.is_locked: bool = is_locked
-		self.is_passivation_atom: bool = is_passivation_atom
+class MoleculePartition:
+	def __init__(self, atoms_count: int, bond_atoms: np.ndarray):
+		# Splits atoms in molecules (connected components of the bonds graph).
+		# Molecules are sorted by their smallest atom id, atoms and bonds are grouped by molecule
+		# so the ones belonging to molecule `k` are in the range [offsets[k], offsets[k+1])
+		self.labels: np.ndarray = find_connected_components(atoms_count, bond_atoms)
+		self.molecules_count: int = int(self.labels.max()) + 1 if atoms_count > 0 else 0
+		self.atoms: np.ndarray = np.argsort(self.labels, kind="stable")
+		self.atom_offsets: np.ndarray = np.zeros(self.molecules_count + 1, dtype=np.int64)
+		np.cumsum(np.bincount(self.labels, minlength=self.molecules_count), out=self.atom_offsets[1:])
+		# index of every atom inside of its own molecule
+		self.local_atom_ids: np.ndarray = np.empty(atoms_count, dtype=np.int64)
+		self.local_atom_ids[self.atoms] = np.arange(atoms_count, dtype=np.int64) - self.atom_offsets[self.labels[self.atoms]]
+		bond_labels: np.ndarray = self.labels[bond_atoms[:, 0]]
+		self.bonds: np.ndarray = np.argsort(bond_labels, kind="stable")
+		self.bond_offsets: np.ndarray = np.zeros(self.molecules_count + 1, dtype=np.int64)
+		np.cumsum(np.bincount(bond_labels, minlength=self.molecules_count), out=self.bond_offsets[1:])
+	
+	def reorder_atoms(self, atoms: np.ndarray) -> None:
+		# Every molecule must keep the same range in `atoms`, only the order inside of each molecule can change
+		self.atoms = atoms
+		self.local_atom_ids[atoms] = np.arange(len(atoms), dtype=np.int64) - self.atom_offsets[self.labels[atoms]]
+
+
+def find_connected_components(atoms_count: int, bond_atoms: np.ndarray) -> np.ndarray:
+	# Array based union-find. Every round hooks each root into the smallest root it is bonded to,
+	# then compresses all paths with pointer jumping. It ends when no bond joins 2 different roots.
+	# Returns the molecule label of each atom, labels are sorted by the smallest atom id in the molecule
+	parent: np.ndarray = np.arange(atoms_count, dtype=np.int64)
+	atom1: np.ndarray = bond_atoms[:, 0]
+	atom2: np.ndarray = bond_atoms[:, 1]
+	while True:
+		root1: np.ndarray = parent[atom1]
+		root2: np.ndarray = parent[atom2]
+		joins: np.ndarray = root1 != root2
+		if not joins.any():
+			break
+		# Once a bond is inside a single tree it stays that way, so it is not visited again
+		atom1 = atom1[joins]
+		atom2 = atom2[joins]
+		root1 = root1[joins]
+		root2 = root2[joins]
+		np.minimum.at(parent, np.maximum(root1, root2), np.minimum(root1, root2))
+		while True:
+			grandparent: np.ndarray = parent[parent]
+			if np.array_equal(grandparent, parent):
+				break
+			parent = grandparent
+	# Roots are the smallest atom of their molecule, numbering them in order gives the labels
+	is_root: np.ndarray = parent == np.arange(atoms_count, dtype=np.int64)
+	root_labels: np.ndarray = np.cumsum(is_root) - 1
+	return root_labels[parent]
+
+
+# Copies of the same molecule are charged and parameterized once, see MoleculeIdentities
+DEDUPLICATE_MOLECULES = True
+# Max rounds of Weisfeiler-Lehman refinement, atoms are told apart by their neighbourhood up to this radius
+MOLECULE_IDENTITY_WL_ROUNDS = 16
+# Max atoms individualized per molecule to break the ties of symmetric molecules, remaining ties keep their atom id order
+MOLECULE_IDENTITY_MAX_INDIVIDUALIZATIONS = 64
+
+def mix_hashes(values: np.ndarray) -> np.ndarray:
+	# splitmix64 finalizer, spreads small integers over the whole uint64 range
+	values = values.astype(np.uint64)
+	values ^= values >> np.uint64(30)
+	values *= np.uint64(0xbf58476d1ce4e5b9)
+	values ^= values >> np.uint64(27)
+	values *= np.uint64(0x94d049bb133111eb)
+	values ^= values >> np.uint64(31)
+	return values
+
+class MoleculeIdentities:
+	# Finds the molecules of a partition that are copies of another one (same elements, formal charges and bonds).
+	# Copies stored with the same atom order are found by hashing their local arrays. For the rest atoms are sorted
+	# by a canonical color: their Weisfeiler-Lehman color, with the ties of symmetric atoms broken by individualization,
+	# and the resulting atom mapping is only accepted if it maps every bond exactly.
+	# The atoms of every copy are reordered to follow the order of its representative.
+	def __init__(self, partition: MoleculePartition, elements: np.ndarray, charges: np.ndarray, bond_atoms: np.ndarray, bond_orders: np.ndarray):
+		molecules_count: int = partition.molecules_count
+		self.representatives: np.ndarray = np.arange(molecules_count, dtype=np.int64)
+		self.atoms: np.ndarray = partition.atoms.copy()
+		local_order_keys: list[str] = self._get_local_order_keys(partition, elements, charges, bond_atoms, bond_orders)
+		first_molecule_by_key: dict = {}
+		for molecule, key in enumerate(local_order_keys):
+			self.representatives[molecule] = first_molecule_by_key.setdefault(key, molecule)
+		candidates: np.ndarray = np.flatnonzero(self.representatives == np.arange(molecules_count))
+		if len(candidates) > 1:
+			self._match_reordered_copies(candidates, partition, elements, charges, bond_atoms, bond_orders)
+		# copies share the key of their representative, which is also the order of their atoms now
+		self.identity_keys: list[str] = [local_order_keys[representative] for representative in self.representatives.tolist()]
+		self.unique_molecules_count: int = int(np.count_nonzero(self.representatives == np.arange(molecules_count)))
+	
+	def _get_local_order_keys(self, partition: MoleculePartition, elements: np.ndarray, charges: np.ndarray, bond_atoms: np.ndarray, bond_orders: np.ndarray) -> list[str]:
+		atoms_table: np.ndarray = np.column_stack((elements[partition.atoms], charges[partition.atoms])).astype(np.int64)
+		bonds_table: np.ndarray = self._get_bonds_table(partition.local_atom_ids, partition.labels, bond_atoms, bond_orders)
+		atom_offsets: list[int] = partition.atom_offsets.tolist()
+		bond_offsets: list[int] = partition.bond_offsets.tolist()
+		keys: list[str] = []
+		for molecule in range(partition.molecules_count):
+			key = hashlib.sha256(atoms_table[atom_offsets[molecule]:atom_offsets[molecule+1]].tobytes())
+			key.update(bonds_table[bond_offsets[molecule]:bond_offsets[molecule+1]].tobytes())
+			keys.append(key.hexdigest())
+		return keys
+	
+	def _get_bonds_table(self, local_atom_ids: np.ndarray, labels: np.ndarray, bond_atoms: np.ndarray, bond_orders: np.ndarray) -> np.ndarray:
+		# (local atom 1, local atom 2, order) of every bond, sorted and grouped by molecule like partition.bonds
+		local_bonds: np.ndarray = local_atom_ids[bond_atoms]
+		table: np.ndarray = np.column_stack((labels[bond_atoms[:, 0]], local_bonds.min(axis=1), local_bonds.max(axis=1), bond_orders)).astype(np.int64)
+		table = table[np.lexsort(table.T[::-1])]
+		return np.ascontiguousarray(table[:, 1:])
+	
+	def _get_initial_colors(self, elements: np.ndarray, charges: np.ndarray, bond_atoms: np.ndarray) -> np.ndarray:
+		degrees: np.ndarray = np.bincount(bond_atoms.reshape(-1), minlength=len(elements))
+		initial_colors: np.ndarray = (elements.astype(np.int64) * 256 + charges.astype(np.int64) + 128) * 1024 + np.minimum(degrees, 1023)
+		return np.unique(initial_colors, return_inverse=True)[1].reshape(-1)
+	
+	def _refine_colors(self, colors: np.ndarray, bond_atoms: np.ndarray, bond_orders: np.ndarray, max_rounds: int = MOLECULE_IDENTITY_WL_ROUNDS) -> np.ndarray:
+		# Colors are global, atoms of different molecules with the same color have the same neighbourhood
+		atoms_count: int = len(colors)
+		colors_count: int = int(colors.max()) + 1
+		source: np.ndarray = np.concatenate((bond_atoms[:, 0], bond_atoms[:, 1]))
+		target: np.ndarray = np.concatenate((bond_atoms[:, 1], bond_atoms[:, 0]))
+		orders: np.ndarray = np.concatenate((bond_orders, bond_orders)).astype(np.uint64)
+		for _round in range(max_rounds):
+			# Sum of hashes is a hash of the multiset of (neighbour color, bond order)
+			neighbourhoods: np.ndarray = np.zeros(atoms_count, dtype=np.uint64)
+			np.add.at(neighbourhoods, source, mix_hashes(colors[target].astype(np.uint64) * np.uint64(256) + orders))
+			order: np.ndarray = np.lexsort((neighbourhoods, colors))
+			is_new_color: np.ndarray = np.ones(atoms_count, dtype=bool)
+			is_new_color[1:] = (np.diff(colors[order]) != 0) | (np.diff(neighbourhoods[order]) != 0)
+			new_colors: np.ndarray = np.empty(atoms_count, dtype=np.int64)
+			new_colors[order] = np.cumsum(is_new_color) - 1
+			colors = new_colors
+			if int(colors.max()) + 1 == colors_count:
+				break
+			colors_count = int(colors.max()) + 1
+		return colors
+	
+	def _split_colors(self, colors: np.ndarray, split_atoms: np.ndarray) -> np.ndarray:
+		# split_atoms get a color of their own next to their previous one, colors stay consistent between molecules
+		keys: np.ndarray = colors * 2
+		keys[split_atoms] += 1
+		return np.unique(keys, return_inverse=True)[1].reshape(-1)
+	
+	def _break_ties(self, colors: np.ndarray, labels: np.ndarray, bond_atoms: np.ndarray, bond_orders: np.ndarray) -> np.ndarray:
+		# Atoms with the same color in a molecule are (almost always) symmetric, so any of them can be individualized:
+		# given a new color and refined again, until every atom of every molecule has its own color. The same choices
+		# are made in every copy of a molecule, whatever the order of its atoms. Colors are refined until they are stable,
+		# otherwise tied atoms could be far from symmetric
+		atoms_count: int = len(colors)
+		colors = self._refine_colors(colors, bond_atoms, bond_orders, atoms_count)
+		atom_ids: np.ndarray = np.arange(atoms_count, dtype=np.int64)
+		# Leaves of the same color bonded to the same atom (ie: hydrogens of a methyl group) are always symmetric,
+		# all of them are told apart at once
+		degrees: np.ndarray = np.bincount(bond_atoms.reshape(-1), minlength=atoms_count)
+		leaf_bonds: np.ndarray = np.concatenate((bond_atoms[degrees[bond_atoms[:, 0]] == 1], bond_atoms[degrees[bond_atoms[:, 1]] == 1][:, ::-1]))
+		if len(leaf_bonds) > 0:
+			leaves: np.ndarray = leaf_bonds[:, 0]
+			leaf_order: np.ndarray = np.lexsort((leaves, colors[leaves], leaf_bonds[:, 1]))
+			leaves = leaves[leaf_order]
+			parents: np.ndarray = leaf_bonds[leaf_order, 1]
+			is_group_start: np.ndarray = np.ones(len(leaves), dtype=bool)
+			is_group_start[1:] = (parents[1:] != parents[:-1]) | (colors[leaves[1:]] != colors[leaves[:-1]])
+			group_starts: np.ndarray = np.maximum.accumulate(np.where(is_group_start, np.arange(len(leaves)), 0))
+			ranks_in_group: np.ndarray = np.arange(len(leaves)) - group_starts
+			keys: np.ndarray = colors * (int(ranks_in_group.max()) + 1)
+			keys[leaves] += ranks_in_group
+			colors = self._refine_colors(np.unique(keys, return_inverse=True)[1].reshape(-1), bond_atoms, bond_orders, atoms_count)
+		for _individualization in range(MOLECULE_IDENTITY_MAX_INDIVIDUALIZATIONS):
+			# Lowest atom id of the lowest tied color of every molecule
+			order: np.ndarray = np.lexsort((atom_ids, colors, labels))
+			is_tied_with_previous: np.ndarray = np.zeros(atoms_count, dtype=bool)
+			is_tied_with_previous[1:] = (labels[order[1:]] == labels[order[:-1]]) & (colors[order[1:]] == colors[order[:-1]])
+			starts_tie: np.ndarray = ~is_tied_with_previous & np.append(is_tied_with_previous[1:], False)
+			tie_starts: np.ndarray = np.flatnonzero(starts_tie)
+			if len(tie_starts) == 0:
+				break
+			first_tie_starts: np.ndarray = tie_starts[np.unique(labels[order[tie_starts]], return_index=True)[1]]
+			colors = self._refine_colors(self._split_colors(colors, order[first_tie_starts]), bond_atoms, bond_orders, atoms_count)
+		return colors
+	
+	def _match_reordered_copies(self, candidates: np.ndarray, partition: MoleculePartition, elements: np.ndarray, charges: np.ndarray, bond_atoms: np.ndarray, bond_orders: np.ndarray):
+		colors: np.ndarray = self._refine_colors(self._get_initial_colors(elements, charges, bond_atoms), bond_atoms, bond_orders)
+		molecule_hashes: np.ndarray = np.zeros(partition.molecules_count, dtype=np.uint64)
+		np.add.at(molecule_hashes, partition.labels, mix_hashes(colors))
+		colors = self._break_ties(colors, partition.labels, bond_atoms, bond_orders)
+		# Atoms sorted by canonical color inside of every molecule
+		sorted_atoms: np.ndarray = np.lexsort((colors, partition.labels))
+		sorted_local_ids: np.ndarray = np.empty(len(colors), dtype=np.int64)
+		sorted_local_ids[sorted_atoms] = np.arange(len(colors), dtype=np.int64) - partition.atom_offsets[partition.labels[sorted_atoms]]
+		sorted_atoms_table: np.ndarray = np.column_stack((elements[sorted_atoms], charges[sorted_atoms])).astype(np.int64)
+		sorted_bonds_table: np.ndarray = self._get_bonds_table(sorted_local_ids, partition.labels, bond_atoms, bond_orders)
+		atom_offsets: list[int] = partition.atom_offsets.tolist()
+		bond_offsets: list[int] = partition.bond_offsets.tolist()
+		def is_same_molecule(molecule1: int, molecule2: int) -> bool:
+			atoms1 = slice(atom_offsets[molecule1], atom_offsets[molecule1+1])
+			atoms2 = slice(atom_offsets[molecule2], atom_offsets[molecule2+1])
+			bonds1 = slice(bond_offsets[molecule1], bond_offsets[molecule1+1])
+			bonds2 = slice(bond_offsets[molecule2], bond_offsets[molecule2+1])
+			return np.array_equal(sorted_atoms_table[atoms1], sorted_atoms_table[atoms2]) \
+					and np.array_equal(sorted_bonds_table[bonds1], sorted_bonds_table[bonds2])
+		# local atom order of every matched molecule, relative to its current order
+		local_orders: dict = {}
+		representatives_by_hash: dict = {}
+		for molecule in candidates.tolist():
+			hash_key: tuple = (int(molecule_hashes[molecule]), atom_offsets[molecule+1] - atom_offsets[molecule], bond_offsets[molecule+1] - bond_offsets[molecule])
+			representatives: list[int] = representatives_by_hash.setdefault(hash_key, [])
+			for representative in representatives:
+				if is_same_molecule(representative, molecule):
+					# Atom at local position i in the representative has the same sorted position as the
+					# atom that has to take position i in this molecule
+					representative_atoms: np.ndarray = partition.atoms[atom_offsets[representative]:atom_offsets[representative+1]]
+					matching_sorted_atoms: np.ndarray = sorted_atoms[atom_offsets[molecule] + sorted_local_ids[representative_atoms]]
+					local_orders[molecule] = partition.local_atom_ids[matching_sorted_atoms]
+					self.representatives[molecule] = representative
+					break
+			else:
+				representatives.append(molecule)
+		# Copies with the same local order as a matched molecule are reordered the same way
+		for molecule, representative in enumerate(self.representatives.tolist()):
+			local_order: np.ndarray = local_orders.get(representative, None)
+			if local_order is None:
+				local_order = local_orders.get(molecule, None)
+			else:
+				self.representatives[molecule] = self.representatives[representative]
+			if local_order is not None:
+				offset: int = atom_offsets[molecule]
+				self.atoms[offset:offset + len(local_order)] = partition.atoms[offset + local_order]
+
+CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "logs", "cache")
+PARTIAL_CHARGE_CACHE_PATH = os.path.join(CACHE_DIRECTORY, "partial_charges.sqlite")
+# Methods are tried in order, a molecule that fails with one method makes all molecules use the next one
+PARTIAL_CHARGE_METHODS = ["mmff94", "gasteiger"]
+# Key of Molecule.properties with the identity key of the molecule, see patches/patch_frozen_molecule.py
+MOLECULE_IDENTITY_KEY_PROPERTY = "msep_identity_key"
+# Charges are stored in elementary charge units
+CHARGES_DTYPE = np.dtype("<f8")
+
+class CanonicalGraph:
+	# Hash of the molecular graph (elements, formal charges and bond orders) with atoms relabeled
+	# by their canonical rank, so any atom order of the same molecule has the same key
+	def __init__(self, molecule: Molecule, elements: list[int], formal_charges: list[int], bonds: list[list[int]], bond_orders: list[int]):
+		self.ranks: np.ndarray = np.array(list(Chem.CanonicalRankAtoms(molecule.to_rdkit(), breakTies=True)), dtype=np.int64)
+		order: np.ndarray = np.argsort(self.ranks)
+		atoms_table: np.ndarray = np.column_stack((np.array(elements, dtype=np.int64)[order], np.array(formal_charges, dtype=np.int64)[order]))
+		bonds_table: np.ndarray = np.empty((len(bonds), 3), dtype=np.int64)
+		if len(bonds) > 0:
+			ranked_bonds: np.ndarray = self.ranks[np.array(bonds, dtype=np.int64)]
+			bonds_table = np.column_stack((ranked_bonds.min(axis=1), ranked_bonds.max(axis=1), np.array(bond_orders, dtype=np.int64)))
+			bonds_table = bonds_table[np.lexsort(bonds_table.T[::-1])]
+		key = hashlib.sha256()
+		key.update(struct.pack("<QQ", len(atoms_table), len(bonds_table)))
+		key.update(atoms_table.tobytes())
+		key.update(bonds_table.tobytes())
+		self.key: str = key.hexdigest()
+
+class PartialChargeCacheStats:
+	def __init__(self):
+		self.hits: int = 0
+		self.misses: int = 0
+		self.seconds_saved: float = 0.0
+		self.seconds_computing: float = 0.0
 	
 	def __str__(self):
-		if self.hybridization == 0:
-			return self.symbol
-		return f"{self.symbol}{self.hybridization}"
-
+		return f"hits={self.hits}, misses={self.misses}, time saved={self.seconds_saved:.2f}s, time computing={self.seconds_computing:.2f}s"
+
+class PartialChargeCache:
+	# Partial charges of every molecule charged before, stored in SQLite so they survive server restarts.
+	# Charges are stored in canonical atom order together with the method that produced them,
+	# failures of a method that has a fallback are stored too so it is not attempted again.
+	def __init__(self, path: str):
+		self._path: str = path
+		self._lock = threading.Lock()
+		self._connection: sqlite3.Connection = None
+	
+	def reset_after_fork(self) -> None:
+		# SQLite connections can't be used by a forked process, the child opens its own
+		self._lock = threading.Lock()
+		self._connection = None
+	
+	def assign_partial_charges(self, molecule: Molecule, canonical_graph: CanonicalGraph, method: str, stats: PartialChargeCacheStats) -> None:
+		# canonical_graph is None for molecules that can't be canonicalized, they are never cached
+		if canonical_graph != None:
+			cached: tuple = self._load(canonical_graph.key, method)
+			if cached != None:
+				charges, seconds = cached
+				if charges is None:
+					raise Exception(f"Partial charges method '{method}' failed before for this molecule")
+				molecule.partial_charges = openff_unit.Quantity(charges[canonical_graph.ranks], openff_unit.elementary_charge)
+				stats.hits += 1
+				stats.seconds_saved += seconds
+				return
+		stats.misses += 1
+		start_time: float = time.perf_counter()
+		try:
+			molecule.assign_partial_charges(partial_charge_method=method, toolkit_registry=RDKitToolkitWrapper())
+		except Exception:
+			if canonical_graph != None and method != PARTIAL_CHARGE_METHODS[-1]:
+				self._store(canonical_graph.key, method, None, time.perf_counter() - start_time)
+			raise
+		seconds: float = time.perf_counter() - start_time
+		stats.seconds_computing += seconds
+		if canonical_graph != None:
+			charges: np.ndarray = np.asarray(molecule.partial_charges.m_as(openff_unit.elementary_charge), dtype=np.float64)
+			charges_by_rank: np.ndarray = np.empty_like(charges)
+			charges_by_rank[canonical_graph.ranks] = charges
+			self._store(canonical_graph.key, method, charges_by_rank, seconds)
+	
+	def _get_connection(self) -> sqlite3.Connection:
+		if self._connection == None:
+			Path(os.path.dirname(self._path)).mkdir(parents=True, exist_ok=True)
+			self._connection = sqlite3.connect(self._path, check_same_thread=False)
+			self._connection.execute("CREATE TABLE IF NOT EXISTS partial_charges "
+					"(graph_key TEXT, method TEXT, charges BLOB, seconds REAL, PRIMARY KEY (graph_key, method))")
+			self._connection.commit()
+		return self._connection
+	
+	def _load(self, graph_key: str, method: str) -> tuple:
+		# Returns (charges or None if the method failed, seconds it took to compute) or None when not cached
+		try:
+			with self._lock:
+				row: tuple = self._get_connection().execute("SELECT charges, seconds FROM partial_charges WHERE graph_key = ? AND method = ?",
+						(graph_key, method)).fetchone()
+		except sqlite3.Error as e:
+			logging.warning(f"Failed to read partial charges cache: {e}")
+			return None
+		if row == None:
+			return None
+		charges: np.ndarray = None if row[0] == None else np.frombuffer(row[0], dtype=CHARGES_DTYPE)
+		return charges, row[1]
+	
+	def _store(self, graph_key: str, method: str, charges: np.ndarray, seconds: float) -> None:
+		charges_blob: bytes = None if charges is None else charges.astype(CHARGES_DTYPE).tobytes()
+		try:
+			with self._lock:
+				connection: sqlite3.Connection = self._get_connection()
+				connection.execute("INSERT OR REPLACE INTO partial_charges VALUES (?, ?, ?, ?)", (graph_key, method, charges_blob, seconds))
+				connection.commit()
+		except sqlite3.Error as e:
+			logging.warning(f"Failed to write partial charges cache: {e}")
 
+partial_charge_cache = PartialChargeCache(PARTIAL_CHARGE_CACHE_PATH)
 
 class PayloadTopologyReader(PayloadChunkReader):
 	def __init__(self, chunk, molecules_count, atoms_count, bonds_count, forcefield_list):
@@ -167,120 +635,120 @@ class PayloadTopologyReader(PayloadChunkReader):
 		self.atoms_count: int = atoms_count
 		self.bonds_count: int = bonds_count
 		self.forcefields: list[str] = str(forcefield_list).split(";")
-		self.atoms: list[AtomData] = []
-		self.bonds: list[tuple[int, int, int]] = []
 		self.molecule_ids: list[int] = []
 		self.motors_forces: list[MotorForce] = []
 		self.anchors: dict = {}
 		self._openff_molecules: list[Molecule] = []
-		self.payload_to_openff_atom: dict = {}
-		self.openff_atom_to_payload: dict = {}
-		atoms_molecule_id: list[int] = []
-		passivation_atom_molecule_id: list[int] = []
-		total_passivation_atoms_count: int = 0
-		for i in range(molecules_count):
-			molecule_id: int = self.read_uint32()
-			atoms_count_in_molecule: int = self.read_uint32()
-			passivation_atoms_count_in_molecule: int = self.read_uint32()
-			total_passivation_atoms_count += passivation_atoms_count_in_molecule
-			for _ in range(atoms_count_in_molecule):
-				atoms_molecule_id.append(molecule_id)
-			for _ in range(passivation_atoms_count_in_molecule):
-				passivation_atom_molecule_id.append(molecule_id)
-		for i in range(self.atoms_count):
-			element = self.read_uint8()
-			hybridization = self.read_uint8()
-			charge = self.read_signed_int8()
-			locked = self.read_uint8() != 0
-			atom_molecule_id = atoms_molecule_id[i]
-			atom = AtomData(element, hybridization, charge, atom_molecule_id, locked)
-			self.atoms.append(atom)
-		for i in range(self.bonds_count):
-			atom1 = self.read_uint32()
-			atom2 = self.read_uint32()
-			order = self.read_uint8()
-			self.bonds.append((atom1, atom2, order))
-		# All atoms tracked by MSEP are loaded, now let's add "ghost/passivation" atoms
-		for i in range(total_passivation_atoms_count):
-			passivated_atom_id = self.read_uint32()
-			# Create Atom
-			element = 1 # Hydrogen
-			hybridization = 0
-			charge = 0
-			locked = False
-			atom_molecule_id = passivation_atom_molecule_id[i]
-			atom = AtomData(element, hybridization, charge, atom_molecule_id, locked, is_passivation_atom=True)
-			self.atoms.append(atom)
-			new_atom_id = len(self.atoms) - 1
-			# Create Bond
-			order = 1
-			self.bonds.append((passivated_atom_id, new_atom_id, order))
+		self._openff_molecules_partial_charge_method: str = None
+		# Method of PARTIAL_CHARGE_METHODS that charged the molecules returned by the last to_openff_molecules() call
+		self.partial_charge_method: str = None
+		self.partition: MoleculePartition = None
+		self.molecule_identities: MoleculeIdentities = None
+		# Permutation arrays, filled by build_atom_maps()
+		self.payload_to_openff_atom: np.ndarray = np.empty(0, dtype=np.int64)
+		self.openff_atom_to_payload: np.ndarray = np.empty(0, dtype=np.int64)
+		# Every chunk is decoded in one pass as a view over the received frame
+		molecules_chunk: np.ndarray = self.read_array(MOLECULE_CHUNK_DTYPE, molecules_count)
+		atoms_chunk: np.ndarray = self.read_array(ATOM_CHUNK_DTYPE, self.atoms_count)
+		bonds_chunk: np.ndarray = self.read_array(BOND_CHUNK_DTYPE, self.bonds_count)
+		total_passivation_atoms_count: int = int(molecules_chunk["passivation_atoms_count"].sum())
+		passivated_atom_ids: np.ndarray = self.read_array(ATOM_ID_DTYPE, total_passivation_atoms_count)
 		assert(self.seek == len(self.chunk))
+		self.molecule_ids = molecules_chunk["molecule_id"].tolist()
+		atoms_molecule_id: np.ndarray = np.repeat(molecules_chunk["molecule_id"], molecules_chunk["atoms_count"])
+		passivation_atom_molecule_id: np.ndarray = np.repeat(molecules_chunk["molecule_id"], molecules_chunk["passivation_atoms_count"])
+		# All atoms tracked by MSEP are followed by "ghost/passivation" atoms, which are
+		# Hydrogens bonded to the passivated atom
+		self.atom_elements: np.ndarray = np.concatenate((atoms_chunk["element"], np.full(total_passivation_atoms_count, 1, dtype=np.uint8)))
+		self.atom_hybridizations: np.ndarray = np.concatenate((atoms_chunk["hybridization"], np.zeros(total_passivation_atoms_count, dtype=np.uint8)))
+		self.atom_charges: np.ndarray = np.concatenate((decode_signed_int8_array(atoms_chunk["charge"]), np.zeros(total_passivation_atoms_count, dtype=np.int8)))
+		self.atom_molecule_ids: np.ndarray = np.concatenate((atoms_molecule_id[:self.atoms_count], passivation_atom_molecule_id)).astype(np.int64)
+		self.atom_is_locked: np.ndarray = np.concatenate((atoms_chunk["locked"] != 0, np.zeros(total_passivation_atoms_count, dtype=bool)))
+		self.atom_is_passivation: np.ndarray = np.concatenate((np.zeros(self.atoms_count, dtype=bool), np.ones(total_passivation_atoms_count, dtype=bool)))
+		passivation_atom_ids: np.ndarray = np.arange(self.atoms_count, self.atoms_count + total_passivation_atoms_count, dtype=np.int64)
+		self.bond_atoms: np.ndarray = np.concatenate((
+			np.column_stack((bonds_chunk["atom1"], bonds_chunk["atom2"])).astype(np.int64),
+			np.column_stack((passivated_atom_ids.astype(np.int64), passivation_atom_ids))
+		)).reshape(-1, 2)
+		self.bond_orders: np.ndarray = np.concatenate((bonds_chunk["order"], np.ones(total_passivation_atoms_count, dtype=np.uint8)))
 	
-	def add_virtual_object(self, json_object: dict):
+	def add_virtual_object(self, json_object: dict, state_payload: PayloadStateReader):
 		if json_object["is"] == "shape":
 			# TODO: handle Shapes
 			logging.warning(f"TODO: Handle shape data: {str(json_object)}")
 		elif json_object["is"] == "motor":
-			self.motors_forces.append(MotorForce(json_object, topology, state))
+			self.motors_forces.append(MotorForce(json_object, self, state_payload))
 		elif json_object["is"] == "anchor":
 			anchor_id: int = json_object["anchor_id"]
 			self.anchors[anchor_id] = AnchorPoint(json_object)
 		elif json_object["is"] == "spring":
 			anchor_id: int = json_object["anchor_id"]
-			spring = Spring(json_object, topology)
+			spring = Spring(json_object, self)
 			self.anchors[anchor_id].springs.append(spring)
 	
-	def to_openff_molecules(self) -> list[Molecule]:
-		if len(self._openff_molecules) > 0:
+	def build_atom_maps(self) -> MoleculePartition:
+		# in order to identify which atom is which we need a map
+		# atoms inside the system will be in the same order as molecules in this list
+		if self.partition != None:
+			return self.partition
+		self.partition = MoleculePartition(len(self.atom_elements), self.bond_atoms)
+		if DEDUPLICATE_MOLECULES:
+			self.molecule_identities = MoleculeIdentities(self.partition, self.atom_elements, self.atom_charges, self.bond_atoms, self.bond_orders)
+			self.partition.reorder_atoms(self.molecule_identities.atoms)
+			logging.info(f"Found {self.molecule_identities.unique_molecules_count} unique molecules out of {self.partition.molecules_count}")
+		self.openff_atom_to_payload = self.partition.atoms
+		self.payload_to_openff_atom = np.empty_like(self.openff_atom_to_payload)
+		self.payload_to_openff_atom[self.openff_atom_to_payload] = np.arange(len(self.openff_atom_to_payload), dtype=np.int64)
+		return self.partition
+	
+	def to_openff_molecules(self, groups: list[int] = None) -> list[Molecule]:
+		# groups: representative molecules to create (without their copies), all molecules by default
+		if groups == None and len(self._openff_molecules) > 0:
+			self.partial_charge_method = self._openff_molecules_partial_charge_method
 			return self._openff_molecules
-		molecules: list[Molecule] = []
-		atom_to_group: dict = {}
-		atom_to_group_atom: dict = {}
-		group_atom_to_atom: dict = {}
-		mol = Molecule()
-
-		for atoms_in_group in self.find_unconnected_molecules(range(self.atoms_count), self.bonds):
+		partition: MoleculePartition = self.build_atom_maps()
+		# Per molecule slices of atoms and bonds, bonds are expressed in atom indices local to their molecule
+		elements: list[int] = self.atom_elements[partition.atoms].tolist()
+		charges: list[int] = self.atom_charges[partition.atoms].tolist()
+		local_bonds: list[list[int]] = partition.local_atom_ids[self.bond_atoms[partition.bonds]].tolist()
+		bond_orders: list[int] = self.bond_orders[partition.bonds].tolist()
+		atom_offsets: list[int] = partition.atom_offsets.tolist()
+		bond_offsets: list[int] = partition.bond_offsets.tolist()
+
+		# Only representative molecules are created and charged, copies are created from them afterwards
+		representatives: list[int] = self.molecule_identities.representatives.tolist() if self.molecule_identities != None \
+				else list(range(partition.molecules_count))
+		created_groups: list[int] = groups if groups != None else [group for group in range(partition.molecules_count) if representatives[group] == group]
+		molecules: list[Molecule] = [None] * partition.molecules_count
+		canonical_graphs: list[CanonicalGraph] = [None] * partition.molecules_count
+		for group in created_groups:
 			mol = Molecule()
-			group = len(molecules)
-			molecules.append(mol)
-			for atom_id in atoms_in_group:
-				atom: AtomData = self.atoms[atom_id]
-				atom_to_group[atom_id] = group
-				atom_to_group_atom[atom_id] = mol.add_atom(atomic_number=atom.element, formal_charge=atom.charge, is_aromatic=False)
-				group_atom_to_atom[(group,atom_to_group_atom[atom_id])] = atom_id
-		
-		for bond in self.bonds:
-			atom1, atom2, bond_order = bond
-			group = atom_to_group[atom1]
-			mol = molecules[group]
-			mol.add_bond(atom_to_group_atom[atom1], atom_to_group_atom[atom2], bond_order, is_aromatic=False, stereochemistry = None, fractional_bond_order = None)
-		logging.info(f"Created {len(molecules)} molecules")
-		
-		# in order to identify which atom is which we need a map
-		# 1. initialize a list with the size of self.atoms filled with 0(es)
-		self.payload_to_openff_atom: dict = {}
-		self.openff_atom_to_payload: dict = {}
-		# 2. atoms inside the system will be in the same order as molecules in this list
-		next_openff_atom = 0
-		for group,mol in enumerate(molecules):
-			for i in range(len(mol.atoms)):
-				payload_atom = group_atom_to_atom[(group,i)]
-				self.openff_atom_to_payload[next_openff_atom] = payload_atom
-				if payload_atom in self.payload_to_openff_atom:
-					logging.error(f"ERROR: payload atom")
-				self.payload_to_openff_atom[payload_atom] = next_openff_atom
-				next_openff_atom += 1
+			molecules[group] = mol
+			atoms_range = slice(atom_offsets[group], atom_offsets[group+1])
+			bonds_range = slice(bond_offsets[group], bond_offsets[group+1])
+			for element, charge in zip(elements[atoms_range], charges[atoms_range]):
+				mol.add_atom(atomic_number=element, formal_charge=charge, is_aromatic=False)
+			for (atom1, atom2), bond_order in zip(local_bonds[bonds_range], bond_orders[bonds_range]):
+				mol.add_bond(atom1, atom2, bond_order, is_aromatic=False, stereochemistry = None, fractional_bond_order = None)
+			try:
+				canonical_graphs[group] = CanonicalGraph(mol, elements[atoms_range], charges[atoms_range], local_bonds[bonds_range], bond_orders[bonds_range])
+			except Exception as e:
+				# RDKit rejected the molecule, charges will be computed without cache (and will most likely fail)
+				pass
+		logging.info(f"Created {len(created_groups)} molecules")
+		molecule_offsets: list[int] = atom_offsets
 
-		try:
-			for mol in molecules:
-				mol.assign_partial_charges(partial_charge_method="mmff94", toolkit_registry=RDKitToolkitWrapper())
-		except Exception as e:
-			logging.warning(f"Failed to assign partial charges with method 'mmff94'. Fallback to 'gasteiger'")
+		charges_stats = PartialChargeCacheStats()
+		for method_index, method in enumerate(PARTIAL_CHARGE_METHODS):
 			try:
-				for i, mol in enumerate(molecules):
-					mol.assign_partial_charges(partial_charge_method="gasteiger", toolkit_registry=RDKitToolkitWrapper())
+				for i in created_groups:
+					partial_charge_cache.assign_partial_charges(molecules[i], canonical_graphs[i], method, charges_stats)
+				self.partial_charge_method = method
+				break
 			except Exception as e:
+				if method_index + 1 < len(PARTIAL_CHARGE_METHODS):
+					logging.warning(f"Failed to assign partial charges with method '{method}'. Fallback to '{PARTIAL_CHARGE_METHODS[method_index + 1]}'")
+					continue
 				# Atom id in the error is the ID of the molecule, not the ID in the entire structure
 				# we need to rewrite the error before raising it
 				err_text: str = str(e)
@@ -289,55 +757,57 @@ class PayloadTopologyReader(PayloadChunkReader):
 				num_string: str = err_text[start:end]
 				mol_atom_id: int = int(num_string)
 				# `i` from for loop should be unchanged
-				payload_atom: int = group_atom_to_atom[(i, mol_atom_id)]
-				openff_atom_id: int = self.payload_to_openff_atom[payload_atom]
+				openff_atom_id: int = molecule_offsets[i] + mol_atom_id
 				err_text = err_text[0:start] + str(openff_atom_id) + err_text[end:len(err_text)]
 				raise Exception(err_text)
-		
+		logging.info(f"Partial charges cache: {charges_stats}")
+		if self.molecule_identities != None:
+			# Lets patch_frozen_molecule match copies without comparing them atom by atom. Molecule.properties is
+			# kept by the copies openff makes (Molecule(other), Topology.add_molecule), unlike plain attributes.
+			for group in created_groups:
+				molecules[group].properties[MOLECULE_IDENTITY_KEY_PROPERTY] = self.molecule_identities.identity_keys[group]
+		if groups != None:
+			return [molecules[group] for group in groups]
+		if self.molecule_identities != None:
+			for group, representative in enumerate(representatives):
+				if representative != group:
+					# Same atom order, partial charges and identity key as the representative
+					molecules[group] = Molecule(molecules[representative])
 		self._openff_molecules = molecules
+		self._openff_molecules_partial_charge_method = self.partial_charge_method
 		return molecules
 
-	def find_unconnected_molecules(self, atoms, bonds):
-		# Create an adjacency list for the graph
-		graph = defaultdict(list)
-		for bond in bonds:
-			atom1, atom2, _ = bond
-			graph[atom1].append(atom2)
-			graph[atom2].append(atom1)
-		
-		# Function to perform BFS and find all nodes in the same component
-		def bfs(start, visited):
-			queue = deque([start])
-			component = []
-			while queue:
-				node = queue.popleft()
-				if node not in visited:
-					visited.add(node)
-					component.append(node)
-					for neighbor in graph[node]:
-						if neighbor not in visited:
-							queue.append(neighbor)
-			return component
-		
-		# Find all connected components
-		visited = set()
-		molecules = []
-		for atom in atoms:
-			if atom not in visited:
-				component = bfs(atom, visited)
-				molecules.append(component)
-		
-		return molecules
+	def create_openmm_topology(self) -> app.Topology:
+		# Same atoms and bonds as Topology.from_molecules(self.to_openff_molecules()).to_openmm(),
+		# without creating (and charging) the openff molecules
+		partition: MoleculePartition = self.build_atom_maps()
+		openmm_topology = app.Topology()
+		chain = openmm_topology.addChain()
+		elements: list[int] = self.atom_elements[partition.atoms].tolist()
+		atom_offsets: list[int] = partition.atom_offsets.tolist()
+		atoms: list = []
+		for group in range(partition.molecules_count):
+			residue = openmm_topology.addResidue("UNK", chain)
+			for element in elements[atom_offsets[group]:atom_offsets[group+1]]:
+				openmm_element = app.element.Element.getByAtomicNumber(element)
+				atoms.append(openmm_topology.addAtom(openmm_element.symbol, openmm_element, residue))
+		bond_atoms: list[list[int]] = self.payload_to_openff_atom[self.bond_atoms].tolist()
+		for (atom1, atom2), bond_order in zip(bond_atoms, self.bond_orders.tolist()):
+			openmm_topology.addBond(atoms[atom1], atoms[atom2], order=bond_order)
+		return openmm_topology
+	
+	def pack_openff_atom_id_map(self) -> bytes:
+		# Pairs of (openff_atom_id: uint32, payload_atom_id: uint32)
+		openff_atom_ids: np.ndarray = np.arange(len(self.openff_atom_to_payload))
+		return np.column_stack((openff_atom_ids, self.openff_atom_to_payload)).astype(ATOM_ID_DTYPE).tobytes()
 
 
 class PayloadStateReader(PayloadChunkReader):
 	def __init__(self, chunk, atoms_count, passivation_atoms_count):
 		super().__init__(chunk)
 		self.atoms_count: int = atoms_count
-		self.positions: list[Vec3] = []
-		for i in range(self.atoms_count + passivation_atoms_count):
-			pos = Vec3(self.read_float(), self.read_float(), self.read_float())
-			self.positions.append(pos)
+		# (N, 3) view over the chunk, in nanometers
+		self.positions: np.ndarray = self.read_array(POSITION_DTYPE, (self.atoms_count + passivation_atoms_count) * 3).reshape(-1, 3)
 		assert(self.seek == len(self.chunk))
 
 
@@ -345,7 +815,7 @@ class Spring:
 	def __init__(self, spring_data: dict, topology_payload: PayloadTopologyReader) -> None:
 		self.anchor_id: int = spring_data["anchor_id"]
 		msep_atom_id: int = spring_data["particle_id"]
-		openff_atom_id = topology_payload.payload_to_openff_atom[msep_atom_id]
+		openff_atom_id = int(topology_payload.payload_to_openff_atom[msep_atom_id])
 		self.particle_id: int = openff_atom_id
 		self.k_constant: float = spring_data["k_constant"]
 		self.equilibrium_length: float = spring_data["equilibrium_length"]
@@ -353,9 +823,9 @@ class Spring:
 
 class AnchorPoint:
 	def __init__(self, anchor_data: dict) -> None:
-		self.anchor_id: int = json_object["anchor_id"]
+		self.anchor_id: int = anchor_data["anchor_id"]
 		self.openmm_particle_id = -1 # to be overriden when PayloadTopologyReader.to_openmm() is called
-		self.position: list[float] = json_object["position"]
+		self.position: list[float] = anchor_data["position"]
 		self.springs: list[Spring] = []
 
 
@@ -382,14 +852,47 @@ class CycleType(IntEnum):
 	BY_DISTANCE = 2, ## In every cycle, motor will stop after a fixed amount of distance was covered, This distance is in nanometers for linear motors and revolutions for rotary motors
 
 MOTOR_DEBUG_PRINTS = False
+# Apply motors inside the integrator (see create_motors_integrator), Python only updates their speed once per chunk.
+# When False motors override the velocities from Python every motor update (required by MOTOR_PER_PARTICLE_LOG_FILES)
+IN_KERNEL_MOTORS = True
 MOTOR_PER_PARTICLE_LOG_FILES = [] # ie: [1, 2, 60, ....]
+MOTOR_DEBUG_SAMPLE_INTERVAL = 64 # motor updates between two samples of MOTOR_PER_PARTICLE_LOG_FILES
 PI = 3.14159265359
 class MotorForce:
 	def __init__(self, motor_force_data: dict, topology_payload: PayloadTopologyReader, state_payload: PayloadStateReader) -> None:
 		self.stopped = False
+		# -1 for payloads created before motors were identified, these can't be updated
+		self.motor_id: int = motor_force_data.get("motor_id", -1)
 		self.connected_molecules: list[int] = motor_force_data["connected_molecules"]
 		self.motor_type: MotorType = motor_force_data["parameters"]["motor_type"]
-		
+		self._set_parameters(motor_force_data)
+		# Initialize motor internal state
+		self.time_accum: float = 0
+		self.distance_accum: float = 0
+		self.cycle_counter: int = 0
+		self.cycle_time_accum: float = 0.0
+		self.cycle_distance_accum: float = 0.0
+		self.cycle_started_to_stop_at_time: float = 0
+		self.cycle_pause_time_accum: float = 0.0
+		self.cycle_paused: bool = False
+		self.print_counter: int = 0
+		atoms_count: int = topology_payload.atoms_count
+		is_connected: np.ndarray = np.isin(topology_payload.atom_molecule_ids[:atoms_count], self.connected_molecules)
+		# openff ids of the atoms moved by this motor
+		self.atom_ids: np.ndarray = topology_payload.payload_to_openff_atom[:atoms_count][is_connected]
+		types_str: list[str] = ["unk", "rotary", "linear"]
+		logging.info(f"Added {len(self.atom_ids)} particles to {types_str[self.motor_type]} force")
+	
+	def update_parameters(self, motor_force_data: dict) -> None:
+		# Called by a running simulation, the cycle state is kept and a stopped motor starts again.
+		# Moved atoms and motor type are fixed for the whole simulation
+		if motor_force_data["parameters"]["motor_type"] != self.motor_type:
+			logging.warning(f"Motor {self.motor_id} can't change its type while the simulation is running")
+			return
+		self._set_parameters(motor_force_data)
+		self.stopped = False
+	
+	def _set_parameters(self, motor_force_data: dict) -> None:
 		self.ramp_in_time_in_nanoseconds: float = motor_force_data["parameters"]["ramp_in_time_in_nanoseconds"]
 		match self.motor_type:
 			case MotorType.ROTARY:
@@ -402,7 +905,6 @@ class MotorForce:
 				top_revolutions_per_nanosecond: float = motor_force_data["parameters"]["top_revolutions_per_nanosecond"]
 				# convert Rev/ns to RADIANS/ns
 				self.top_speed_in_radians_per_nanosecond = top_revolutions_per_nanosecond * 2.0 * PI
-				self.last_motor_velocities = []
 			case MotorType.LINEAR:
 				linear_polarity: LinearPolarity = motor_force_data["parameters"]["polarity"]
 				self.polarity: float = 1.0 if linear_polarity == LinearPolarity.FORWARD else -1.0
@@ -503,152 +1005,40 @@ class MotorForce:
 				else: # MotorType.LINEAR
 					self.top_speed_in_nanometers_by_nanoseconds = self.ramp_in_time_in_nanoseconds * self.cycle_accel
 			self.cycle_start_stop_at_distance: float = cycle_limit - expected_deceleration_distance
-		pos: list[float] = motor_force_data["position"]
-		self.position = Vec3(pos[0], pos[1], pos[2]) * nanometer
-		dir: list[float] = motor_force_data["axis_direction"]
-		self.axis_direction: Vec3 = Vec3(dir[0], dir[1], dir[2])
-		# Initialize motor internal state
-		self.atom_ids: list[int] = []
-		Path(os.path.expanduser(os.path.join('~','particle_logs'))).mkdir(parents=True, exist_ok=True)
-		self.particle_log_file: list[int] = []
-		self.time_accum: float = 0
-		self.distance_accum: float = 0
-		self.cycle_counter: int = 0
-		self.cycle_time_accum: float = 0.0
-		self.cycle_distance_accum: float = 0.0
-		self.cycle_started_to_stop_at_time: float = 0
-		self.cycle_pause_time_accum: float = 0.0
-		self.cycle_paused: bool = False
-		self.print_counter: int = 0
-		added_particles = 0
-		is_rotary: bool = self.motor_type == MotorType.ROTARY
-		for i in range(topology_payload.atoms_count):
-			atom: AtomData = topology_payload.atoms[i]
-			if not atom.molecule_id in self.connected_molecules:
-				continue
-			openff_atom_id = topology_payload.payload_to_openff_atom[i]
-			self.atom_ids.append(openff_atom_id)
-			self.particle_log_file.append(os.path.expanduser(os.path.join('~','particle_logs',f'{openff_atom_id}.log')))
-			if is_rotary:
-				self.last_motor_velocities.append(Vec3(0.0, 0.0, 0.0) * nanometer / nanosecond)
-				self.init_particle_log(self.atom_ids.index(openff_atom_id))
-			added_particles += 1
-		types_str: list[str] = ["unk", "rotary", "linear"]
-		logging.info(f"Added {added_particles} particles to {types_str[self.motor_type]} force")
-
-	def particle_log(self, i, text):
-		atom_id: int = self.atom_ids[i]
-		if not atom_id in MOTOR_PER_PARTICLE_LOG_FILES:
-			return
-		with open(self.particle_log_file[i], 'a') as f:
-			print(text, file=f)
-	
-	def init_particle_log(self, i):
-		atom_id: int = self.atom_ids[i]
-		if not atom_id in MOTOR_PER_PARTICLE_LOG_FILES:
-			return
-		# deletes file if exists
-		try:
-			os.remove(self.particle_log_file[i])
-		except OSError:
-			pass
-		
-		with open(self.particle_log_file[i], 'w') as f:
-			f.write("")
-		print(f"Initialized log path: {self.particle_log_file[i]}")
-
-
-	def advance(self, simulation, delta_time_nanoseconds: float):
-		match self.motor_type:
-			case MotorType.ROTARY:
-				self._advance_rotary(simulation, delta_time_nanoseconds)
-			case MotorType.LINEAR:
-				self._advance_linear(simulation, delta_time_nanoseconds)
-			case _:
-				logging.error(f"Unknown motor type '{self.motor_type}'!")
-				pass
-	
-	def _advance_rotary(self, simulation, delta_time: float):
+		# Motor geometry in nanometers
+		self.origin: np.ndarray = np.array(motor_force_data["position"], dtype=np.float64)
+		self.axis: np.ndarray = np.array(motor_force_data["axis_direction"], dtype=np.float64)
+		# Integrator variables are only written when the geometry was changed
+		self._integrator_geometry_changed: bool = True
+
+	def update_speed(self, delta_time: float) -> float:
+		# Advances the motor cycle, returns the signed speed to apply in rad/ps or nm/ps, None when the motor is idle
 		if self.stopped or len(self.atom_ids) == 0:
-			# Nothing to do here
-			return
+			return None
 		self.time_accum += delta_time
 		speed: float = self._calculate_speed(delta_time)
-		self.distance_accum += (delta_time * speed) / (2 * PI) # acum distance is in cycles
-		
-		self.print_counter = (self.print_counter + 1) % 64 # print every 64 steps
-		if self.print_counter == 0:
-			if MOTOR_DEBUG_PRINTS:
-				logging.info(f"motor speed is {speed}rad/ns , distance is {self.distance_accum}nm ")
-		
-		state = simulation.context.getState(getVelocities=True, getPositions= True)
-		prev_velocities = state.getVelocities()
-		positions = state.getPositions()
-		new_velocities = prev_velocities.copy()
-		for i in range(len(self.atom_ids)):
-			atom_id: int = self.atom_ids[i]
-			new_motor_velocity: Vec3 = self._calculate_rotary_motor_particle_velocity(speed, positions[atom_id], i)
-			if atom_id in MOTOR_PER_PARTICLE_LOG_FILES:
-				prev_motor_velocity: Vec3 = self.last_motor_velocities[i]
-				if length_Vec3(prev_motor_velocity) > 0.0 and length_Vec3(new_motor_velocity) > 0.0 and dot_Vec3(normalize_Vec3(prev_motor_velocity), normalize_Vec3(new_motor_velocity)) < 0.1:
-					self.particle_log(i, "		MOTOR DIRECTION SUDDENLY INVERTED!")
-					self.particle_log(i, f"		speed ({speed}) , prev_motor_velocity {prev_motor_velocity}({length_Vec3(prev_motor_velocity)}) new_motor_velocity {new_motor_velocity}({length_Vec3(new_motor_velocity)})")
-			new_velocities[atom_id] = new_motor_velocity
-			self.last_motor_velocities[i] = new_motor_velocity # update record for the next iter
-		simulation.context.setVelocities(new_velocities)
-		return
-	
-	def _calculate_rotary_motor_particle_distance_to_axis(self, particle_pos: Vec3) -> float:
-		axis_of_rotation: Vec3 = closest_point_in_rect_to_other(self.position, self.axis_direction, particle_pos)
-		distance = length_Vec3(particle_pos - axis_of_rotation)
-		return distance
-	
-	def _calculate_rotary_motor_particle_velocity(self, speed: float, particle_pos: Vec3, i: int) -> Vec3:
-		distance_to_axis: float = self._calculate_rotary_motor_particle_distance_to_axis(particle_pos)
-		axis_of_rotation: Vec3 = closest_point_in_rect_to_other(self.position, self.axis_direction, particle_pos)
-		axis_to_particle_vec: Vec3 = particle_pos - axis_of_rotation
-		axis_to_particle_dir: Vec3 = normalize_Vec3(axis_to_particle_vec)
-		move_dir: Vec3 = cross_Vec3(axis_to_particle_dir / nanometer, self.axis_direction) * nanometer / nanosecond
-		velocity: Vec3 = move_dir * speed * distance_to_axis * self.polarity
-		atom_id: int = self.atom_ids[i]
-		if atom_id in MOTOR_PER_PARTICLE_LOG_FILES:
-			# This if condition is not strictly necesary, but will prevent wasting cpu on formating strings
-			self.particle_log(i, f"CALCULATE VELOCITY, time is {self.time_accum * 1000000}fs")
-			self.particle_log(i, f"	particle_pos {particle_pos}")
-			self.particle_log(i, f"	distance_to_axis {distance_to_axis}nm")
-			self.particle_log(i, f"	axis_of_rotation {axis_of_rotation}")
-			self.particle_log(i, f"	axis_to_particle_vec {axis_to_particle_vec}")
-			self.particle_log(i, f"	axis_to_particle_dir {axis_to_particle_dir}")
-			self.particle_log(i, f"	move_dir {move_dir}")
-			self.particle_log(i, f"		velocity ({length_Vec3(velocity)}nm/ns) {velocity}")
-		return velocity
-	
-	def _advance_linear(self, simulation, delta_time: float):
-		if self.stopped or len(self.atom_ids) == 0:
-			# Nothing to do here
-			return
-		
-		self.time_accum += delta_time
-		new_motor_velocity: Vec3 = Vec3(0,0,0) # new motor velocity is the same for all particles linked to the motor
-		speed: float = self._calculate_speed(delta_time)
-		new_motor_velocity = self.axis_direction * speed * self.polarity * nanometer / nanosecond
-		self.distance_accum += delta_time * speed
-		self.print_counter = (self.print_counter + 1) % 64 # print every 64 steps
-
+		if self.motor_type == MotorType.ROTARY:
+			self.distance_accum += (delta_time * speed) / (2 * PI) # acum distance is in cycles
+		else:
+			self.distance_accum += delta_time * speed
+		self.print_counter = (self.print_counter + 1) % 64 # print every 64 updates
 		if self.print_counter == 0 or self.stopped:
 			if MOTOR_DEBUG_PRINTS:
-				logging.info(f"motor velocity is {new_motor_velocity} , distance is {self.distance_accum}nm , time is {self.time_accum * 1000000}fs")
-		
-		state = simulation.context.getState(getVelocities=True)
-		prev_velocities = state.getVelocities()
-		new_velocities = prev_velocities.copy()
-		for i in range(len(self.atom_ids)):
-			atom_id: int = self.atom_ids[i]
-			current_velocity_in_desired_direction = self.axis_direction * dot_Vec3(prev_velocities[atom_id], self.axis_direction) * prev_velocities[atom_id].unit
-			delta_velocity = new_motor_velocity - current_velocity_in_desired_direction
-			new_velocities[atom_id] = prev_velocities[atom_id] + delta_velocity
-		simulation.context.setVelocities(new_velocities)
-		return
+				logging.info(f"motor speed is {speed} , distance is {self.distance_accum} , time is {self.time_accum * 1000000}fs")
+		if self.stopped:
+			return None
+		# speed is in rad/ns or nm/ns, OpenMM works in picoseconds
+		return speed * self.polarity * 1e-3
+	
+	def apply_velocities(self, speed: float, positions: np.ndarray, velocities: np.ndarray) -> None:
+		# positions in nm and velocities in nm/ps of every particle, velocities is modified in place
+		if self.motor_type == MotorType.ROTARY:
+			# cross() ignores the component along the axis, the velocity is speed * distance to the axis
+			velocities[self.atom_ids] = speed * np.cross(positions[self.atom_ids] - self.origin, self.axis)
+		else:
+			# only the component along the axis is replaced
+			motor_velocities: np.ndarray = velocities[self.atom_ids]
+			velocities[self.atom_ids] = motor_velocities + np.outer(speed - motor_velocities @ self.axis, self.axis)
 
 	def _calculate_speed(self, delta_time: float) -> float:
 		if self.cycle_paused:
@@ -694,7 +1084,7 @@ class MotorForce:
 					# Stop
 					if MOTOR_DEBUG_PRINTS:
 						logging.info("Stop")
-					self._stop_motor(simulation)
+					self._stop_motor()
 					speed = 0
 				else:
 					if self.cycle_swap_polarity:
@@ -708,21 +1098,449 @@ class MotorForce:
 		self.cycle_distance_accum += speed * delta_time
 		return speed
 
+	def add_to_integrator(self, integrator: CustomIntegrator, motor_index: int):
+		# Declares the variables of this motor, create_motors_integrator() adds the velocity override itself
+		self.integrator_index = motor_index
+		integrator.addGlobalVariable(f"motor{motor_index}_enabled", 0.0)
+		integrator.addGlobalVariable(f"motor{motor_index}_speed", 0.0)
+		integrator.addPerDofVariable(f"motor{motor_index}_mask", 0.0)
+		for component, i in [("x", 0), ("y", 1), ("z", 2)]:
+			integrator.addGlobalVariable(f"motor{motor_index}_origin_{component}", self.origin[i])
+			integrator.addGlobalVariable(f"motor{motor_index}_axis_{component}", self.axis[i])
+		self._integrator_geometry_changed = False
+	
+	def get_velocity_override_expression(self) -> str:
+		# Same math as apply_velocities(), the speed variable is the value returned by update_speed()
+		prefix: str = f"motor{self.integrator_index}"
+		origin: str = f"vector({prefix}_origin_x, {prefix}_origin_y, {prefix}_origin_z)"
+		axis: str = f"vector({prefix}_axis_x, {prefix}_axis_y, {prefix}_axis_z)"
+		if self.motor_type == MotorType.ROTARY:
+			override: str = f"{prefix}_speed*cross(x-{origin}, {axis}) - v"
+		else:
+			override = f"{axis}*({prefix}_speed - dot(v, {axis}))"
+		return f"v + {prefix}_enabled*{prefix}_mask*({override})"
+	
+	def set_integrator_mask(self, integrator: CustomIntegrator, particles_count: int):
+		mask: np.ndarray = np.zeros((particles_count, 3))
+		mask[self.atom_ids] = 1.0
+		integrator.setPerDofVariableByName(f"motor{self.integrator_index}_mask", mask)
+	
+	def advance_in_integrator(self, integrator: CustomIntegrator, delta_time: float):
+		# Only the speed is sent, the integrator keeps overriding velocities on every step
+		prefix: str = f"motor{self.integrator_index}"
+		if self._integrator_geometry_changed:
+			for component, i in [("x", 0), ("y", 1), ("z", 2)]:
+				integrator.setGlobalVariableByName(f"{prefix}_origin_{component}", self.origin[i])
+				integrator.setGlobalVariableByName(f"{prefix}_axis_{component}", self.axis[i])
+			self._integrator_geometry_changed = False
+		speed: float = self.update_speed(delta_time)
+		if speed == None:
+			integrator.setGlobalVariableByName(f"{prefix}_enabled", 0.0)
+			return
+		integrator.setGlobalVariableByName(f"{prefix}_speed", speed)
+		integrator.setGlobalVariableByName(f"{prefix}_enabled", 1.0)
+	
 	def _invert_polarity(self):
 		# Swap polarity and reset time and distance counters
 		self.polarity *= -1.0
 	
-	def _stop_motor(self, simulation):
+	def _stop_motor(self):
 		self.stopped = True
 	
 
+class MotorDebugRecorder:
+	# Writes ~/particle_logs/<atom_id>.log for the atoms in MOTOR_PER_PARTICLE_LOG_FILES.
+	# Simulation threads only copy a sample of the logged atoms, formatting and writing happen in its own thread
+	def __init__(self, atom_ids: np.ndarray):
+		self._atom_ids: np.ndarray = atom_ids
+		self._logs_dir: str = os.path.expanduser(os.path.join('~','particle_logs'))
+		Path(self._logs_dir).mkdir(parents=True, exist_ok=True)
+		for atom_id in atom_ids.tolist():
+			# deletes previous logs
+			open(os.path.join(self._logs_dir, f'{atom_id}.log'), 'w').close()
+			logging.info(f"Initialized log path: {os.path.join(self._logs_dir, f'{atom_id}.log')}")
+		self._updates_count: int = 0
+		self._samples = queue.SimpleQueue()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+	
+	def record(self, time_in_nanoseconds: float, positions: np.ndarray, velocities: np.ndarray) -> None:
+		self._updates_count += 1
+		if self._updates_count % MOTOR_DEBUG_SAMPLE_INTERVAL != 0:
+			return
+		self._samples.put((time_in_nanoseconds, positions[self._atom_ids], velocities[self._atom_ids]))
+	
+	def close(self) -> None:
+		# Samples already recorded are written before the thread ends
+		self._samples.put(None)
+		self._thread.join()
+	
+	def _run(self):
+		last_velocities: np.ndarray = None
+		while True:
+			sample: tuple = self._samples.get()
+			if sample is None:
+				return
+			time_in_nanoseconds, positions, velocities = sample
+			speeds: np.ndarray = np.linalg.norm(velocities, axis=1)
+			for i, atom_id in enumerate(self._atom_ids.tolist()):
+				with open(os.path.join(self._logs_dir, f'{atom_id}.log'), 'a') as f:
+					print(f"CALCULATE VELOCITY, time is {time_in_nanoseconds * 1000000}fs", file=f)
+					print(f"	particle_pos {positions[i]}nm", file=f)
+					print(f"		velocity ({speeds[i]}nm/ps) {velocities[i]}", file=f)
+					if last_velocities is None:
+						continue
+					last_speed: float = np.linalg.norm(last_velocities[i])
+					if last_speed > 0.0 and speeds[i] > 0.0 and np.dot(last_velocities[i], velocities[i]) / (last_speed * speeds[i]) < 0.1:
+						print("		MOTOR DIRECTION SUDDENLY INVERTED!", file=f)
+						print(f"		prev_motor_velocity {last_velocities[i]}({last_speed}) new_motor_velocity {velocities[i]}({speeds[i]})", file=f)
+			last_velocities = velocities
+
+class MotorManager:
+	# Advances every motor of a simulation. Python motors share one State fetch and one setVelocities() call
+	def __init__(self, motors_forces: list[MotorForce]):
+		self.motors_forces: list[MotorForce] = motors_forces
+		self._time_accum: float = 0.0
+		self._debug_recorder: MotorDebugRecorder = None
+		if len(MOTOR_PER_PARTICLE_LOG_FILES) > 0 and len(motors_forces) > 0:
+			motors_atom_ids: np.ndarray = np.concatenate([motor.atom_ids for motor in motors_forces])
+			logged_atom_ids: np.ndarray = np.intersect1d(np.array(MOTOR_PER_PARTICLE_LOG_FILES, dtype=np.int64), motors_atom_ids)
+			if len(logged_atom_ids) > 0:
+				self._debug_recorder = MotorDebugRecorder(logged_atom_ids)
+	
+	def has_motors(self) -> bool:
+		return len(self.motors_forces) > 0
+	
+	def close(self) -> None:
+		if self._debug_recorder != None:
+			self._debug_recorder.close()
+			self._debug_recorder = None
+	
+	def find_motor(self, motor_id: int) -> MotorForce:
+		for motor in self.motors_forces:
+			if motor.motor_id == motor_id:
+				return motor
+		return None
+	
+	def advance(self, simulation: Simulation, delta_time_in_nanoseconds: float) -> None:
+		self._time_accum += delta_time_in_nanoseconds
+		if simulation.motors_in_integrator:
+			for motor in self.motors_forces:
+				motor.advance_in_integrator(simulation.integrator, delta_time_in_nanoseconds)
+			return
+		speeds: list = [motor.update_speed(delta_time_in_nanoseconds) for motor in self.motors_forces]
+		if all(speed == None for speed in speeds):
+			return
+		state = simulation.context.getState(getVelocities=True, getPositions=True)
+		positions: np.ndarray = state.getPositions(asNumpy=True).value_in_unit(nanometer)
+		velocities: np.ndarray = np.array(state.getVelocities(asNumpy=True).value_in_unit(nanometer/picosecond))
+		for motor, speed in zip(self.motors_forces, speeds):
+			if speed != None:
+				motor.apply_velocities(speed, positions, velocities)
+		simulation.context.setVelocities(velocities)
+		if self._debug_recorder != None:
+			self._debug_recorder.record(self._time_accum, positions, velocities)
+
+def create_motors_integrator(time_step, motors_forces: list[MotorForce]) -> CustomIntegrator:
+	# Leapfrog Verlet like VerletIntegrator, the velocities of motor atoms are overriden before every kick
+	integrator = CustomIntegrator(time_step)
+	integrator.addPerDofVariable("x1", 0.0)
+	for motor_index, motor in enumerate(motors_forces):
+		motor.add_to_integrator(integrator, motor_index)
+	integrator.addUpdateContextState()
+	for motor in motors_forces:
+		integrator.addComputePerDof("v", motor.get_velocity_override_expression())
+	# anchors and locks are massless particles and must not move
+	integrator.addComputePerDof("v", "select(m, v+dt*f/m, 0)")
+	integrator.addComputePerDof("x1", "x")
+	integrator.addComputePerDof("x", "x+dt*v")
+	integrator.addConstrainPositions()
+	integrator.addComputePerDof("v", "select(m, (x-x1)/dt, 0)")
+	return integrator
+
+class FrameEncoding(IntEnum):
+	FLOAT64 = 0,         ## Full precision XYZ, the original frame format
+	FLOAT32 = 1,         ## Single precision XYZ
+	QUANTIZED_UINT16 = 2, ## Fixed point XYZ relative to the bounding box of the frame
+	QUANTIZED_UINT32 = 3,
+	DELTA = 4,           ## Fixed point int32 XYZ XORed against the last keyframe, keyframes are sent periodically
+
+class FrameCompression(IntEnum):
+	NONE = 0,
+	LZ4 = 1,
+	ZSTD = 2,
+
+# Header frame sent before the positions of every frame that is not FLOAT64 + NONE (or is sparse):
+# encoding u8, compression u8, flags u8, padding, atoms count u32, origin 3 x f64, step 3 x f64
+# A quantized coordinate is decoded as `origin + value * step`, origin and step are 0 for float encodings
+# Sparse frames send a uint32 frame with the ids of the atoms that moved between the header and the positions
+FRAME_HEADER = struct.Struct("<BBBxI3d3d")
+FRAME_FLAG_KEYFRAME = 0b00000001
+FRAME_FLAG_SPARSE = 0b00000010
+DEFAULT_KEYFRAME_INTERVAL = 30
+# DELTA frames share the grid of their keyframe so atoms can move outside of its bounding box
+DELTA_STEP_IN_NANOMETERS = 1e-6
+
+class FrameEncoder:
+	def __init__(self, encoding: FrameEncoding, compression: FrameCompression, keyframe_interval: int, sparse_threshold_in_nanometers: float = 0.0):
+		if compression == FrameCompression.LZ4 and lz4_frame == None:
+			logging.warning(f"lz4 is not installed, sending uncompressed frames")
+			compression = FrameCompression.NONE
+		if compression == FrameCompression.ZSTD and zstandard == None:
+			logging.warning(f"zstandard is not installed, sending uncompressed frames")
+			compression = FrameCompression.NONE
+		self.encoding: FrameEncoding = encoding
+		self.compression: FrameCompression = compression
+		self.keyframe_interval: int = keyframe_interval if keyframe_interval > 0 else DEFAULT_KEYFRAME_INTERVAL
+		self.sparse_threshold_in_nanometers: float = sparse_threshold_in_nanometers
+		self._zstd_compressor = zstandard.ZstdCompressor() if compression == FrameCompression.ZSTD else None
+		self._frames_since_keyframe: int = 0
+		self._keyframe_atoms_count: int = -1
+		self._keyframe_origin: np.ndarray = np.zeros(3)
+		self._keyframe_values: np.ndarray = None
+		# Positions the client has for every atom, only tracked in sparse mode
+		self._published_positions: np.ndarray = None
+	
+	def is_legacy(self) -> bool:
+		return self.encoding == FrameEncoding.FLOAT64 and self.compression == FrameCompression.NONE \
+				and not self.is_sparse()
+	
+	def is_sparse(self) -> bool:
+		return self.sparse_threshold_in_nanometers > 0.0
+	
+	def encode(self, positions: np.ndarray) -> list:
+		# Returns the frames to send after the time frame, positions is a (N,3) float64 array in nanometers
+		if self.is_legacy():
+			return [positions]
+		atoms_count: int = len(positions)
+		# Only DELTA and sparse frames depend on previous frames, everything else is a keyframe
+		is_keyframe: bool = (self.encoding != FrameEncoding.DELTA and not self.is_sparse()) \
+				or self._keyframe_atoms_count != atoms_count or self._frames_since_keyframe >= self.keyframe_interval
+		if is_keyframe:
+			self._frames_since_keyframe = 0
+			self._keyframe_atoms_count = atoms_count
+			self._keyframe_origin = positions.min(axis=0) if atoms_count > 0 else np.zeros(3)
+		self._frames_since_keyframe += 1
+		flags: int = FRAME_FLAG_KEYFRAME if is_keyframe else 0
+		atom_ids: np.ndarray = None
+		if self.is_sparse():
+			if is_keyframe:
+				self._published_positions = positions.copy()
+			else:
+				displacements_squared: np.ndarray = np.square(positions - self._published_positions).sum(axis=1)
+				atom_ids = np.flatnonzero(displacements_squared > self.sparse_threshold_in_nanometers ** 2).astype(ATOM_ID_DTYPE)
+				positions = positions[atom_ids]
+				self._published_positions[atom_ids] = positions
+				flags |= FRAME_FLAG_SPARSE
+		data, origin, step = self._encode_positions(positions, atom_ids, is_keyframe)
+		header: bytes = FRAME_HEADER.pack(self.encoding, self.compression, flags, atoms_count, *origin, *step)
+		if atom_ids is None:
+			return [header, self._compress(data)]
+		return [header, self._compress(atom_ids), self._compress(data)]
+	
+	def _encode_positions(self, positions: np.ndarray, atom_ids: np.ndarray, is_keyframe: bool) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+		# Returns the encoded values plus the origin and step needed to decode them
+		origin: np.ndarray = np.zeros(3)
+		step: np.ndarray = np.zeros(3)
+		if self.encoding == FrameEncoding.FLOAT64:
+			return np.ascontiguousarray(positions, dtype=POSITION_DTYPE), origin, step
+		if self.encoding == FrameEncoding.FLOAT32:
+			return positions.astype("<f4"), origin, step
+		if self.encoding in [FrameEncoding.QUANTIZED_UINT16, FrameEncoding.QUANTIZED_UINT32]:
+			max_value: int = 0xFFFF if self.encoding == FrameEncoding.QUANTIZED_UINT16 else 0xFFFFFFFF
+			dtype: str = "<u2" if self.encoding == FrameEncoding.QUANTIZED_UINT16 else "<u4"
+			if len(positions) > 0:
+				origin = positions.min(axis=0)
+				step = (positions.max(axis=0) - origin) / max_value
+			safe_step: np.ndarray = np.where(step > 0.0, step, 1.0)
+			return np.rint((positions - origin) / safe_step).astype(dtype), origin, step
+		values: np.ndarray = np.rint((positions - self._keyframe_origin) / DELTA_STEP_IN_NANOMETERS)
+		values = np.clip(values, np.iinfo(np.int32).min, np.iinfo(np.int32).max).astype("<i4")
+		origin = self._keyframe_origin
+		step = np.full(3, DELTA_STEP_IN_NANOMETERS)
+		if is_keyframe:
+			self._keyframe_values = values
+			return values, origin, step
+		# Atoms that barely moved turn into runs of zero bytes, which compress very well
+		keyframe_values: np.ndarray = self._keyframe_values if atom_ids is None else self._keyframe_values[atom_ids]
+		return np.bitwise_xor(values, keyframe_values), origin, step
+	
+	def _compress(self, data: np.ndarray):
+		data = np.ascontiguousarray(data)
+		if self.compression == FrameCompression.LZ4:
+			return lz4_frame.compress(data)
+		if self.compression == FrameCompression.ZSTD:
+			return self._zstd_compressor.compress(data)
+		return data
+
+class PublisherPolicy(IntEnum):
+	DROP_OLDEST = 0,     ## When the queue of a simulation is full its oldest frame is discarded
+	CONFLATE_LATEST = 1, ## Only the latest frame of every simulation is kept
+
+PUBLISHER_POLICY_ARGUMENTS: dict = {
+	"drop-oldest": PublisherPolicy.DROP_OLDEST,
+	"conflate-latest": PublisherPolicy.CONFLATE_LATEST,
+}
+DEFAULT_PUBLISHER_QUEUE_SIZE = 64
+# How often the publisher checks if zmq is done with frames sent straight from released buffers (ie: SharedFrameRing slots)
+PUBLISHER_TRACKER_POLL_INTERVAL_IN_SECONDS = 0.002
+
+class PublisherCounters:
+	def __init__(self):
+		self.produced: int = 0
+		self.sent: int = 0
+		self.dropped: int = 0
+	
+	def __str__(self):
+		return f"produced={self.produced}, sent={self.sent}, dropped={self.dropped}"
+
+class PublishedSimulation:
+	def __init__(self, frame_encoder: FrameEncoder):
+		self.frame_encoder: FrameEncoder = frame_encoder
+		# (time_in_nanoseconds, positions, release) tuples, positions is None when the simulation failed
+		self.frames: deque = deque()
+		self.counters = PublisherCounters()
+		self.is_closed: bool = False
+
+class SimulationPublisher:
+	# Owns the PUB socket, simulation threads only push frames into bounded per simulation queues
+	# and never wait for the socket. Frames are encoded here after the drop policy has been applied,
+	# so DELTA and sparse frames always describe what the client actually received.
+	def __init__(self, publish_socket, policy: PublisherPolicy, queue_size: int):
+		self._socket = publish_socket
+		self._policy: PublisherPolicy = policy
+		self._queue_size: int = max(1, queue_size) if policy == PublisherPolicy.DROP_OLDEST else 1
+		self._condition = threading.Condition()
+		self._simulations: dict = {
+		#	id<int> = PublishedSimulation
+		}
+		# Multipart messages (ie: errors) that are sent in order and never dropped
+		self._messages: deque = deque()
+		# (trackers, release) of sent frames zmq may still be reading, only used by the publisher thread
+		self._tracked_releases: list = []
+		self.total_counters = PublisherCounters()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+	
+	def register_simulation(self, simulation_id: int, frame_encoder: FrameEncoder) -> None:
+		with self._condition:
+			self._simulations[simulation_id] = PublishedSimulation(frame_encoder)
+	
+	def close_simulation(self, simulation_id: int) -> None:
+		# Queued frames are still sent, the simulation is forgotten once its queue is empty
+		with self._condition:
+			simulation: PublishedSimulation = self._simulations.get(simulation_id, None)
+			if simulation != None:
+				simulation.is_closed = True
+				self._condition.notify()
+	
+	def push_frame(self, simulation_id: int, time_in_nanoseconds: float, positions: np.ndarray, release = None) -> None:
+		# positions must not be modified after pushing it, None publishes an "err" frame.
+		# release is called once positions is no longer used (sent or dropped), see SharedFrameRing
+		with self._condition:
+			simulation: PublishedSimulation = self._simulations.get(simulation_id, None)
+			if simulation == None:
+				if release != None:
+					release()
+				return
+			simulation.counters.produced += 1
+			self.total_counters.produced += 1
+			if len(simulation.frames) >= self._queue_size:
+				_time, _positions, dropped_release = simulation.frames.popleft()
+				if dropped_release != None:
+					dropped_release()
+				simulation.counters.dropped += 1
+				self.total_counters.dropped += 1
+			simulation.frames.append((time_in_nanoseconds, positions, release))
+			self._condition.notify()
+	
+	def push_message(self, frames: list) -> None:
+		with self._condition:
+			self._messages.append(frames)
+			self._condition.notify()
+	
+	def _has_pending_work(self) -> bool:
+		if len(self._messages) > 0:
+			return True
+		for simulation in self._simulations.values():
+			if simulation.is_closed or len(simulation.frames) > 0:
+				return True
+		return False
+	
+	def _has_sent_tracked_frames(self) -> bool:
+		return any(all(tracker.done for tracker in trackers) for trackers, _release in self._tracked_releases)
+	
+	def _release_sent_frames(self) -> None:
+		pending: list = []
+		for trackers, release in self._tracked_releases:
+			if all(tracker.done for tracker in trackers):
+				release()
+			else:
+				pending.append((trackers, release))
+		self._tracked_releases = pending
+	
+	def _run(self):
+		while True:
+			with self._condition:
+				while not self._has_pending_work() and not self._has_sent_tracked_frames():
+					self._condition.wait(PUBLISHER_TRACKER_POLL_INTERVAL_IN_SECONDS if len(self._tracked_releases) > 0 else None)
+				messages: list = list(self._messages)
+				self._messages.clear()
+				# Take one frame of every simulation, so a big structure can't starve the others
+				pending_frames: list = []
+				for simulation_id, simulation in list(self._simulations.items()):
+					if len(simulation.frames) > 0:
+						pending_frames.append((simulation_id, simulation, simulation.frames.popleft()))
+					elif simulation.is_closed:
+						del self._simulations[simulation_id]
+						logging.info(f"Simulation {simulation_id} frames: {simulation.counters}")
+			self._release_sent_frames()
+			try:
+				for message in messages:
+					self._socket.send_multipart(message)
+				for simulation_id, simulation, frame in pending_frames:
+					self._send_frame(simulation_id, simulation, frame)
+			except Exception as inst:
+				logging.error(f"Failed to publish: {inst}")
+	
+	def _send_frame(self, simulation_id: int, simulation: PublishedSimulation, frame: tuple) -> None:
+		time_in_nanoseconds, positions, release = frame
+		trackers: list = []
+		try:
+			self._socket.send_string(str(simulation_id), zmq.SNDMORE)
+			self._socket.send(struct.pack("d", time_in_nanoseconds), zmq.SNDMORE)
+			if positions is None:
+				self._socket.send_string("err")
+			else:
+				# Encoded frames are sent without copying. Frames that are a view of positions (ie: legacy frames)
+				# are tracked when positions has to be released, it is released once zmq is done with them
+				encoded_frames: list = simulation.frame_encoder.encode(positions)
+				for i, encoded_frame in enumerate(encoded_frames):
+					is_view: bool = release != None and isinstance(encoded_frame, np.ndarray) and np.may_share_memory(encoded_frame, positions)
+					flags: int = zmq.SNDMORE if i + 1 < len(encoded_frames) else 0
+					tracker = self._socket.send(encoded_frame, flags, copy=False, track=is_view)
+					if is_view:
+						trackers.append(tracker)
+		finally:
+			if release != None:
+				if len(trackers) > 0:
+					self._tracked_releases.append((trackers, release))
+				else:
+					release()
+		simulation.counters.sent += 1
+		self.total_counters.sent += 1
+
 class ZmqPublishReporter(object):
-	def __init__(self, simulation_id, publish_scoket, publish_socket_lock, reportInterval):
+	def __init__(self, simulation_id, publisher: SimulationPublisher, reportInterval, openff_atom_ids):
 		self._simulation_id = simulation_id
-		self._publish_scoket = publish_scoket
-		self._publish_socket_lock = publish_socket_lock
+		self._publisher: SimulationPublisher = publisher
 		self._reportInterval = reportInterval
+		# openff index of every payload atom, in payload order. Anchors and locks are not published
+		self._openff_atom_ids: np.ndarray = openff_atom_ids
 		self._has_error = False
+	
+	def set_report_interval(self, report_interval: int):
+		self._reportInterval = max(1, report_interval)
 
 	def describeNextReport(self, simulation):
 		if self._has_error:
@@ -739,35 +1557,13 @@ class ZmqPublishReporter(object):
 
 	def report(self, simulation, state):
 		time_in_nanoseconds: float = (state.getTime() / femtosecond) / 1000000.0
-		time_buffer:bytes = struct.pack("d", time_in_nanoseconds)
-		openff_positions: list[Vec3] = state.getPositions()
-		positions: list[Vec3] = []
-		payload_to_openff_atom = simulation.payload_to_openff_atom
-	
-		for i in range(simulation.atoms_count):
-			positions.append(openff_positions[payload_to_openff_atom[i]])
-
-		positions_buffer: bytes = b''
-		if len(positions) != simulation.atoms_count:
+		openff_positions: np.ndarray = state.getPositions(asNumpy=True).value_in_unit(nanometer)
+		# fancy indexing creates a new array, so it can be handed to the publisher thread as is
+		positions: np.ndarray = np.ascontiguousarray(openff_positions[self._openff_atom_ids], dtype=POSITION_DTYPE)
+		if np.isnan(positions).any():
 			self._has_error = True
-		else:
-			for p, pos in enumerate(positions):
-				if p >= simulation.atoms_count:
-					# This is an anchor position. Skip
-					break
-				for i in range(3):
-					raw = pos[i] / nanometer
-					if math.isnan(raw):
-						self._has_error = True
-						break
-					positions_buffer += struct.pack("d", raw)
-		with self._publish_socket_lock:
-			self._publish_scoket.send_string(str(self._simulation_id), zmq.SNDMORE)
-			self._publish_scoket.send(time_buffer, zmq.SNDMORE)
-			if self._has_error:
-				self._publish_scoket.send_string("err")
-			else:
-				self._publish_scoket.send(positions_buffer)
+			positions = None
+		self._publisher.push_frame(self._simulation_id, time_in_nanoseconds, positions)
 
 class ImportFileRequest:
 	def __init__(self, path):
@@ -810,28 +1606,487 @@ class ImportFileResponse():
 		self.bonds = bonds
 
 
-def create_forcefield_for_topology(topology_payload: PayloadTopologyReader) -> ForceField:
-	openff_forcefield_path = os.path.join(os.path.dirname(__file__ ), "offxml", topology_payload.forcefields[0])
-	forcefield = ForceField(openff_forcefield_path)
+def get_forcefield_paths(topology_payload: PayloadTopologyReader) -> list[str]:
+	# First forcefield is the base offxml file, the rest are extensions parsed on top of it
+	paths: list[str] = [os.path.join(os.path.dirname(__file__ ), "offxml", topology_payload.forcefields[0])]
 	for i in range(1, len(topology_payload.forcefields)):
-		forcefield_extension_path = os.path.join(os.path.dirname(__file__ ), "offxml_extensions", topology_payload.forcefields[i])
+		paths.append(os.path.join(os.path.dirname(__file__ ), "offxml_extensions", topology_payload.forcefields[i]))
+	return paths
+
+def load_forcefield(forcefield_paths: list[str]) -> ForceField:
+	forcefield = ForceField(forcefield_paths[0])
+	for forcefield_extension_path in forcefield_paths[1:]:
 		with open(forcefield_extension_path, 'r', encoding='utf-8') as f:
 			forcefield.parse_sources([f])
 	return forcefield
 
+class ForceFieldRegistry:
+	# Loaded ForceFields by ordered list of files, a list is only parsed again when one of its files changes.
+	# ForceFields are shared by all requests and simulation threads, they must be treated as read only.
+	def __init__(self):
+		self._lock = threading.Lock()
+		# tuple(paths) = (tuple((mtime, size) of every path), ForceField)
+		self._forcefields: dict = {}
+	
+	def get(self, forcefield_paths: list[str]) -> ForceField:
+		file_stamps: list[tuple] = []
+		for forcefield_path in forcefield_paths:
+			stat = os.stat(forcefield_path)
+			file_stamps.append((stat.st_mtime_ns, stat.st_size))
+		key: tuple = tuple(forcefield_paths)
+		with self._lock:
+			# Loading while holding the lock, concurrent requests for the same files wait instead of parsing them again
+			entry: tuple = self._forcefields.get(key, None)
+			if entry != None and entry[0] == tuple(file_stamps):
+				return entry[1]
+			start_time: float = time.perf_counter()
+			forcefield: ForceField = load_forcefield(forcefield_paths)
+			self._forcefields[key] = (tuple(file_stamps), forcefield)
+			logging.info(f"Loaded forcefield {[os.path.basename(path) for path in forcefield_paths]} in {time.perf_counter() - start_time:.2f}s")
+			return forcefield
+
+forcefield_registry = ForceFieldRegistry()
 
-def minimize_energy(topology_payload: PayloadTopologyReader, state_payload: PayloadStateReader, temperature_in_kelvins: float, max_iterations: int = 0) -> list[Vec3]:
-	molecules: list[Molecule] = topology_payload.to_openff_molecules()
-	topology = Topology.from_molecules(molecules)
-	forcefield = create_forcefield_for_topology(topology_payload)
-	interchange = Interchange.from_smirnoff(forcefield, topology, charge_from_molecules=molecules)
-
-	openmm_system = interchange.to_openmm()
-	openmm_topology = interchange.to_openmm_topology()
-	openff_initial_positions: list[Vec3] = []
-	for i in range(len(state_payload.positions)):
-		payload_atom_id = topology_payload.openff_atom_to_payload[i]
-		openff_initial_positions.append(state_payload.positions[payload_atom_id])
+def create_forcefield_for_topology(topology_payload: PayloadTopologyReader) -> ForceField:
+	# Shared instance, do not modify
+	return forcefield_registry.get(get_forcefield_paths(topology_payload))
+
+
+SYSTEM_CACHE_DIRECTORY = os.path.join(CACHE_DIRECTORY, "systems")
+SYSTEM_CACHE_MEMORY_BUDGET_IN_BYTES = 256 * 1024 * 1024
+SYSTEM_CACHE_DISK_BUDGET_IN_BYTES = 2 * 1024 * 1024 * 1024
+
+class SystemCacheEntry:
+	def __init__(self, system_xml: str, openff_atom_to_payload: np.ndarray, partial_charge_method: str = None):
+		self.system_xml: str = system_xml
+		self.openff_atom_to_payload: np.ndarray = openff_atom_to_payload
+		# Only known for entries created by this process, entries loaded from disk have None
+		self.partial_charge_method: str = partial_charge_method
+		self.size_in_bytes: int = len(system_xml) + openff_atom_to_payload.nbytes
+
+class SystemCache:
+	# Parameterized OpenMM Systems (XmlSerializer) keyed by the content of everything that affects them.
+	# Recently used entries are kept in memory, all of them are kept on disk, both tiers are bounded by size.
+	def __init__(self, directory: str, memory_budget_in_bytes: int, disk_budget_in_bytes: int):
+		self._directory: str = directory
+		self._memory_budget_in_bytes: int = memory_budget_in_bytes
+		self._disk_budget_in_bytes: int = disk_budget_in_bytes
+		self._lock = threading.Lock()
+		self._entries: OrderedDict = OrderedDict()
+		self._memory_size_in_bytes: int = 0
+		# path = (mtime, size, sha256), forcefield files are only hashed again when they change
+		self._file_digests: dict = {}
+	
+	def get_key(self, topology_payload: PayloadTopologyReader, variant: str) -> str:
+		key = hashlib.sha256()
+		key.update(variant.encode())
+		key.update(topology_payload.chunk)
+		key.update(self.get_forcefield_key(topology_payload).encode())
+		return key.hexdigest()
+	
+	def get_forcefield_key(self, topology_payload: PayloadTopologyReader) -> str:
+		key = hashlib.sha256()
+		for forcefield_path in get_forcefield_paths(topology_payload):
+			key.update(forcefield_path.encode())
+			key.update(self._get_file_digest(forcefield_path))
+		return key.hexdigest()
+	
+	def load(self, key: str) -> SystemCacheEntry:
+		with self._lock:
+			entry: SystemCacheEntry = self._entries.get(key, None)
+			if entry != None:
+				self._entries.move_to_end(key)
+				return entry
+		xml_path: str = os.path.join(self._directory, key + ".xml")
+		try:
+			with open(xml_path, 'r', encoding='utf-8') as f:
+				system_xml: str = f.read()
+			openff_atom_to_payload: np.ndarray = np.load(os.path.join(self._directory, key + ".npy"))
+			# mtime is used as last access time for the disk eviction
+			os.utime(xml_path)
+		except OSError:
+			return None
+		entry = SystemCacheEntry(system_xml, openff_atom_to_payload)
+		self._store_in_memory(key, entry)
+		return entry
+	
+	def store(self, key: str, entry: SystemCacheEntry) -> None:
+		self._store_in_memory(key, entry)
+		try:
+			Path(self._directory).mkdir(parents=True, exist_ok=True)
+			# Write to temporary files first so an interrupted write never leaves a broken entry
+			xml_path: str = os.path.join(self._directory, key + ".xml")
+			with open(xml_path + ".tmp", 'w', encoding='utf-8') as f:
+				f.write(entry.system_xml)
+			with open(os.path.join(self._directory, key + ".npy.tmp"), 'wb') as f:
+				np.save(f, entry.openff_atom_to_payload)
+			os.replace(os.path.join(self._directory, key + ".npy.tmp"), os.path.join(self._directory, key + ".npy"))
+			os.replace(xml_path + ".tmp", xml_path)
+			self._evict_from_disk()
+		except OSError as e:
+			logging.warning(f"Failed to write system cache entry {key}: {e}")
+	
+	def _store_in_memory(self, key: str, entry: SystemCacheEntry) -> None:
+		with self._lock:
+			if key in self._entries:
+				self._memory_size_in_bytes -= self._entries.pop(key).size_in_bytes
+			self._entries[key] = entry
+			self._memory_size_in_bytes += entry.size_in_bytes
+			while self._memory_size_in_bytes > self._memory_budget_in_bytes and len(self._entries) > 1:
+				_evicted_key, evicted_entry = self._entries.popitem(last=False)
+				self._memory_size_in_bytes -= evicted_entry.size_in_bytes
+	
+	def _evict_from_disk(self) -> None:
+		entries: list = []
+		total_size: int = 0
+		for xml_path in Path(self._directory).glob("*.xml"):
+			npy_path: Path = xml_path.with_suffix(".npy")
+			stat = xml_path.stat()
+			size: int = stat.st_size + (npy_path.stat().st_size if npy_path.exists() else 0)
+			entries.append((stat.st_mtime, size, xml_path, npy_path))
+			total_size += size
+		entries.sort()
+		for _mtime, size, xml_path, npy_path in entries:
+			if total_size <= self._disk_budget_in_bytes:
+				break
+			xml_path.unlink(missing_ok=True)
+			npy_path.unlink(missing_ok=True)
+			total_size -= size
+	
+	def _get_file_digest(self, path: str) -> bytes:
+		stat = os.stat(path)
+		cached: tuple = self._file_digests.get(path, None)
+		if cached != None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+			return cached[2]
+		with open(path, 'rb') as f:
+			digest: bytes = hashlib.sha256(f.read()).digest()
+		self._file_digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+		return digest
+
+system_cache = SystemCache(SYSTEM_CACHE_DIRECTORY, SYSTEM_CACHE_MEMORY_BUDGET_IN_BYTES, SYSTEM_CACHE_DISK_BUDGET_IN_BYTES)
+
+
+# Molecules that were already parameterized by a previous request (same identity key) reuse their parameters,
+# only new or edited molecules go through Interchange, see ParameterBlockStore
+INCREMENTAL_PARAMETERIZATION = True
+# Forces that can be split in per molecule terms: (terms count getter, term getter, term adder, particles per term).
+# Terms with 0 particles are per particle terms, they are stored in particle order.
+# Forces are keyed by class name, OpenMM is not imported yet when this is declared (see ToolkitsWarmUp)
+SPLITTABLE_FORCE_TERMS: dict = {
+	"HarmonicBondForce": [("getNumBonds", "getBondParameters", "addBond", 2)],
+	"HarmonicAngleForce": [("getNumAngles", "getAngleParameters", "addAngle", 3)],
+	"PeriodicTorsionForce": [("getNumTorsions", "getTorsionParameters", "addTorsion", 4)],
+	"NonbondedForce": [("getNumParticles", "getParticleParameters", "addParticle", 0),
+			("getNumExceptions", "getExceptionParameters", "addException", 2)],
+	"CMMotionRemover": [],
+}
+# Settings that are not per molecule: (getter, setter), copied to the forces of the stitched System
+SPLITTABLE_FORCE_SETTINGS: dict = {
+	"HarmonicBondForce": [("usesPeriodicBoundaryConditions", "setUsesPeriodicBoundaryConditions")],
+	"HarmonicAngleForce": [("usesPeriodicBoundaryConditions", "setUsesPeriodicBoundaryConditions")],
+	"PeriodicTorsionForce": [("usesPeriodicBoundaryConditions", "setUsesPeriodicBoundaryConditions")],
+	"NonbondedForce": [("getNonbondedMethod", "setNonbondedMethod"), ("getCutoffDistance", "setCutoffDistance"),
+			("getUseSwitchingFunction", "setUseSwitchingFunction"), ("getSwitchingDistance", "setSwitchingDistance"),
+			("getReactionFieldDielectric", "setReactionFieldDielectric"), ("getEwaldErrorTolerance", "setEwaldErrorTolerance"),
+			("getUseDispersionCorrection", "setUseDispersionCorrection"), ("getPMEParameters", "setPMEParameters"),
+			("getExceptionsUsePeriodicBoundaryConditions", "setExceptionsUsePeriodicBoundaryConditions"),
+			("getReciprocalSpaceForceGroup", "setReciprocalSpaceForceGroup"), ("getIncludeDirectSpace", "setIncludeDirectSpace")],
+	"CMMotionRemover": [("getFrequency", "setFrequency")],
+}
+COMMON_FORCE_SETTINGS: list = [("getForceGroup", "setForceGroup"), ("getName", "setName")]
+
+class MoleculeParameterBlock:
+	def __init__(self):
+		self.masses: list[float] = []
+		# (force class, adder, particles per term) = [parameters], particle indices are local to the molecule
+		self.terms: dict = {}
+
+class SplitSystem:
+	def __init__(self, force_settings: dict, box_vectors: list, blocks: dict):
+		# force class = settings values, in the order of the forces of the split System
+		self.force_settings: dict = force_settings
+		self.box_vectors: list = box_vectors
+		# group = MoleculeParameterBlock
+		self.blocks: dict = blocks
+
+def strip_units(value):
+	return value.value_in_unit_system(md_unit_system) if is_quantity(value) else value
+
+def split_openmm_system(openmm_system: System, atom_offsets: np.ndarray, groups: list[int]) -> SplitSystem:
+	# Returns None if the System has terms that can't be assigned to a single molecule
+	if openmm_system.getNumParticles() != int(atom_offsets[-1]):
+		return None
+	labels: list[int] = np.repeat(np.arange(len(atom_offsets) - 1), np.diff(atom_offsets)).tolist()
+	offsets: list[int] = atom_offsets.tolist()
+	blocks: dict = {group: MoleculeParameterBlock() for group in groups}
+	for particle in range(openmm_system.getNumParticles()):
+		if openmm_system.isVirtualSite(particle):
+			return None
+		block: MoleculeParameterBlock = blocks.get(labels[particle], None)
+		if block != None:
+			block.masses.append(strip_units(openmm_system.getParticleMass(particle)))
+	def split_terms(key: tuple, count: int, get_parameters) -> bool:
+		particles_per_term: int = key[2]
+		for term in range(count):
+			parameters: list = list(get_parameters(term))
+			group: int = labels[term] if particles_per_term == 0 else labels[parameters[0]]
+			for i in range(particles_per_term):
+				if labels[parameters[i]] != group:
+					return False
+				parameters[i] -= offsets[group]
+			block: MoleculeParameterBlock = blocks.get(group, None)
+			if block != None:
+				block.terms.setdefault(key, []).append([strip_units(value) for value in parameters])
+		return True
+	if not split_terms((System, "addConstraint", 2), openmm_system.getNumConstraints(), openmm_system.getConstraintParameters):
+		return None
+	force_settings: dict = {}
+	for force in openmm_system.getForces():
+		force_class = type(force)
+		if not force_class.__name__ in SPLITTABLE_FORCE_TERMS or force_class in force_settings:
+			return None
+		if force_class == NonbondedForce and (force.getNumGlobalParameters() > 0 or force.getNumParticleParameterOffsets() > 0
+				or force.getNumExceptionParameterOffsets() > 0):
+			return None
+		force_settings[force_class] = [getattr(force, getter)() for getter, _setter in COMMON_FORCE_SETTINGS + SPLITTABLE_FORCE_SETTINGS[force_class.__name__]]
+		for count_getter, parameters_getter, adder, particles_per_term in SPLITTABLE_FORCE_TERMS[force_class.__name__]:
+			if not split_terms((force_class, adder, particles_per_term), getattr(force, count_getter)(), getattr(force, parameters_getter)):
+				return None
+	return SplitSystem(force_settings, list(openmm_system.getDefaultPeriodicBoxVectors()), blocks)
+
+def stitch_openmm_system(force_settings: dict, box_vectors: list, molecule_blocks: list[MoleculeParameterBlock]) -> System:
+	openmm_system = System()
+	openmm_system.setDefaultPeriodicBoxVectors(*box_vectors)
+	forces: dict = {}
+	for force_class, settings in force_settings.items():
+		force = force_class()
+		for (_getter, setter), value in zip(COMMON_FORCE_SETTINGS + SPLITTABLE_FORCE_SETTINGS[force_class.__name__], settings):
+			if isinstance(value, (list, tuple)):
+				getattr(force, setter)(*value)
+			else:
+				getattr(force, setter)(value)
+		forces[force_class] = force
+		openmm_system.addForce(force)
+	offset: int = 0
+	for block in molecule_blocks:
+		for mass in block.masses:
+			openmm_system.addParticle(mass)
+		for (force_class, adder, particles_per_term), terms in block.terms.items():
+			add_term = openmm_system.addConstraint if force_class == System else getattr(forces[force_class], adder)
+			for parameters in terms:
+				if particles_per_term > 0:
+					parameters = [particle + offset for particle in parameters[:particles_per_term]] + parameters[particles_per_term:]
+				add_term(*parameters)
+		offset += len(block.masses)
+	return openmm_system
+
+class MoleculeParameterBlocks:
+	def __init__(self, forcefield_key: str):
+		self.forcefield_key: str = forcefield_key
+		self.force_settings: dict = None
+		self.box_vectors: list = None
+		# Partial charge method of all the blocks, molecules charged with different methods are never mixed
+		self.partial_charge_method: str = None
+		# (identity key, partial charge method) = MoleculeParameterBlock
+		self.blocks: dict = {}
+		# identity keys of the molecules of the last payload, blocks of other molecules are discarded
+		self.previous_keys: set = set()
+	
+	def keep_only(self, identity_keys: list[str]) -> None:
+		self.previous_keys = set(identity_keys)
+		self.blocks = {key: block for key, block in self.blocks.items() if key[0] in self.previous_keys}
+
+def get_charge_molecules(molecules: list[Molecule], identities: MoleculeIdentities = None) -> list[Molecule]:
+	# Molecules for charge_from_molecules, openff-interchange 0.5 and newer reject isomorphic molecules in it.
+	# Copies have the charges of their representative, only representatives are compared to each other.
+	if identities != None:
+		molecules = [molecules[group] for group, representative in enumerate(identities.representatives.tolist()) if representative == group]
+	# Isomorphic molecules MoleculeIdentities could not map onto each other are separate representatives
+	return list(dict.fromkeys(molecules))
+
+class ParameterBlockStore:
+	# Per molecule parameters (masses, constraints and terms of every force) of the molecules of the last payload,
+	# by variant. Systems are stitched from these blocks, only molecules with a new identity key are parameterized.
+	def __init__(self):
+		self._lock = threading.Lock()
+		# variant = MoleculeParameterBlocks
+		self._variants: dict = {}
+	
+	def _get_blocks(self, variant: str, forcefield_key: str) -> MoleculeParameterBlocks:
+		blocks: MoleculeParameterBlocks = self._variants.get(variant, None)
+		if blocks == None or blocks.forcefield_key != forcefield_key:
+			blocks = MoleculeParameterBlocks(forcefield_key)
+			self._variants[variant] = blocks
+		return blocks
+	
+	def create_system(self, topology_payload: PayloadTopologyReader, variant: str, forcefield_key: str, **to_openmm_arguments) -> System:
+		# Returns None when the System has to be fully parameterized
+		identities: MoleculeIdentities = topology_payload.molecule_identities
+		if identities == None:
+			return None
+		partition: MoleculePartition = topology_payload.build_atom_maps()
+		identity_keys: list[str] = identities.identity_keys
+		with self._lock:
+			blocks: MoleculeParameterBlocks = self._get_blocks(variant, forcefield_key)
+			# A fallback method is used for all molecules only because one of them needed it,
+			# a full parameterization decides again which method applies once molecules are edited
+			if blocks.force_settings == None or blocks.partial_charge_method != PARTIAL_CHARGE_METHODS[0]:
+				return None
+			partial_charge_method: str = blocks.partial_charge_method
+			known_blocks: dict = blocks.blocks.copy()
+			changed_molecules_count: int = sum(1 for key in identity_keys if not key in blocks.previous_keys)
+		start_time: float = time.perf_counter()
+		missing_groups: list[int] = [group for group, representative in enumerate(identities.representatives.tolist())
+				if representative == group and not (identity_keys[group], partial_charge_method) in known_blocks]
+		if len(missing_groups) == identities.unique_molecules_count:
+			return None
+		if len(missing_groups) > 0:
+			molecules: list[Molecule] = topology_payload.to_openff_molecules(missing_groups)
+			if topology_payload.partial_charge_method != partial_charge_method:
+				logging.info(f"Edited molecules were charged with '{topology_payload.partial_charge_method}' instead of '{partial_charge_method}', " +
+						"parameterizing all molecules")
+				return None
+			forcefield = create_forcefield_for_topology(topology_payload)
+			interchange = Interchange.from_smirnoff(forcefield, Topology.from_molecules(molecules), charge_from_molecules=get_charge_molecules(molecules))
+			atom_offsets: np.ndarray = np.zeros(len(molecules) + 1, dtype=np.int64)
+			np.cumsum([molecule.n_atoms for molecule in molecules], out=atom_offsets[1:])
+			split_system: SplitSystem = split_openmm_system(interchange.to_openmm(**to_openmm_arguments), atom_offsets, list(range(len(molecules))))
+			if split_system == None or split_system.force_settings != blocks.force_settings or split_system.box_vectors != blocks.box_vectors:
+				logging.info(f"Parameters of the edited molecules don't match the previous System, parameterizing all molecules")
+				return None
+			for i, group in enumerate(missing_groups):
+				known_blocks[(identity_keys[group], partial_charge_method)] = split_system.blocks[i]
+		openmm_system: System = stitch_openmm_system(blocks.force_settings, blocks.box_vectors,
+				[known_blocks[(key, partial_charge_method)] for key in identity_keys])
+		with self._lock:
+			if blocks.partial_charge_method == partial_charge_method:
+				blocks.blocks.update(known_blocks)
+				blocks.keep_only(identity_keys)
+		logging.info(f"Incremental parameterization: {changed_molecules_count} of {partition.molecules_count} molecules changed since the last payload, " +
+				f"parameterized {len(missing_groups)} of {identities.unique_molecules_count} unique molecules in {time.perf_counter() - start_time:.2f}s")
+		return openmm_system
+	
+	def remember(self, topology_payload: PayloadTopologyReader, variant: str, forcefield_key: str, openmm_system: System,
+			partial_charge_method: str) -> None:
+		# Stores the blocks of the molecules of a fully parameterized System, charged with partial_charge_method
+		identities: MoleculeIdentities = topology_payload.molecule_identities
+		if identities == None or partial_charge_method == None:
+			return
+		partition: MoleculePartition = topology_payload.build_atom_maps()
+		identity_keys: list[str] = identities.identity_keys
+		with self._lock:
+			blocks: MoleculeParameterBlocks = self._get_blocks(variant, forcefield_key)
+			missing_groups: list[int] = [group for group, representative in enumerate(identities.representatives.tolist())
+					if representative == group and (blocks.force_settings == None or not (identity_keys[group], partial_charge_method) in blocks.blocks)]
+		if len(missing_groups) > 0:
+			split_system: SplitSystem = split_openmm_system(openmm_system, partition.atom_offsets, missing_groups)
+			if split_system == None:
+				logging.info(f"System can't be split by molecule, incremental parameterization is not available for it")
+				return
+		with self._lock:
+			if len(missing_groups) > 0:
+				if blocks.force_settings != split_system.force_settings or blocks.box_vectors != split_system.box_vectors \
+						or blocks.partial_charge_method != partial_charge_method:
+					blocks.blocks.clear()
+					blocks.force_settings = split_system.force_settings
+					blocks.box_vectors = split_system.box_vectors
+					blocks.partial_charge_method = partial_charge_method
+				for group in missing_groups:
+					blocks.blocks[(identity_keys[group], partial_charge_method)] = split_system.blocks[group]
+			blocks.keep_only(identity_keys)
+
+parameter_block_store = ParameterBlockStore()
+
+def create_openmm_system(topology_payload: PayloadTopologyReader, variant: str, use_cache: bool = True, **to_openmm_arguments) -> System:
+	# variant identifies the to_openmm_arguments, the returned System is a new copy the caller can modify
+	key: str = system_cache.get_key(topology_payload, variant) if use_cache else ""
+	forcefield_key: str = system_cache.get_forcefield_key(topology_payload) if INCREMENTAL_PARAMETERIZATION else ""
+	entry: SystemCacheEntry = system_cache.load(key) if use_cache else None
+	if entry != None and np.array_equal(entry.openff_atom_to_payload, topology_payload.build_atom_maps().atoms):
+		logging.info(f"System cache hit ({key[:12]})")
+		openmm_system: System = XmlSerializer.deserialize(entry.system_xml)
+		if INCREMENTAL_PARAMETERIZATION:
+			parameter_block_store.remember(topology_payload, variant, forcefield_key, openmm_system, entry.partial_charge_method)
+		return openmm_system
+	start_time: float = time.perf_counter()
+	openmm_system: System = None
+	# Stitched Systems only have blocks charged with the first method, see ParameterBlockStore.create_system()
+	partial_charge_method: str = PARTIAL_CHARGE_METHODS[0]
+	if INCREMENTAL_PARAMETERIZATION:
+		openmm_system = parameter_block_store.create_system(topology_payload, variant, forcefield_key, **to_openmm_arguments)
+	if openmm_system == None:
+		molecules: list[Molecule] = topology_payload.to_openff_molecules()
+		topology = Topology.from_molecules(molecules)
+		forcefield = create_forcefield_for_topology(topology_payload)
+		interchange = Interchange.from_smirnoff(forcefield, topology,
+				charge_from_molecules=get_charge_molecules(molecules, topology_payload.molecule_identities))
+		openmm_system = interchange.to_openmm(**to_openmm_arguments)
+		partial_charge_method = topology_payload.partial_charge_method
+		if INCREMENTAL_PARAMETERIZATION:
+			parameter_block_store.remember(topology_payload, variant, forcefield_key, openmm_system, partial_charge_method)
+	if use_cache:
+		logging.info(f"System cache miss ({key[:12]}), parameterized in {time.perf_counter() - start_time:.2f}s")
+		system_cache.store(key, SystemCacheEntry(XmlSerializer.serialize(openmm_system), topology_payload.openff_atom_to_payload,
+				partial_charge_method))
+	return openmm_system
+
+
+RELAX_CONTEXT_POOL_BUDGET_IN_BYTES = 512 * 1024 * 1024
+# OpenMM doesn't report the memory used by a Context, pool entries are sized with a rough estimate
+RELAX_CONTEXT_BASE_SIZE_IN_BYTES = 4 * 1024 * 1024
+RELAX_CONTEXT_SIZE_PER_PARTICLE_IN_BYTES = 2048
+
+class RelaxContext:
+	def __init__(self, simulation: Simulation):
+		self.simulation: Simulation = simulation
+		self.size_in_bytes: int = RELAX_CONTEXT_BASE_SIZE_IN_BYTES + \
+				simulation.system.getNumParticles() * RELAX_CONTEXT_SIZE_PER_PARTICLE_IN_BYTES
+
+class RelaxContextPool:
+	# Live relax Simulations (System, integrator and Context) by system identity, least recently used are
+	# evicted when the estimated size goes over the budget. Acquired entries are removed from the pool until
+	# they are released, so a Context is never used by two requests at the same time.
+	def __init__(self, memory_budget_in_bytes: int):
+		self.memory_budget_in_bytes: int = memory_budget_in_bytes
+		self._lock = threading.Lock()
+		self._entries: OrderedDict = OrderedDict()
+		self._size_in_bytes: int = 0
+	
+	def get_key(self, topology_payload: PayloadTopologyReader) -> str:
+		# Locked atoms are part of the topology chunk, anchor positions are set on every request
+		key = hashlib.sha256(system_cache.get_key(topology_payload, "relax").encode())
+		for anchor_id in sorted(topology_payload.anchors):
+			for spring in topology_payload.anchors[anchor_id].springs:
+				key.update(struct.pack("<qqdd", anchor_id, spring.particle_id, spring.k_constant, spring.equilibrium_length))
+		return key.hexdigest()
+	
+	def acquire(self, key: str) -> RelaxContext:
+		with self._lock:
+			relax_context: RelaxContext = self._entries.pop(key, None)
+			if relax_context != None:
+				self._size_in_bytes -= relax_context.size_in_bytes
+			return relax_context
+	
+	def release(self, key: str, relax_context: RelaxContext) -> None:
+		with self._lock:
+			if relax_context.size_in_bytes > self.memory_budget_in_bytes:
+				return
+			previous_context: RelaxContext = self._entries.pop(key, None)
+			if previous_context != None:
+				self._size_in_bytes -= previous_context.size_in_bytes
+			self._entries[key] = relax_context
+			self._size_in_bytes += relax_context.size_in_bytes
+			while self._size_in_bytes > self.memory_budget_in_bytes:
+				_evicted_key, evicted_context = self._entries.popitem(last=False)
+				self._size_in_bytes -= evicted_context.size_in_bytes
+
+relax_context_pool = RelaxContextPool(RELAX_CONTEXT_POOL_BUDGET_IN_BYTES)
+
+def create_relax_context(topology_payload: PayloadTopologyReader, temperature_in_kelvins: float, use_system_cache: bool = True) -> RelaxContext:
+	# Extra massless particles are added after the atoms, first one per anchor with springs (by anchor id, the order
+	# RelaxContextPool.get_key() hashes them in), then one per locked atom, see get_relax_positions()
+	openmm_system: System = create_openmm_system(topology_payload, "relax", use_system_cache)
+	openmm_topology = topology_payload.create_openmm_topology()
 	# Anchors
 	bond_force: HarmonicBondForce = None
 	nonbonded_force: NonbondedForce = None
@@ -840,15 +2095,13 @@ def minimize_energy(topology_payload: PayloadTopologyReader, state_payload: Payl
 			bond_force = force
 		if isinstance(force, NonbondedForce):
 			nonbonded_force = force
-	for anchor_id in topology_payload.anchors:
+	for anchor_id in sorted(topology_payload.anchors):
 		anchor: AnchorPoint = topology_payload.anchors[anchor_id]
 		if len(anchor.springs) == 0:
 			continue
 		anchor.openmm_particle_id = openmm_system.addParticle(0.0)
 		if nonbonded_force != None:
 			nonbonded_force.addParticle(0.0, 1.0, 0.0)
-		pos = anchor.position
-		openff_initial_positions.append(Vec3(pos[0], pos[1], pos[2]))
 		for spring in anchor.springs:
 			k_constant: float = spring.k_constant
 			equilibrium_length: float = spring.equilibrium_length
@@ -856,67 +2109,529 @@ def minimize_energy(topology_payload: PayloadTopologyReader, state_payload: Payl
 				nonbonded_force.addException(anchor.openmm_particle_id, spring.particle_id, 0.0, 1.0, 0.0)
 			# NOTE: use of openmm_system.addConstraint() was  not possible because it doesn't support massless particles
 			bond_force.addBond(anchor.openmm_particle_id, spring.particle_id, equilibrium_length, k_constant)
-	for i, atom in enumerate(topology_payload.atoms):
-		if atom.is_locked:
-			openff_atom_id = topology_payload.payload_to_openff_atom[i]
-			lock_particle_id = openmm_system.addParticle(0.0)
-			if nonbonded_force != None:
-				nonbonded_force.addParticle(0.0, 1.0, 0.0)
-			pos = state_payload.positions[i]
-			openff_initial_positions.append(pos)
-			k_constant: float = 500000.0
-			equilibrium_length: float = 0.0
-			if nonbonded_force != None:
-				nonbonded_force.addException(lock_particle_id, openff_atom_id, 0.0, 1.0, 0.0)
-			# NOTE: use of openmm_system.addConstraint() was  not possible because it doesn't support massless particles
-			bond_force.addBond(lock_particle_id, openff_atom_id, equilibrium_length, k_constant)
-		if atom.is_passivation_atom:
-			openff_atom_id = topology_payload.payload_to_openff_atom[i]
-			nonbonded_force.setParticleParameters(openff_atom_id, charge=0.0, sigma=0.0, epsilon=0.0)
+	for i in np.flatnonzero(topology_payload.atom_is_locked).tolist():
+		openff_atom_id = int(topology_payload.payload_to_openff_atom[i])
+		lock_particle_id = openmm_system.addParticle(0.0)
+		if nonbonded_force != None:
+			nonbonded_force.addParticle(0.0, 1.0, 0.0)
+		k_constant: float = 500000.0
+		equilibrium_length: float = 0.0
+		if nonbonded_force != None:
+			nonbonded_force.addException(lock_particle_id, openff_atom_id, 0.0, 1.0, 0.0)
+		# NOTE: use of openmm_system.addConstraint() was  not possible because it doesn't support massless particles
+		bond_force.addBond(lock_particle_id, openff_atom_id, equilibrium_length, k_constant)
+	for openff_atom_id in topology_payload.payload_to_openff_atom[topology_payload.atom_is_passivation].tolist():
+		nonbonded_force.setParticleParameters(openff_atom_id, charge=0.0, sigma=0.0, epsilon=0.0)
 	integrator = LangevinMiddleIntegrator(temperature_in_kelvins*kelvin, 1/picosecond, 0.004*picoseconds)
-	simulation = Simulation(openmm_topology, openmm_system, integrator)
-	simulation.context.setPositions(openff_initial_positions)
-	tolerance = Quantity(value=10.000000000000004, unit=kilojoule/mole)
-	simulation.minimizeEnergy(maxIterations = max_iterations)
+	return RelaxContext(Simulation(openmm_topology, openmm_system, integrator))
+
+def get_relax_positions(topology_payload: PayloadTopologyReader, state_payload: PayloadStateReader) -> np.ndarray:
+	# Positions of the atoms followed by the positions of the restraint particles, see create_relax_context()
+	positions: list[np.ndarray] = [state_payload.positions[topology_payload.openff_atom_to_payload]]
+	for anchor_id in sorted(topology_payload.anchors):
+		anchor: AnchorPoint = topology_payload.anchors[anchor_id]
+		if len(anchor.springs) > 0:
+			positions.append(np.array([anchor.position], dtype=np.float64))
+	positions.append(state_payload.positions[topology_payload.atom_is_locked])
+	return np.concatenate(positions)
+
+# Relax requests with a relax_id publish their progress and can be aborted, see handle_relax()
+RELAX_REPORT_INTERVAL_IN_SECONDS = 0.1
+DEFAULT_RELAX_TOLERANCE_IN_KJ_PER_MOL_PER_NM = 10.0
+DEFAULT_RELAX_MAX_ITERATIONS = 500
+# Adaptive relaxes start this many times looser than the requested tolerance, tightening it by this factor
+# only while the forces are still above the requested tolerance
+RELAX_ADAPTIVE_STAGES = 3
+RELAX_ADAPTIVE_TOLERANCE_FACTOR = 10.0
+# OpenMM older than 8.1 has no MinimizationReporter, the minimizer is called in chunks of iterations instead
+RELAX_CHUNK_ITERATIONS = 50
+RELAX_CHUNK_CONVERGED_ENERGY_CHANGE_IN_KJ_PER_MOL = 1e-3
+
+class RelaxOptions:
+	# Optional json options of a Relax request, sent after the virtual objects
+	def __init__(self, options: dict):
+		self.relax_id: int = options.get("relax_id", None)
+		self.report_interval_in_seconds: float = options.get("report_interval_in_seconds", RELAX_REPORT_INTERVAL_IN_SECONDS)
+		self.tolerance_in_kj_per_mol_per_nm: float = options.get("tolerance", DEFAULT_RELAX_TOLERANCE_IN_KJ_PER_MOL_PER_NM)
+		# 0 means no limit, for both
+		self.max_iterations: int = options.get("max_iterations", DEFAULT_RELAX_MAX_ITERATIONS)
+		self.max_seconds: float = options.get("max_seconds", 0.0)
+		self.adaptive: bool = options.get("adaptive", False)
+		# Clash removal with a cheap element based forcefield (see pre_relax()), followed by the SMIRNOFF relax unless
+		# refine is False
+		self.pre_relax: bool = options.get("pre_relax", False)
+		self.refine: bool = options.get("refine", True)
+
+class RelaxProgress:
+	# Follows the minimizer of a relax and stops it once aborted or out of time. Relaxes with a relax_id publish
+	# intermediate positions and energies on the subscription socket: "relax:<id>", the iterations (int64) and
+	# the energy in kJ/mol (float64), and the positions (float64, payload atoms order)
+	def __init__(self, options: RelaxOptions, publisher: SimulationPublisher, openff_atom_ids: np.ndarray):
+		self.relax_id: int = options.relax_id
+		self.iterations: int = 0
+		self.energy_in_kj_per_mol: float = float("nan")
+		self.rms_force_in_kj_per_mol_per_nm: float = float("nan")
+		self.max_force_in_kj_per_mol_per_nm: float = float("nan")
+		self.converged: bool = False
+		self.pre_relax_seconds: float = 0.0
+		self.refined: bool = False
+		# Set when the deadline stopped the minimizer, not when the result is built
+		self.out_of_time: bool = False
+		self._publisher: SimulationPublisher = publisher if options.relax_id != None else None
+		# openff index of every payload atom, in payload order
+		self._openff_atom_ids: np.ndarray = openff_atom_ids
+		self._report_interval_in_seconds: float = options.report_interval_in_seconds
+		self._last_report_time: float = time.perf_counter()
+		self._deadline: float = time.perf_counter() + options.max_seconds if options.max_seconds > 0.0 else float("inf")
+		self._abort_event = threading.Event()
 	
-	# Get the minimized positions
-	openff_minimized_positions: list[Vec3] = simulation.context.getState(getPositions=True).getPositions()
-	minimized_positions: list[Vec3] = []
+	def abort(self) -> None:
+		self._abort_event.set()
+	
+	def is_aborted(self) -> bool:
+		return self._abort_event.is_set()
+	
+	def is_out_of_time(self) -> bool:
+		return time.perf_counter() > self._deadline
+	
+	def should_stop(self) -> bool:
+		if self.is_aborted() or self.out_of_time:
+			return True
+		self.out_of_time = self.is_out_of_time()
+		return self.out_of_time
+	
+	def report(self, iterations: int, openff_positions, energy_in_kj_per_mol: float) -> bool:
+		# Called by the minimizer, returns True to stop it. Positions are only converted when a frame is published
+		self.iterations += iterations
+		self.energy_in_kj_per_mol = energy_in_kj_per_mol
+		now: float = time.perf_counter()
+		if self._publisher != None and now - self._last_report_time >= self._report_interval_in_seconds:
+			self._last_report_time = now
+			positions: np.ndarray = np.asarray(openff_positions, dtype=np.float64).reshape(-1, 3)[self._openff_atom_ids]
+			self._publisher.push_message([f"relax:{self.relax_id}".encode(), struct.pack("<qd", self.iterations, energy_in_kj_per_mol),
+					np.ascontiguousarray(positions, dtype=POSITION_DTYPE)])
+		return self.should_stop()
+	
+	def measure_forces(self, context: Context, tolerance_in_kj_per_mol_per_nm: float) -> None:
+		# Forces on the atoms, restraint particles are left out. Converged uses the same criterion as OpenMM:
+		# the RMS of all force components is below the tolerance
+		state: State = context.getState(getForces=True, getEnergy=True)
+		forces: np.ndarray = np.asarray(state.getForces(asNumpy=True).value_in_unit(kilojoule_per_mole/nanometer))[self._openff_atom_ids]
+		self.energy_in_kj_per_mol = state.getPotentialEnergy().value_in_unit(kilojoule_per_mole)
+		self.rms_force_in_kj_per_mol_per_nm = float(np.sqrt(np.mean(np.square(forces)))) if len(forces) > 0 else 0.0
+		self.max_force_in_kj_per_mol_per_nm = float(np.linalg.norm(forces, axis=1).max()) if len(forces) > 0 else 0.0
+		self.converged = self.rms_force_in_kj_per_mol_per_nm <= tolerance_in_kj_per_mol_per_nm
+	
+	def get_result(self) -> dict:
+		# Values that were never measured (ie: aborted before the first measure) are null, json has no NaN
+		measured = lambda value: value if not np.isnan(value) else None
+		return {
+			"iterations": self.iterations,
+			"energy_in_kj_per_mol": measured(self.energy_in_kj_per_mol),
+			"rms_force_in_kj_per_mol_per_nm": measured(self.rms_force_in_kj_per_mol_per_nm),
+			"max_force_in_kj_per_mol_per_nm": measured(self.max_force_in_kj_per_mol_per_nm),
+			"converged": self.converged,
+			"aborted": self.is_aborted(),
+			"out_of_time": self.out_of_time,
+			"pre_relax_seconds": self.pre_relax_seconds,
+			"refined": self.refined,
+		}
+
+running_relaxes: dict = {
+#	id<int> = progress<RelaxProgress>
+}
 
-	for i in range(topology_payload.atoms_count):
-		minimized_positions.append(openff_minimized_positions[topology_payload.payload_to_openff_atom[i]])
+def minimize_with_progress(context: Context, tolerance, max_iterations: int, progress: RelaxProgress) -> None:
+	if "MinimizationReporter" in globals():
+		class ProgressReporter(MinimizationReporter):
+			def report(self, iteration, x, grad, args):
+				return progress.report(1, x, args["system energy"])
+		LocalEnergyMinimizer.minimize(context, tolerance, max_iterations, ProgressReporter())
+		return
+	# Every chunk restarts the minimizer, it is done once a whole chunk barely changes the energy
+	done_iterations: int = 0
+	while not progress.should_stop():
+		chunk_iterations: int = RELAX_CHUNK_ITERATIONS if max_iterations <= 0 else min(RELAX_CHUNK_ITERATIONS, max_iterations - done_iterations)
+		if chunk_iterations <= 0:
+			return
+		done_iterations += chunk_iterations
+		previous_energy: float = progress.energy_in_kj_per_mol
+		LocalEnergyMinimizer.minimize(context, tolerance, chunk_iterations)
+		state: State = context.getState(getPositions=True, getEnergy=True)
+		energy: float = state.getPotentialEnergy().value_in_unit(kilojoule_per_mole)
+		progress.report(chunk_iterations, state.getPositions(asNumpy=True).value_in_unit(nanometer), energy)
+		if abs(previous_energy - energy) < RELAX_CHUNK_CONVERGED_ENERGY_CHANGE_IN_KJ_PER_MOL:
+			return
 
-	return minimized_positions
+def minimize_until_converged(context: Context, options: RelaxOptions, progress: RelaxProgress) -> None:
+	stages_count: int = RELAX_ADAPTIVE_STAGES if options.adaptive else 1
+	for stage in reversed(range(stages_count)):
+		remaining_iterations: int = 0
+		if options.max_iterations > 0:
+			remaining_iterations = options.max_iterations - progress.iterations
+			if remaining_iterations <= 0:
+				return
+		tolerance: float = options.tolerance_in_kj_per_mol_per_nm * RELAX_ADAPTIVE_TOLERANCE_FACTOR ** stage
+		minimize_with_progress(context, tolerance*kilojoule_per_mole/nanometer, remaining_iterations, progress)
+		progress.measure_forces(context, options.tolerance_in_kj_per_mol_per_nm)
+		if progress.converged or progress.should_stop():
+			return
+
+# Clash removal pre-pass: a soft-core forcefield built from element tables that needs neither partial charges nor
+# SMIRNOFF parameters, it pushes overlapping atoms apart before the full relax (see small_molecule_test2.py)
+KJ_PER_KCAL = 4.184
+ANGSTROMS_PER_NM = 10.0
+# Van der Waals radii (nm) by atomic number
+PRE_RELAX_VDW_RADII: dict = {
+	1:  0.110, 2:  0.140, 3:  0.181, 4:  0.153, 5:  0.192, 6:  0.170, 7:  0.155, 8:  0.152, 9:  0.147, 10: 0.154,
+	11: 0.227, 12: 0.173, 13: 0.184, 14: 0.210, 15: 0.180, 16: 0.180, 17: 0.175, 18: 0.188, 19: 0.275, 20: 0.231
+}
+# Covalent radii (nm) by atomic number and bond order, a bond length is the sum of the radii of both atoms
+PRE_RELAX_COVALENT_RADII: dict = {
+	1:  [0.032,  None,  None],
+	2:  [0.046,  None,  None],
+	3:  [0.133, 0.124,  None],
+	4:  [0.102, 0.090, 0.085],
+	5:  [0.085, 0.078, 0.073],
+	6:  [0.075, 0.067, 0.060],
+	7:  [0.071, 0.060, 0.054],
+	8:  [0.063, 0.057, 0.053],
+	9:  [0.064, 0.059, 0.053],
+	10: [0.067, 0.096,  None],
+	11: [0.155, 0.160,  None],
+	12: [0.139, 0.132, 0.127],
+	13: [0.126, 0.113, 0.111],
+	14: [0.116, 0.107, 0.102],
+	15: [0.111, 0.102, 0.094],
+	16: [0.103, 0.094, 0.095],
+	17: [0.099, 0.095, 0.093],
+	18: [0.096, 0.107, 0.096],
+	19: [0.196, 0.193,  None],
+	20: [0.171, 0.147, 0.133]
+}
+# Elements missing from the tables, and bond orders missing for an element, use these radii
+PRE_RELAX_DEFAULT_VDW_RADIUS_IN_NM = 0.2
+PRE_RELAX_DEFAULT_COVALENT_RADIUS_IN_NM = 0.12
+# kJ/mol/nm^2 by bond order
+PRE_RELAX_BOND_STIFFNESS: list[float] = [k * 2 * KJ_PER_KCAL * ANGSTROMS_PER_NM * ANGSTROMS_PER_NM for k in [310, 340, 370]]
+PRE_RELAX_ANGLE_STIFFNESS_IN_KJ_PER_MOL_PER_RAD2 = 80 * 2 * KJ_PER_KCAL
+# Atoms closer than this fraction of the sum of their vdW radii are pushed apart, unless they are a few bonds away
+PRE_RELAX_CONTACT_SCALE = 0.8
+PRE_RELAX_REPULSION_STIFFNESS_IN_KJ_PER_MOL_PER_NM2 = 50000.0
+PRE_RELAX_EXCLUDED_BONDS_DISTANCE = 3
+# Loose on purpose, the pre-pass only removes the clashes when it is followed by the SMIRNOFF refinement
+PRE_RELAX_TOLERANCE_IN_KJ_PER_MOL_PER_NM = 100.0
+PRE_RELAX_MAX_ITERATIONS = 200
+
+def create_pre_relax_tables() -> tuple[np.ndarray, np.ndarray]:
+	# Lookup arrays indexed by atomic number, and by bond order - 1 for the covalent radii
+	elements_count: int = np.iinfo(ATOM_CHUNK_DTYPE["element"]).max + 1
+	vdw_radii: np.ndarray = np.full(elements_count, PRE_RELAX_DEFAULT_VDW_RADIUS_IN_NM)
+	covalent_radii: np.ndarray = np.full((elements_count, 3), PRE_RELAX_DEFAULT_COVALENT_RADIUS_IN_NM)
+	for atomic_number, radius in PRE_RELAX_VDW_RADII.items():
+		vdw_radii[atomic_number] = radius
+	for atomic_number, radii in PRE_RELAX_COVALENT_RADII.items():
+		# Missing bond orders fall back to the single bond radius
+		covalent_radii[atomic_number] = [radius if radius != None else radii[0] for radius in radii]
+	return vdw_radii, covalent_radii
+
+pre_relax_vdw_radii, pre_relax_covalent_radii = create_pre_relax_tables()
+
+def get_pre_relax_angle(neighbors_count: int, pi_bonds_count: int) -> float:
+	# Ideal angle in radians, from the hybridization guessed with the number of neighbors and pi bonds of the center atom
+	if neighbors_count == 2 and pi_bonds_count >= 2:
+		return np.pi
+	if neighbors_count == 3 or (neighbors_count == 2 and pi_bonds_count == 1):
+		return float(np.radians(120.0))
+	return float(np.radians(109.5))
+
+def create_pre_relax_system(topology_payload: PayloadTopologyReader) -> System:
+	# Particles in openff order like create_relax_context(), followed by one massless particle per anchor with springs.
+	# Locked atoms are massless, so the minimizer leaves them in place
+	elements: np.ndarray = topology_payload.atom_elements[topology_payload.openff_atom_to_payload].astype(np.int64)
+	is_locked: np.ndarray = topology_payload.atom_is_locked[topology_payload.openff_atom_to_payload]
+	bond_atoms: np.ndarray = topology_payload.payload_to_openff_atom[topology_payload.bond_atoms]
+	bond_orders: np.ndarray = np.clip(topology_payload.bond_orders.astype(np.int64), 1, 3)
+	openmm_system = System()
+	# Only zero and non zero masses matter to the minimizer
+	for mass in np.where(is_locked, 0.0, 1.0).tolist():
+		openmm_system.addParticle(mass)
+
+	bond_force = HarmonicBondForce()
+	bond_lengths: np.ndarray = pre_relax_covalent_radii[elements[bond_atoms[:, 0]], bond_orders - 1] + \
+			pre_relax_covalent_radii[elements[bond_atoms[:, 1]], bond_orders - 1]
+	bond_stiffness: np.ndarray = np.array(PRE_RELAX_BOND_STIFFNESS)[bond_orders - 1]
+	for (atom1, atom2), length, k_constant in zip(bond_atoms.tolist(), bond_lengths.tolist(), bond_stiffness.tolist()):
+		bond_force.addBond(atom1, atom2, length, k_constant)
+	openmm_system.addForce(bond_force)
+
+	# Every pair of neighbors of an atom with 2 to 4 neighbors
+	neighbors: list[list[int]] = [[] for _ in range(len(elements))]
+	pi_bonds_counts: list[int] = [0] * len(elements)
+	for (atom1, atom2), order in zip(bond_atoms.tolist(), bond_orders.tolist()):
+		neighbors[atom1].append(atom2)
+		neighbors[atom2].append(atom1)
+		pi_bonds_counts[atom1] += order - 1
+		pi_bonds_counts[atom2] += order - 1
+	angle_force = HarmonicAngleForce()
+	for center, center_neighbors in enumerate(neighbors):
+		if len(center_neighbors) < 2 or len(center_neighbors) > 4:
+			continue
+		angle: float = get_pre_relax_angle(len(center_neighbors), pi_bonds_counts[center])
+		for i, atom1 in enumerate(center_neighbors):
+			for atom2 in center_neighbors[i+1:]:
+				angle_force.addAngle(atom1, center, atom2, angle, PRE_RELAX_ANGLE_STIFFNESS_IN_KJ_PER_MOL_PER_RAD2)
+	openmm_system.addForce(angle_force)
+
+	# Soft-core repulsion, finite when atoms overlap completely and zero once they are in contact
+	repulsion = CustomNonbondedForce("0.5*k_repulsion*step(overlap)*overlap^2; overlap=radius1+radius2-r")
+	repulsion.addGlobalParameter("k_repulsion", PRE_RELAX_REPULSION_STIFFNESS_IN_KJ_PER_MOL_PER_NM2)
+	repulsion.addPerParticleParameter("radius")
+	contact_radii: np.ndarray = pre_relax_vdw_radii[elements] * PRE_RELAX_CONTACT_SCALE
+	for radius in contact_radii.tolist():
+		repulsion.addParticle([radius])
+	cutoff_in_nm: float = 2.0 * float(contact_radii.max()) if len(contact_radii) > 0 else 1.0
+	repulsion.setNonbondedMethod(CustomNonbondedForce.CutoffNonPeriodic)
+	repulsion.setCutoffDistance(cutoff_in_nm)
+	repulsion.createExclusionsFromBonds(bond_atoms.tolist(), PRE_RELAX_EXCLUDED_BONDS_DISTANCE)
+	openmm_system.addForce(repulsion)
 
+	# Anchors
+	for anchor_id in sorted(topology_payload.anchors):
+		anchor: AnchorPoint = topology_payload.anchors[anchor_id]
+		if len(anchor.springs) == 0:
+			continue
+		anchor_particle_id: int = openmm_system.addParticle(0.0)
+		# Negative radius, never in contact with an atom
+		repulsion.addParticle([-cutoff_in_nm])
+		for spring in anchor.springs:
+			bond_force.addBond(anchor_particle_id, spring.particle_id, spring.equilibrium_length, spring.k_constant)
+	return openmm_system
+
+def create_pre_relax_context(openmm_system: System) -> Context:
+	# CPU avoids the kernels compilation of GPU platforms, which takes longer than the whole pre-pass
+	try:
+		return Context(openmm_system, VerletIntegrator(0.001), Platform.getPlatformByName("CPU"))
+	except Exception as e:
+		return Context(openmm_system, VerletIntegrator(0.001), Platform.getPlatformByName("Reference"))
+
+def pre_relax(topology_payload: PayloadTopologyReader, state_payload: PayloadStateReader, options: RelaxOptions, progress: RelaxProgress) -> np.ndarray:
+	# Returns the positions of every atom (passivation included) in payload order. Followed by the SMIRNOFF refinement
+	# it stops at a loose tolerance, otherwise it is the whole relax and follows the options
+	start_time: float = time.perf_counter()
+	context: Context = create_pre_relax_context(create_pre_relax_system(topology_payload))
+	positions: list[np.ndarray] = [state_payload.positions[topology_payload.openff_atom_to_payload]]
+	for anchor_id in sorted(topology_payload.anchors):
+		anchor: AnchorPoint = topology_payload.anchors[anchor_id]
+		if len(anchor.springs) > 0:
+			positions.append(np.array([anchor.position], dtype=np.float64))
+	context.setPositions(np.concatenate(positions))
+	if options.refine:
+		LocalEnergyMinimizer.minimize(context, PRE_RELAX_TOLERANCE_IN_KJ_PER_MOL_PER_NM*kilojoule_per_mole/nanometer, PRE_RELAX_MAX_ITERATIONS)
+	else:
+		minimize_until_converged(context, options, progress)
+	openff_positions: np.ndarray = context.getState(getPositions=True).getPositions(asNumpy=True).value_in_unit(nanometer)
+	progress.pre_relax_seconds = time.perf_counter() - start_time
+	logging.info(f"Pre-relaxed {len(topology_payload.atom_elements)} atoms in {progress.pre_relax_seconds:.3f}s")
+	return openff_positions[topology_payload.payload_to_openff_atom]
+
+def minimize_energy(topology_payload: PayloadTopologyReader, state_payload: PayloadStateReader, temperature_in_kelvins: float, max_iterations: int = 0,
+		use_system_cache: bool = True, use_context_pool: bool = True, options: RelaxOptions = None, progress: RelaxProgress = None) -> np.ndarray:
+	# Relaxes with options are followed by progress, see handle_relax()
+	key: str = relax_context_pool.get_key(topology_payload) if use_context_pool else ""
+	relax_context: RelaxContext = relax_context_pool.acquire(key) if use_context_pool else None
+	if relax_context == None:
+		start_time: float = time.perf_counter()
+		relax_context = create_relax_context(topology_payload, temperature_in_kelvins, use_system_cache)
+		logging.info(f"Created relax context in {time.perf_counter() - start_time:.2f}s")
+	else:
+		logging.info(f"Reusing relax context ({key[:12]})")
+		relax_context.simulation.integrator.setTemperature(temperature_in_kelvins*kelvin)
+	simulation: Simulation = relax_context.simulation
+	simulation.context.setPositions(get_relax_positions(topology_payload, state_payload))
+	if progress == None:
+		simulation.minimizeEnergy(tolerance = DEFAULT_RELAX_TOLERANCE_IN_KJ_PER_MOL_PER_NM*kilojoule_per_mole/nanometer, maxIterations = max_iterations)
+	else:
+		minimize_until_converged(simulation.context, options, progress)
+	
+	# Get the minimized positions
+	openff_minimized_positions: np.ndarray = simulation.context.getState(getPositions=True).getPositions(asNumpy=True).value_in_unit(nanometer)
+	# Contexts that failed are not returned to the pool
+	if use_context_pool:
+		relax_context_pool.release(key, relax_context)
+	return openff_minimized_positions[topology_payload.payload_to_openff_atom[:topology_payload.atoms_count]]
+
+
+class SimulationState(IntEnum):
+	QUEUED = 0,   ## Waiting for a free worker of the simulation scheduler
+	STARTING = 1, ## Parameterizing and creating the Context
+	RUNNING = 2,  ## Stepping
+
+class SimulationControl:
+	# Shared by the request loop and the thread of a simulation. Updates (see UpdateSimulation) are queued by the
+	# request loop and applied by the simulation thread between two chunks of steps
+	def __init__(self):
+		self.state: SimulationState = SimulationState.QUEUED
+		self._abort_event = threading.Event()
+		self._updates = queue.SimpleQueue()
+	
+	def set_state(self, state: SimulationState) -> None:
+		self.state = state
+	
+	def abort(self) -> None:
+		self._abort_event.set()
+	
+	def is_aborted(self) -> bool:
+		return self._abort_event.is_set()
+	
+	def push_update(self, update: dict) -> None:
+		self._updates.put(update)
+	
+	def pop_updates(self) -> list[dict]:
+		updates: list[dict] = []
+		while True:
+			try:
+				updates.append(self._updates.get_nowait())
+			except queue.Empty:
+				return updates
+
+class ProcessSimulationControl(SimulationControl):
+	# Control of a simulation run by a SimulationWorkerProcess. Until the job is sent to the worker it behaves
+	# like a SimulationControl, then aborts are written to the frame ring and updates are forwarded to the worker
+	def __init__(self):
+		super().__init__()
+		self._lock = threading.Lock()
+		self._simulation_id: int = -1
+		self._worker_process: SimulationWorkerProcess = None
+		self._ring: SharedFrameRing = None
+	
+	def start_on_worker(self, worker_process: SimulationWorkerProcess, simulation_id: int, ring: SharedFrameRing,
+			frames: list[zmq.Frame], cpu_threads: int) -> None:
+		# Sending the job and the queued updates while holding the lock keeps them in order
+		with self._lock:
+			if self.is_aborted():
+				ring.set_aborted()
+			worker_process.send_job(simulation_id, ring, frames, cpu_threads)
+			for update in self.pop_updates():
+				worker_process.send(("update", simulation_id, update))
+			self._simulation_id = simulation_id
+			self._worker_process = worker_process
+			self._ring = ring
+	
+	def detach(self) -> None:
+		with self._lock:
+			self._worker_process = None
+			self._ring = None
+	
+	def abort(self) -> None:
+		with self._lock:
+			super().abort()
+			if self._ring != None:
+				self._ring.set_aborted()
+	
+	def push_update(self, update: dict) -> None:
+		with self._lock:
+			if self._worker_process == None:
+				super().push_update(update)
+				return
+			try:
+				self._worker_process.send(("update", self._simulation_id, update))
+			except Exception as e:
+				logging.warning(f"Failed to forward update of simulation {self._simulation_id}: {e}")
 
 running_simulations: dict = {
-#	id<int> = stop_trigger<threading.Event>
+#	id<int> = control<SimulationControl>
 }
-def start_simulation(socket, socket_lock, simulation_id: int, parameters: PayloadSimulationParameters, topology_payload: PayloadTopologyReader, state_payload: PayloadStateReader):
+
+# --simulation-workers=0 opts out of the queue: every simulation starts as soon as it is requested, on its own thread.
+# Worker processes are always a fixed pool, one per CPU with 0
+DEFAULT_SIMULATION_WORKERS_COUNT = 2
+class SimulationScheduler:
+	# Runs simulations (from parameterization to the last step) on a fixed number of worker threads. Queued
+	# simulations are started by priority, then in request order. The CPU platform threads are split between workers.
+	# With worker processes every worker thread owns a SimulationWorkerProcess and only relays its frames
+	def __init__(self, workers_count: int, use_worker_processes: bool = False):
+		self.is_unbounded: bool = workers_count <= 0 and not use_worker_processes
+		self.workers_count: int = 0 if self.is_unbounded else workers_count if workers_count > 0 else (os.cpu_count() or 1)
+		# 0 lets the platform use every CPU thread
+		self.cpu_threads_per_simulation: int = 0 if self.is_unbounded else max(1, (os.cpu_count() or 1) // self.workers_count)
+		self.uses_worker_processes: bool = use_worker_processes
+		self._condition = threading.Condition()
+		# heap of (priority, sequence, simulation_id, run), run receives the CPU threads to use and
+		# the SimulationWorkerProcess of the worker (None when simulations run on the worker thread)
+		self._queue: list = []
+		self._sequence: int = 0
+		self._idle_workers_count: int = 0
+		for i in range(self.workers_count):
+			worker_process: SimulationWorkerProcess = SimulationWorkerProcess(i) if use_worker_processes else None
+			threading.Thread(target=self._run_worker, args=(worker_process,), name=f"simulation-{i}", daemon=True).start()
+	
+	def submit(self, simulation_id: int, priority: int, run) -> bool:
+		# Returns True when the simulation has to wait for a busy worker
+		if self.is_unbounded:
+			threading.Thread(target=self._run, args=(simulation_id, run, None), name=f"simulation-{simulation_id}", daemon=True).start()
+			return False
+		with self._condition:
+			heapq.heappush(self._queue, (priority, self._sequence, simulation_id, run))
+			self._sequence += 1
+			self._condition.notify()
+			return len(self._queue) > self._idle_workers_count
+	
+	def get_queue_position(self, simulation_id: int) -> int:
+		# 0 is the next simulation to start, -1 when the simulation is not queued
+		with self._condition:
+			queued_ids: list[int] = [entry[2] for entry in sorted(self._queue)]
+		return queued_ids.index(simulation_id) if simulation_id in queued_ids else -1
+	
+	def _run_worker(self, worker_process: SimulationWorkerProcess) -> None:
+		while True:
+			with self._condition:
+				self._idle_workers_count += 1
+				while len(self._queue) == 0:
+					self._condition.wait()
+				self._idle_workers_count -= 1
+				_priority, _sequence, simulation_id, run = heapq.heappop(self._queue)
+			self._run(simulation_id, run, worker_process)
+	
+	def _run(self, simulation_id: int, run, worker_process: SimulationWorkerProcess) -> None:
+		try:
+			run(self.cpu_threads_per_simulation, worker_process)
+		except Exception as e:
+			logging.error(f"Simulation {simulation_id} failed: {e}")
+			running_simulations.pop(simulation_id, None)
+
+def get_simulation_platforms(cpu_threads: int) -> list[tuple]:
+	# (platform, properties) in the order they are tried. None falls back to the best possible platform,
+	# CPU is requested by name when it is the best one so its threads can be set
+	platforms: list = [Platform.getPlatform(i) for i in range(Platform.getNumPlatforms())]
+	fastest_platform: Platform = max(platforms, key=lambda platform: platform.getSpeed()) if len(platforms) > 0 else None
+	candidates: list[tuple] = [(None, None)]
+	if fastest_platform != None and fastest_platform.getName() == "CPU" and cpu_threads > 0:
+		candidates = [(fastest_platform, {"Threads": str(cpu_threads)})]
+	# Reference is a CPU fallback that should always work
+	candidates.append((Platform.getPlatformByName("Reference"), None))
+	return candidates
+def start_simulation(publisher: SimulationPublisher, simulation_id: int, parameters: PayloadSimulationParameters, topology_payload: PayloadTopologyReader,
+		state_payload: PayloadStateReader, cpu_threads: int = 0):
+	publisher.register_simulation(simulation_id, FrameEncoder(parameters.frame_encoding, parameters.frame_compression,
+			parameters.keyframe_interval, parameters.sparse_threshold_in_nanometers))
 	try:
-		stop_trigger: threading.Event = running_simulations.get(simulation_id, None)
-		stop_exists: bool = stop_trigger != None
-		if stop_exists and stop_trigger.is_set():
+		control: SimulationControl = running_simulations.get(simulation_id, None)
+		control_exists: bool = control != None
+		if control_exists and control.is_aborted():
 			if running_simulations.pop(simulation_id, None) != None:
 				logging.info(f"Aborted simulation while starting, step #1")
 			return
-		molecules: list[Molecule] = topology_payload.to_openff_molecules()
-		topology = Topology.from_molecules(molecules)
-		forcefield = create_forcefield_for_topology(topology_payload)
-		interchange = Interchange.from_smirnoff(forcefield, topology, charge_from_molecules=molecules)
-		if stop_exists and stop_trigger.is_set():
+		if control_exists:
+			control.set_state(SimulationState.STARTING)
+		openmm_system: System = create_openmm_system(topology_payload, "simulate",
+				combine_nonbonded_forces=True, add_constrained_forces=False)
+		if control_exists and control.is_aborted():
 			if running_simulations.pop(simulation_id, None) != None:
 				logging.info(f"Aborted simulation while starting, step #2")
 			return
-		openmm_system: System =interchange.to_openmm(combine_nonbonded_forces=True, add_constrained_forces=False)
-		if stop_exists and stop_trigger.is_set():
-			if running_simulations.pop(simulation_id, None) != None:
-				logging.info(f"Aborted simulation while starting, step #3")
-			return
-		openff_initial_positions: list[Vec3] = []
-		for i in range(len(state_payload.positions)):
-			payload_atom_id = topology_payload.openff_atom_to_payload[i]
-			openff_initial_positions.append(state_payload.positions[payload_atom_id])
+		# Rows are appended for every extra particle (anchors and locks) and concatenated before use
+		openff_initial_positions: list[np.ndarray] = [state_payload.positions[topology_payload.openff_atom_to_payload]]
 		openmm_system.setDefaultPeriodicBoxVectors(Vec3(float("inf"), 0, 0), Vec3(0, float("inf"), 0), Vec3(0, 0, float("inf")))
 		# Anchors
 		bond_force: HarmonicBondForce = None
@@ -929,15 +2644,19 @@ def start_simulation(socket, socket_lock, simulation_id: int, parameters: Payloa
 		if bond_force == None:
 			bond_force = HarmonicBondForce()
 			openmm_system.addForce(bond_force)
+		# Massless restraint particles, their positions can be changed with UpdateSimulation
+		anchor_particle_ids: dict = {} # anchor_id = particle id
+		lock_particle_ids: dict = {} # payload atom id = particle id
 		for anchor_id in topology_payload.anchors:
 			anchor: AnchorPoint = topology_payload.anchors[anchor_id]
 			if len(anchor.springs) == 0:
 				continue
 			anchor.openmm_particle_id = openmm_system.addParticle(0.0)
+			anchor_particle_ids[anchor_id] = anchor.openmm_particle_id
 			if nonbonded_force != None:
 				nonbonded_force.addParticle(0.0, 1.0, 0.0)
 			pos = anchor.position
-			openff_initial_positions.append(Vec3(pos[0], pos[1], pos[2]))
+			openff_initial_positions.append(np.array([pos], dtype=np.float64))
 			for spring in anchor.springs:
 				k_constant: float = spring.k_constant
 				equilibrium_length: float = spring.equilibrium_length
@@ -945,26 +2664,24 @@ def start_simulation(socket, socket_lock, simulation_id: int, parameters: Payloa
 					nonbonded_force.addException(anchor.openmm_particle_id, spring.particle_id, 0.0, 1.0, 0.0)
 				# NOTE: use of openmm_system.addConstraint() was  not possible because it doesn't support massless particles
 				bond_force.addBond(anchor.openmm_particle_id, spring.particle_id, equilibrium_length, k_constant)
-		for i, atom in enumerate(topology_payload.atoms):
-			if atom.is_locked:
-				openff_atom_id = topology_payload.payload_to_openff_atom[i]
-				lock_particle_id = openmm_system.addParticle(0.0)
-				if nonbonded_force != None:
-					nonbonded_force.addParticle(0.0, 1.0, 0.0)
-				pos = state_payload.positions[i]
-				openff_initial_positions.append(pos)
-				k_constant: float = 500000.0
-				equilibrium_length: float = 0.0
-				if nonbonded_force != None:
-					nonbonded_force.addException(lock_particle_id, openff_atom_id, 0.0, 1.0, 0.0)
-				# NOTE: use of openmm_system.addConstraint() was  not possible because it doesn't support massless particles
-				bond_force.addBond(lock_particle_id, openff_atom_id, equilibrium_length, k_constant)
-			if atom.is_passivation_atom:
-				openff_atom_id = topology_payload.payload_to_openff_atom[i]
-				nonbonded_force.setParticleParameters(openff_atom_id, charge=0.0, sigma=0.0, epsilon=0.0)
-		if stop_exists and stop_trigger.is_set():
-			if running_simulations.pop(simulation.simulation_id, None) != None:
-				logging.info(f"Aborted simulation while starting, step #4")
+		for i in np.flatnonzero(topology_payload.atom_is_locked).tolist():
+			openff_atom_id = int(topology_payload.payload_to_openff_atom[i])
+			lock_particle_id = openmm_system.addParticle(0.0)
+			lock_particle_ids[i] = lock_particle_id
+			if nonbonded_force != None:
+				nonbonded_force.addParticle(0.0, 1.0, 0.0)
+			openff_initial_positions.append(state_payload.positions[i:i+1])
+			k_constant: float = 500000.0
+			equilibrium_length: float = 0.0
+			if nonbonded_force != None:
+				nonbonded_force.addException(lock_particle_id, openff_atom_id, 0.0, 1.0, 0.0)
+			# NOTE: use of openmm_system.addConstraint() was  not possible because it doesn't support massless particles
+			bond_force.addBond(lock_particle_id, openff_atom_id, equilibrium_length, k_constant)
+		for openff_atom_id in topology_payload.payload_to_openff_atom[topology_payload.atom_is_passivation].tolist():
+			nonbonded_force.setParticleParameters(openff_atom_id, charge=0.0, sigma=0.0, epsilon=0.0)
+		if control_exists and control.is_aborted():
+			if running_simulations.pop(simulation_id, None) != None:
+				logging.info(f"Aborted simulation while starting, step #3")
 			return
 		# Propagate the System with Langevin dynamics.
 		# "Typical time steps range from 0.25 fs for systems with light nuclei (such as hydrogen), to 2 fs or greater for systems with more massive nuclei"
@@ -987,26 +2704,31 @@ def start_simulation(socket, socket_lock, simulation_id: int, parameters: Payloa
 		# ```
 		# However, to take anchors and springs into accounts we hacked into the integrator Interchange
 		# class to use a modified version of `openmm_system`
-		platforms_to_test: list[Platform] = [
-			None, # None will fallback to the best possible, but CUDA failed for me to
-			Platform.getPlatformByName("Reference"), # Reference is a CPU fallback that should always work
-		]
 		simulation: Simulation = None
-		for platform_candidate in platforms_to_test:
+		motors_in_integrator: bool = IN_KERNEL_MOTORS and len(topology_payload.motors_forces) > 0
+		for platform_candidate, platform_properties in get_simulation_platforms(cpu_threads):
+			integrator: Integrator = create_motors_integrator(time_step, topology_payload.motors_forces) \
+					if motors_in_integrator else VerletIntegrator(time_step)
 			simulation = Simulation(
-				topology=topology.to_openmm(),
+				topology=topology_payload.create_openmm_topology(),
 				system=openmm_system,
-				integrator=VerletIntegrator(time_step),
-				platform=platform_candidate
+				integrator=integrator,
+				platform=platform_candidate,
+				platformProperties=platform_properties
 			)
+			for motor in topology_payload.motors_forces if motors_in_integrator else []:
+				motor.set_integrator_mask(integrator, openmm_system.getNumParticles())
+			simulation.motors_in_integrator = motors_in_integrator
 			simulation.simulation_id = simulation_id
 			simulation.atoms_count = topology_payload.atoms_count
 			simulation.anchors_count = len(topology_payload.anchors)
 			simulation.payload_to_openff_atom = topology_payload.payload_to_openff_atom
 			simulation.openff_atom_to_payload = topology_payload.openff_atom_to_payload
+			simulation.anchor_particle_ids = anchor_particle_ids
+			simulation.lock_particle_ids = lock_particle_ids
 			
 
-			simulation.context.setPositions(openff_initial_positions)
+			simulation.context.setPositions(np.concatenate(openff_initial_positions))
 			if not math.isnan(simulation.context.getState(getPositions=True).getPositions()[0][0]._value):
 				Quantity
 				logging.info(f"Platform is '{str(simulation.context.getPlatform().getName())}'")
@@ -1017,7 +2739,7 @@ def start_simulation(socket, socket_lock, simulation_id: int, parameters: Payloa
 		thermostat = AndersenThermostat(temperature, 1.0)
 		openmm_system.addForce(thermostat)
 		# Configure publish reporter
-		socket_publish_reporter = ZmqPublishReporter(simulation_id, socket, socket_lock, trj_freq)
+		socket_publish_reporter = ZmqPublishReporter(simulation_id, publisher, trj_freq, topology_payload.payload_to_openff_atom[:topology_payload.atoms_count])
 		simulation.reporters.append(socket_publish_reporter)
 		
 		logs_config_file = os.path.join(os.path.dirname(__file__), "._log_enabled")
@@ -1049,81 +2771,399 @@ def start_simulation(socket, socket_lock, simulation_id: int, parameters: Payloa
 						progress=True, remainingTime=True, speed=True, elapsedTime=False, separator=',', systemMass=None, totalSteps=num_steps)
 				simulation.reporters.append(sd_reporter)
 		
-		if stop_exists and stop_trigger.is_set():
+		if control_exists and control.is_aborted():
 			if running_simulations.pop(simulation.simulation_id, None) != None:
-				logging.info(f"Aborted simulation while starting, step #5")
+				logging.info(f"Aborted simulation while starting, step #4")
 			return
-		with concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
-			executor.submit(thread_simulate, simulation, num_steps, topology_payload.motors_forces, time_step_in_nanoseconds)
+		if control_exists:
+			control.set_state(SimulationState.RUNNING)
+		motor_manager = MotorManager(topology_payload.motors_forces)
+		try:
+			thread_simulate(simulation, num_steps, motor_manager, time_step_in_nanoseconds, parameters.motor_update_interval_in_steps)
+		finally:
+			motor_manager.close()
 	except Exception as inst:
-			with socket_lock:
-				socket.send_string("err:" + str(simulation_id), zmq.SNDMORE)
-				if not topology is None and hasattr(topology, 'openff_atom_to_payload'):
-					# Packing atom ids map topology.openff_atom_to_payload
-					# It is necesary for identification of the actual problems in the model
-					atom_id_buffer: bytes = b''
-					for openff_atom in topology.openff_atom_to_payload.keys():
-						atom_id_buffer += struct.pack("<I", openff_atom)
-						atom_id_buffer += struct.pack("<I", topology.openff_atom_to_payload[openff_atom])
-					socket.send(atom_id_buffer, zmq.SNDMORE)
-				else:
-					# Will not send IDs to remap
-					socket.send(b'', zmq.SNDMORE)
-				socket.send_string(f"[b]{str(inst)}[/b]", zmq.SNDMORE)
-				socket.send_string("\n[b]Traceback:[/b]", zmq.SNDMORE)
-
-				environment_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "msep.one")
-				trace: list = traceback.extract_tb(inst.__traceback__)
-				traceback_str = ""
-				for trace_data in trace:
-					full_path = trace_data[0]
-					short_path = full_path.replace(__file__, "openmm_server.py")
-					short_path = short_path.replace(environment_dir, "<env>")
-					line = trace_data[1]
-					module = trace_data[2]
-					trace_line = f"\n    File [url={full_path}@{line}]{short_path}:{line}[/url], in {module}\n"
-					for i in range(3, len(trace_data)):
-						code = trace_data[i]
-						trace_line += f"    {line-3+i}|   {code}\n"
-					traceback_str += trace_line
-				socket.send_string(traceback_str)
-				traceback.print_exc()
-				# raise inst
-
-
-def thread_simulate(simulation: Simulation, num_steps, motors_forces, time_step_in_nanoseconds):
-	stop_trigger: threading.Event = running_simulations.get(simulation.simulation_id, None)
-	stop_exists: bool = stop_trigger != None
-	for step in range(num_steps):
+			publisher.push_message(create_simulation_error_frames(simulation_id, topology_payload, inst))
+			traceback.print_exc()
+			# raise inst
+	finally:
+		publisher.close_simulation(simulation_id)
+
+
+def create_simulation_error_frames(simulation_id: int, topology_payload: PayloadTopologyReader, inst: Exception) -> list[bytes]:
+	# Packing atom ids map topology_payload.openff_atom_to_payload
+	# It is necesary for identification of the actual problems in the model
+	# (empty when the map was not created yet, then client will not remap IDs)
+	atom_id_map: bytes = topology_payload.pack_openff_atom_id_map() if topology_payload != None else b''
+	error_frames: list = ["err:" + str(simulation_id), atom_id_map,
+			f"[b]{str(inst)}[/b]", "\n[b]Traceback:[/b]"]
+
+	traceback_str: str = format_error_traceback(inst)
+	error_frames.append(traceback_str)
+	return [frame.encode() if isinstance(frame, str) else frame for frame in error_frames]
+
+
+def format_error_traceback(inst: Exception) -> str:
+	# BBCode traceback shown by the editor, paths are links to the source
+	environment_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "msep.one")
+	trace: list = traceback.extract_tb(inst.__traceback__)
+	traceback_str = ""
+	for trace_data in trace:
+		full_path = trace_data[0]
+		short_path = full_path.replace(__file__, "openmm_server.py")
+		short_path = short_path.replace(environment_dir, "<env>")
+		line = trace_data[1]
+		module = trace_data[2]
+		trace_line = f"\n    File [url={full_path}@{line}]{short_path}:{line}[/url], in {module}\n"
+		for i in range(3, len(trace_data)):
+			code = trace_data[i]
+			trace_line += f"    {line-3+i}|   {code}\n"
+		traceback_str += trace_line
+	return traceback_str
+
+
+# Simulations are stepped in chunks sized from the measured speed so abort requests are noticed within this time
+ABORT_POLL_BUDGET_IN_SECONDS = 0.05
+def thread_simulate(simulation: Simulation, num_steps, motor_manager: MotorManager, time_step_in_nanoseconds, motor_update_interval: int = 0):
+	control: SimulationControl = running_simulations.get(simulation.simulation_id, None)
+	control_exists: bool = control != None
+	has_motors: bool = motor_manager.has_motors()
+	if not simulation.motors_in_integrator:
+		motor_update_interval = max(1, motor_update_interval)
+	steps_per_second: float = 0.0
+	chunk_steps: int = 1
+	step: int = 0
+	while step < num_steps:
 		try:
-			if stop_exists and stop_trigger.is_set():
+			if control_exists and control.is_aborted():
 				if running_simulations.pop(simulation.simulation_id, None) != None:
 					logging.info(f"Aborted simulation on thread while running step #{step}")
 				return
-			for motor in motors_forces:
-				motor.advance(simulation, time_step_in_nanoseconds)
-			simulation.step(1)
+			for update in control.pop_updates() if control_exists else []:
+				apply_simulation_update(simulation, motor_manager, update)
+			# Grow at most x2 per chunk, the speed estimate of the first chunks includes warm up costs
+			budget_steps: int = max(1, int(steps_per_second * ABORT_POLL_BUDGET_IN_SECONDS))
+			chunk_steps = min(num_steps - step, budget_steps, chunk_steps * 2)
+			if has_motors and motor_update_interval > 0:
+				steps_to_motor_update: int = motor_update_interval - step % motor_update_interval
+				if steps_to_motor_update == motor_update_interval:
+					motor_manager.advance(simulation, time_step_in_nanoseconds * motor_update_interval)
+				chunk_steps = min(chunk_steps, steps_to_motor_update)
+			elif has_motors:
+				# in-kernel motors keep overriding velocities inside the chunk, only their speed is updated here
+				motor_manager.advance(simulation, time_step_in_nanoseconds * chunk_steps)
+			chunk_start: float = time.perf_counter()
+			# reporters are still called on their own intervals inside the chunk
+			simulation.step(chunk_steps)
+			chunk_time: float = time.perf_counter() - chunk_start
+			if chunk_time > 0.0:
+				chunk_speed: float = chunk_steps / chunk_time
+				steps_per_second = chunk_speed if steps_per_second == 0.0 else 0.5 * (steps_per_second + chunk_speed)
+			step += chunk_steps
 		except Exception as inst:
-			environment_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "msep.one")
-			trace: list = traceback.extract_tb(inst.__traceback__)
-			traceback_str = ""
-			for trace_data in trace:
-				full_path = trace_data[0]
-				short_path = full_path.replace(__file__, "openmm_server.py")
-				short_path = short_path.replace(environment_dir, "<env>")
-				line = trace_data[1]
-				module = trace_data[2]
-				trace_line = f"\n    File [url={full_path}@{line}]{short_path}:{line}[/url], in {module}\n"
-				for i in range(3, len(trace_data)):
-					code = trace_data[i]
-					trace_line += f"    {line-3+i}|   {code}\n"
-				traceback_str += trace_line
+			traceback_str: str = format_error_traceback(inst)
 			logging.error(inst)
 			logging.error(traceback_str)
 			running_simulations.pop(simulation.simulation_id, None)
 			return
 	running_simulations.pop(simulation.simulation_id, None)
 
+def apply_simulation_update(simulation: Simulation, motor_manager: MotorManager, update: dict) -> None:
+	# Only the fields present in the update are changed, see the UpdateSimulation request
+	try:
+		if "temperature_in_kelvins" in update:
+			# Simulations have no active thermostat, the temperature only sets the initial velocities
+			logging.warning(f"The temperature of simulation {simulation.simulation_id} can't be changed while it runs, restart it instead")
+		if "steps_per_report" in update:
+			for reporter in simulation.reporters:
+				if isinstance(reporter, ZmqPublishReporter):
+					reporter.set_report_interval(update["steps_per_report"])
+		for motor_force_data in update.get("motors", []):
+			motor: MotorForce = motor_manager.find_motor(motor_force_data.get("motor_id", -1))
+			if motor == None:
+				logging.warning(f"Motor {motor_force_data.get('motor_id', -1)} is not part of simulation {simulation.simulation_id}")
+				continue
+			motor.update_parameters(motor_force_data)
+		anchors: list[dict] = update.get("anchors", [])
+		locks: list[dict] = update.get("locks", [])
+		if len(anchors) + len(locks) > 0:
+			# Restraints are massless particles, the integrator never moves them
+			positions: np.ndarray = np.array(simulation.context.getState(getPositions=True).getPositions(asNumpy=True).value_in_unit(nanometer))
+			for anchor_data in anchors:
+				particle_id: int = simulation.anchor_particle_ids.get(anchor_data["anchor_id"], -1)
+				if particle_id >= 0:
+					positions[particle_id] = anchor_data["position"]
+			for lock_data in locks:
+				particle_id: int = simulation.lock_particle_ids.get(lock_data["atom_id"], -1)
+				if particle_id >= 0:
+					positions[particle_id] = lock_data["position"]
+			simulation.context.setPositions(positions)
+		logging.info(f"Updated simulation {simulation.simulation_id}: {', '.join(update.keys())}")
+	except Exception as e:
+		# A bad update is ignored, the simulation keeps running with its previous parameters
+		logging.warning(f"Failed to update simulation {simulation.simulation_id}: {e}")
+
+
+# Simulation worker processes
+# Opt-in (--simulation-processes): every simulation runs in a pre-warmed process owned by a worker of the
+# SimulationScheduler, so parameterization and the Python side of stepping don't share the GIL of the server.
+# Frames are written into a SharedFrameRing and published by the server directly from shared memory.
+FRAME_RING_HEADER = struct.Struct("<B3xII") # abort flag, slots count, atoms count
+FRAME_RING_DATA_OFFSET = 16
+FRAME_RING_BUDGET_IN_BYTES = 64 * 1024 * 1024
+FRAME_RING_MIN_SLOTS = 2
+FRAME_RING_MAX_SLOTS = 16
+# Time the publisher has to send (or drop) the last frames of a simulation before its ring is released anyway
+FRAME_RING_RELEASE_TIMEOUT_IN_SECONDS = 5.0
+
+class SharedFrameRing:
+	# Positions of the frames of one simulation, in shared memory. Slots are handed over with "frame" (worker to server)
+	# and "free" (server to worker) messages, so a slot is never written while it is being published.
+	# The abort flag is written by the server and read by the worker between two chunks of steps
+	def __init__(self, memory: shared_memory.SharedMemory, is_owner: bool):
+		self._memory: shared_memory.SharedMemory = memory
+		self._is_owner: bool = is_owner
+		self.name: str = memory.name
+		_abort_flag, self.slots_count, self.atoms_count = FRAME_RING_HEADER.unpack_from(memory.buf, 0)
+		self.slots: np.ndarray = np.ndarray((self.slots_count, self.atoms_count, 3), dtype=POSITION_DTYPE,
+				buffer=memory.buf, offset=FRAME_RING_DATA_OFFSET)
+	
+	def set_aborted(self) -> None:
+		self._memory.buf[0] = 1
+	
+	def is_aborted(self) -> bool:
+		return self._memory.buf[0] != 0
+	
+	def close(self) -> None:
+		# Views of the slots must be gone before the memory can be closed
+		self.slots = None
+		try:
+			self._memory.close()
+		except BufferError as e:
+			logging.warning(f"Frame ring {self.name} is still in use: {e}")
+		if self._is_owner:
+			self._memory.unlink()
+
+def create_shared_frame_ring(atoms_count: int) -> SharedFrameRing:
+	slot_size_in_bytes: int = max(1, atoms_count) * 3 * POSITION_DTYPE.itemsize
+	slots_count: int = min(FRAME_RING_MAX_SLOTS, max(FRAME_RING_MIN_SLOTS, FRAME_RING_BUDGET_IN_BYTES // slot_size_in_bytes))
+	memory = shared_memory.SharedMemory(create=True, size=FRAME_RING_DATA_OFFSET + slots_count * slot_size_in_bytes)
+	FRAME_RING_HEADER.pack_into(memory.buf, 0, 0, slots_count, atoms_count)
+	return SharedFrameRing(memory, True)
+
+class WorkerPipe:
+	# One end of the pipe between the server and a worker process, messages are tuples starting with their kind.
+	# Big payloads follow their message as raw bytes so they are never pickled
+	def __init__(self, connection):
+		self.connection = connection
+		self._lock = threading.Lock()
+	
+	def send(self, message: tuple) -> None:
+		with self._lock:
+			self.connection.send(message)
+	
+	def send_with_payloads(self, message: tuple, payloads: list) -> None:
+		with self._lock:
+			self.connection.send(message)
+			for payload in payloads:
+				self.connection.send_bytes(payload)
+
+class WorkerSimulationControl(SimulationControl):
+	# SimulationControl of the simulation running inside a worker process, see ProcessSimulationControl
+	def __init__(self, pipe: WorkerPipe, ring: SharedFrameRing):
+		self._pipe: WorkerPipe = pipe
+		self._ring: SharedFrameRing = ring
+		super().__init__()
+	
+	def set_state(self, state: SimulationState) -> None:
+		self.state = state
+		self._pipe.send(("state", int(state)))
+	
+	def abort(self) -> None:
+		self._ring.set_aborted()
+	
+	def is_aborted(self) -> bool:
+		return self._ring.is_aborted()
+
+class WorkerFramePublisher:
+	# Takes the place of the SimulationPublisher inside a worker process. Positions are copied into a free slot
+	# of the ring and only its index is sent, frames are dropped while the server holds every slot
+	def __init__(self, pipe: WorkerPipe, ring: SharedFrameRing):
+		self._pipe: WorkerPipe = pipe
+		self._ring: SharedFrameRing = ring
+		self.free_slots = queue.SimpleQueue()
+		for slot in range(ring.slots_count):
+			self.free_slots.put(slot)
+		self.dropped_frames: int = 0
+	
+	def register_simulation(self, simulation_id: int, frame_encoder: FrameEncoder) -> None:
+		self._pipe.send(("register", frame_encoder.encoding, frame_encoder.compression, frame_encoder.keyframe_interval,
+				frame_encoder.sparse_threshold_in_nanometers))
+	
+	def close_simulation(self, simulation_id: int) -> None:
+		self._pipe.send(("close",))
+	
+	def push_frame(self, simulation_id: int, time_in_nanoseconds: float, positions: np.ndarray) -> None:
+		if positions is None:
+			self._pipe.send(("frame", -1, time_in_nanoseconds))
+			return
+		try:
+			slot: int = self.free_slots.get_nowait()
+		except queue.Empty:
+			self.dropped_frames += 1
+			return
+		self._ring.slots[slot] = positions
+		self._pipe.send(("frame", slot, time_in_nanoseconds))
+	
+	def push_message(self, frames: list) -> None:
+		self._pipe.send(("message", frames))
+
+class WorkerSimulationJob:
+	def __init__(self, pipe: WorkerPipe, simulation_id: int, cpu_threads: int, ring_name: str, frames: list[bytes]):
+		self.simulation_id: int = simulation_id
+		self.cpu_threads: int = cpu_threads
+		self.frames: list[bytes] = frames
+		self.ring: SharedFrameRing = SharedFrameRing(shared_memory.SharedMemory(name=ring_name), False)
+		self.publisher = WorkerFramePublisher(pipe, self.ring)
+		self.control = WorkerSimulationControl(pipe, self.ring)
+
+def run_simulation_job(job: WorkerSimulationJob) -> None:
+	# Same frames the server received, the payload is decoded here
+	request = RequestFrames([zmq.Frame(b'')] + [zmq.Frame(frame) for frame in job.frames])
+	reply = ReplyFrames()
+	try:
+		toolkits_warm_up.wait_until_ready()
+		simulation_id, parameters, topology, state = read_simulation_request(request, reply)
+	except Exception as inst:
+		job.publisher.push_message(create_simulation_error_frames(job.simulation_id, reply.topology_payload, inst))
+		traceback.print_exc()
+		return
+	start_simulation(job.publisher, simulation_id, parameters, topology, state, job.cpu_threads)
+
+def run_simulation_worker_process(connection) -> None:
+	# Entry point of the worker processes. Messages are received on a thread so "free" and "update" messages
+	# reach the running simulation while the main thread is stepping it
+	pipe = WorkerPipe(connection)
+	jobs = queue.SimpleQueue()
+	current_jobs: dict = {
+	#	simulation_id<int> = WorkerSimulationJob
+	}
+	def receive_messages():
+		try:
+			while True:
+				message: tuple = connection.recv()
+				if message[0] == "simulate":
+					_kind, simulation_id, cpu_threads, ring_name, frames_count = message
+					frames: list[bytes] = [connection.recv_bytes() for i in range(frames_count)]
+					job = WorkerSimulationJob(pipe, simulation_id, cpu_threads, ring_name, frames)
+					current_jobs[simulation_id] = job
+					jobs.put(job)
+				elif message[0] == "free":
+					job: WorkerSimulationJob = current_jobs.get(message[1], None)
+					if job != None:
+						job.publisher.free_slots.put(message[2])
+				elif message[0] == "update":
+					job: WorkerSimulationJob = current_jobs.get(message[1], None)
+					if job != None:
+						job.control.push_update(message[2])
+		except (EOFError, OSError):
+			# The server is gone
+			os._exit(0)
+	threading.Thread(target=receive_messages, daemon=True).start()
+	toolkits_warm_up.run()
+	logging.info(f"Simulation worker process {os.getpid()} is ready")
+	while True:
+		job: WorkerSimulationJob = jobs.get()
+		running_simulations[job.simulation_id] = job.control
+		try:
+			run_simulation_job(job)
+		except Exception as e:
+			logging.error(f"Simulation {job.simulation_id} failed: {e}")
+		finally:
+			running_simulations.pop(job.simulation_id, None)
+			current_jobs.pop(job.simulation_id, None)
+			if job.publisher.dropped_frames > 0:
+				logging.info(f"Simulation {job.simulation_id} dropped {job.publisher.dropped_frames} frames, every ring slot was in use")
+			job.publisher = None
+			job.ring.close()
+			pipe.send(("done",))
+
+class SimulationWorkerProcess:
+	# Server side of a worker process. run_simulation() is called by the worker thread of the SimulationScheduler
+	# that owns this process, and relays the messages of the simulation to the publisher until it is done
+	def __init__(self, index: int):
+		self.index: int = index
+		self._start_process()
+	
+	def _start_process(self) -> None:
+		# spawn works the same way on every platform and doesn't copy the sockets of the server
+		context = multiprocessing.get_context("spawn")
+		connection, worker_connection = context.Pipe(duplex=True)
+		self._pipe = WorkerPipe(connection)
+		self._process = context.Process(target=run_simulation_worker_process, args=(worker_connection,),
+				name=f"simulation-worker-{self.index}", daemon=True)
+		self._process.start()
+		worker_connection.close()
+		logging.info(f"Started simulation worker process {self.index} (pid {self._process.pid})")
+	
+	def send(self, message: tuple) -> None:
+		self._pipe.send(message)
+	
+	def send_job(self, simulation_id: int, ring: SharedFrameRing, frames: list[zmq.Frame], cpu_threads: int) -> None:
+		self._pipe.send_with_payloads(("simulate", simulation_id, cpu_threads, ring.name, len(frames)),
+				[frame.buffer for frame in frames])
+	
+	def run_simulation(self, publisher: SimulationPublisher, simulation_id: int, control: ProcessSimulationControl,
+			frames: list[zmq.Frame], atoms_count: int, cpu_threads: int) -> None:
+		ring: SharedFrameRing = create_shared_frame_ring(atoms_count)
+		# Slots held by the publisher, they are given back to the worker once sent or dropped
+		published_slots: set = set()
+		slots_condition = threading.Condition()
+		def release_slot(slot: int):
+			with slots_condition:
+				published_slots.discard(slot)
+				slots_condition.notify_all()
+			try:
+				self._pipe.send(("free", simulation_id, slot))
+			except Exception:
+				pass
+		try:
+			control.start_on_worker(self, simulation_id, ring, frames, cpu_threads)
+			while True:
+				message: tuple = self._pipe.connection.recv()
+				if message[0] == "frame":
+					_kind, slot, time_in_nanoseconds = message
+					if slot < 0:
+						publisher.push_frame(simulation_id, time_in_nanoseconds, None)
+						continue
+					with slots_condition:
+						published_slots.add(slot)
+					publisher.push_frame(simulation_id, time_in_nanoseconds, ring.slots[slot], lambda slot=slot: release_slot(slot))
+				elif message[0] == "state":
+					control.set_state(SimulationState(message[1]))
+				elif message[0] == "register":
+					publisher.register_simulation(simulation_id, FrameEncoder(*message[1:]))
+				elif message[0] == "message":
+					publisher.push_message(message[1])
+				elif message[0] == "close":
+					publisher.close_simulation(simulation_id)
+				elif message[0] == "done":
+					break
+		except (EOFError, OSError) as inst:
+			logging.error(f"Simulation worker process {self.index} exited while running simulation {simulation_id}: {inst}")
+			publisher.push_message(create_simulation_error_frames(simulation_id, None, inst))
+			publisher.close_simulation(simulation_id)
+			if self._process.is_alive():
+				self._process.terminate()
+			self._start_process()
+		finally:
+			control.detach()
+			running_simulations.pop(simulation_id, None)
+			with slots_condition:
+				slots_condition.wait_for(lambda: len(published_slots) == 0, FRAME_RING_RELEASE_TIMEOUT_IN_SECONDS)
+			ring.close()
+
+
 def import_file(payload: ImportFileRequest) -> ImportFileResponse:
 	molecules: list[Molecule] = []
 	if payload.extension == "pdb":
@@ -1173,27 +3213,31 @@ def import_file(payload: ImportFileRequest) -> ImportFileResponse:
 	return ImportFileResponse(openmm_topology, positions, bonds)
 
 
-def prewarm_openmm_ff():
-	topology = PayloadTopologyReader([], 0, 0, 0, "openff-2.1.0.offxml")
-	topology.atoms_count = 3
-	topology.bonds_count = 2
-	topology.atoms = [
-		AtomData(element=8, hybridization=0),
-		AtomData(element=1, hybridization=0),
-		AtomData(element=1, hybridization=0)
-	]
-	topology.bonds = [
-		(0, 1, 1),
-		(0, 2, 1)
-	]
-	state = PayloadStateReader([], 0, 0)
-	state.atoms_count = 3
-	state.positions = [
-		Vec3(0.0, 0.0, 0.0),
-		Vec3(1.0, 1.0, 0.0),
-		Vec3(-1.0, 0.0, 0.0)
-	]
-	new_state: list = minimize_energy(topology, state, 300)
+def prewarm_openmm_ff(create_context: bool = True):
+	# A water molecule, packed the same way OpenMMPayload does
+	topology_bytes: bytes = struct.pack("<III", 0, 3, 0)
+	topology_bytes += bytes([
+		8, 0, 0, 0,
+		1, 0, 0, 0,
+		1, 0, 0, 0
+	])
+	topology_bytes += struct.pack("<IIB", 0, 1, 1)
+	topology_bytes += struct.pack("<IIB", 0, 2, 1)
+	# Same forcefield list the editor sends by default, so its ForceField is already loaded for the first request
+	topology = PayloadTopologyReader(topology_bytes, 1, 3, 2, "openff-2.1.0.offxml;msep.one_extension-0.0.1.offxml")
+	state_bytes: bytes = np.array([
+		[0.0, 0.0, 0.0],
+		[1.0, 1.0, 0.0],
+		[-1.0, 0.0, 0.0]
+	], dtype=POSITION_DTYPE).tobytes()
+	state = PayloadStateReader(state_bytes, 3, 0)
+	# Skip the system cache, the point is warming up the openff parameterization
+	if not create_context:
+		create_openmm_system(topology, "relax", use_cache=False)
+		if DETAILED_LOGS:
+			logging.info(f"prewarmed openff parameterizing a water molecule")
+		return
+	new_state: list = minimize_energy(topology, state, 300, use_system_cache=False, use_context_pool=False)
 	if DETAILED_LOGS:
 		logging.info(f"prewarmed openmm/ff relaxating a water molecule.\n\tpositions={str(new_state)}")
 
@@ -1257,199 +3301,537 @@ done
 						stderr=subprocess.DEVNULL)
 # End Kill openmm if msep has died.
 
+# Requests
+# The request socket is a ROUTER, clients keep using REQ sockets with the same multipart messages.
+# Cheap requests are answered by the event loop, the rest run on REQUEST_WORKERS_COUNT threads
+# and are answered when they finish, in any order.
+REQUEST_WORKERS_COUNT = 4
+
+class ServerContext:
+	# Server-wide objects used by the request handlers
+	def __init__(self, publisher: SimulationPublisher, simulation_scheduler: SimulationScheduler):
+		self.publisher: SimulationPublisher = publisher
+		self.simulation_scheduler: SimulationScheduler = simulation_scheduler
+
+class RequestFrames:
+	# Frames of one request, read in order the same way they were read from the REP socket
+	def __init__(self, frames: list[zmq.Frame]):
+		delimiter: int = next((i for i, frame in enumerate(frames) if len(frame.bytes) == 0), 0)
+		# Routing id(s) and empty delimiter, sent back in front of the reply
+		self.envelope: list[zmq.Frame] = frames[:delimiter + 1]
+		self._frames: list[zmq.Frame] = frames[delimiter + 1:]
+		self._next_frame: int = 0
+		self.request_type: bytes = self.recv()
+	
+	def get_frames(self) -> list[zmq.Frame]:
+		# Every frame after the envelope, request type included
+		return self._frames
+	
+	def recv(self, copy: bool = True):
+		if self._next_frame >= len(self._frames):
+			raise Exception(f"Request {self.request_type} has less frames than expected")
+		frame: zmq.Frame = self._frames[self._next_frame]
+		self._next_frame += 1
+		return frame.bytes if copy else frame
+	
+	def recv_string(self) -> str:
+		return self.recv().decode("utf-8")
+	
+	def has_more(self) -> bool:
+		return self._next_frame < len(self._frames)
+
+class ReplyFrames:
+	def __init__(self):
+		self.frames: list = []
+		# Set by handlers once decoded, errors include its atom ids map
+		self.topology_payload: PayloadTopologyReader = None
+		self.close_server: bool = False
+	
+	def send(self, data) -> None:
+		self.frames.append(data)
+	
+	def send_string(self, text: str) -> None:
+		self.frames.append(text.encode("utf-8"))
+
+def read_payload(request: RequestFrames, reply: ReplyFrames, forcefield_list: str) -> tuple[PayloadTopologyReader, PayloadStateReader]:
+	# Header, topology, state and virtual objects frames, shared by Relax and Simulate
+	header_bytes: bytes = request.recv()
+	header = PayloadHeaderReader(header_bytes)
+	logging.info(f"Header: atoms_count={str(header.atoms_count)}, bonds_count={header.bonds_count}")
+	topology_bytes: zmq.Frame = request.recv(copy=False)
+	topology = PayloadTopologyReader(topology_bytes, header.molecules_count, header.atoms_count, header.bonds_count, forcefield_list)
+	reply.topology_payload = topology
+	if DETAILED_LOGS:
+		atoms_str = "[" + ", ".join(periodic_table_symbols[element] for element in topology.atom_elements.tolist()) + "]"
+		logging.info(f"Topology: atoms={atoms_str} bonds={topology.bond_atoms.tolist()}")
+	# atom maps are needed by virtual objects, molecules are only created on a system cache miss
+	topology.build_atom_maps()
+	state_bytes: zmq.Frame = request.recv(copy=False)
+	state = PayloadStateReader(state_bytes, header.atoms_count, header.passivated_atoms_count)
+	if DETAILED_LOGS:
+		logging.info(f"state: positions={str(state.positions)}")
+	# Collect motors parameters
+	for m in range(header.virtual_objects_count):
+		json_object: dict = json.loads(request.recv_string())
+		topology.add_virtual_object(json_object, state)
+	return topology, state
+
+def handle_relax(request: RequestFrames, reply: ReplyFrames, server: ServerContext):
+	logging.info(f"Server received a Relax request")
+	temperature_bytes = request.recv()
+	temperature_in_kelvins: float = struct.unpack('d', temperature_bytes)[0]
+	forcefield_list: str = request.recv_string()
+	topology, state = read_payload(request, reply, forcefield_list)
+	# Optional json options after the virtual objects (see RelaxOptions): relax_id publishes the progress of the relax
+	# and allows aborting it with AbortRelax, tolerance (kJ/mol/nm), max_iterations, max_seconds, adaptive, pre_relax
+	# and refine. Relaxes with options reply a second frame, a json object with the result (see RelaxProgress.get_result())
+	if not request.has_more():
+		minimized_positions = minimize_energy(topology, state, temperature_in_kelvins, max_iterations=DEFAULT_RELAX_MAX_ITERATIONS)
+		reply.send(np.ascontiguousarray(minimized_positions, dtype=POSITION_DTYPE))
+		return
+	options = RelaxOptions(json.loads(request.recv_string()))
+	progress = RelaxProgress(options, server.publisher, topology.payload_to_openff_atom[:topology.atoms_count])
+	if options.relax_id != None:
+		running_relaxes[options.relax_id] = progress
+	try:
+		if options.pre_relax:
+			state.positions = pre_relax(topology, state, options, progress)
+		if options.refine and not progress.should_stop():
+			minimized_positions = minimize_energy(topology, state, temperature_in_kelvins, options=options, progress=progress)
+			progress.refined = True
+		else:
+			minimized_positions = state.positions[:topology.atoms_count]
+	finally:
+		if options.relax_id != None:
+			running_relaxes.pop(options.relax_id, None)
+	result: dict = progress.get_result()
+	logging.info(f"Relax result: {result}")
+	reply.send(np.ascontiguousarray(minimized_positions, dtype=POSITION_DTYPE))
+	reply.send_string(json.dumps(result))
+
+def handle_abort_relax(request: RequestFrames, reply: ReplyFrames, server: ServerContext):
+	# The relax stops after its current iteration and replies the positions it reached
+	id_bytes: bytes = request.recv()
+	relax_id: int = struct.unpack('<q', id_bytes)[0]
+	progress: RelaxProgress = running_relaxes.get(relax_id, None)
+	if progress != None and not progress.is_aborted():
+		logging.info(f"Server received an Abort Relax request")
+		progress.abort()
+		reply.send(b'ack')
+	else:
+		reply.send(b'not running')
+
+def read_simulation_parameters(request: RequestFrames) -> tuple[int, PayloadSimulationParameters]:
+	id_bytes: bytes = request.recv()
+	simulation_id: int = struct.unpack('<q', id_bytes)[0]
+	parameters_bytes: bytes = request.recv()
+	return simulation_id, PayloadSimulationParameters(parameters_bytes)
+
+def read_simulation_request(request: RequestFrames, reply: ReplyFrames) -> tuple[int, PayloadSimulationParameters, PayloadTopologyReader, PayloadStateReader]:
+	simulation_id, parameters = read_simulation_parameters(request)
+	forcefield_list: str = request.recv_string()
+	topology, state = read_payload(request, reply, forcefield_list)
+	return simulation_id, parameters, topology, state
+
+def handle_simulate(request: RequestFrames, reply: ReplyFrames, server: ServerContext):
+	logging.info(f"Server received a Simulation Start request")
+	if server.simulation_scheduler.uses_worker_processes:
+		# Only the header is read here, the worker process decodes and parameterizes the payload
+		frames: list[zmq.Frame] = request.get_frames()
+		simulation_id, parameters = read_simulation_parameters(request)
+		_forcefield_list: str = request.recv_string()
+		header = PayloadHeaderReader(request.recv())
+		control = ProcessSimulationControl()
+		running_simulations[simulation_id] = control
+		is_queued: bool = server.simulation_scheduler.submit(simulation_id, parameters.priority,
+				lambda cpu_threads, worker_process: worker_process.run_simulation(server.publisher, simulation_id, control,
+						frames, header.atoms_count, cpu_threads))
+		reply.send(b'Queued' if is_queued else b'Running')
+		return
+	simulation_id, parameters, topology, state = read_simulation_request(request, reply)
+	running_simulations[simulation_id] = SimulationControl()
+	# Queued simulations start once a worker is free, see SimulationStatus for their position in the queue
+	is_queued: bool = server.simulation_scheduler.submit(simulation_id, parameters.priority,
+			lambda cpu_threads, worker_process: start_simulation(server.publisher, simulation_id, parameters, topology, state, cpu_threads))
+	reply.send(b'Queued' if is_queued else b'Running')
+
+def handle_abort_simulation(request: RequestFrames, reply: ReplyFrames, server: ServerContext):
+	id_bytes: bytes = request.recv()
+	simulation_id: int = struct.unpack('<q', id_bytes)[0]
+	control: SimulationControl = running_simulations.get(simulation_id, None)
+	if control != None and not control.is_aborted():
+		logging.info(f"Server received an Abort Simulation request")
+		control.abort()
+	reply.send(b'ack')
+
+def handle_update_simulation(request: RequestFrames, reply: ReplyFrames, server: ServerContext):
+	# id, then a json object with any of: steps_per_report,
+	# motors (same objects as the virtual objects of Simulate, with motor_id),
+	# anchors ([{anchor_id, position}]) and locks ([{atom_id, position}]), positions in nanometers
+	id_bytes: bytes = request.recv()
+	simulation_id: int = struct.unpack('<q', id_bytes)[0]
+	update: dict = json.loads(request.recv_string())
+	control: SimulationControl = running_simulations.get(simulation_id, None)
+	if control != None and not control.is_aborted():
+		control.push_update(update)
+		reply.send(b'ack')
+	else:
+		reply.send(b'not running')
+
+def handle_simulation_status(request: RequestFrames, reply: ReplyFrames, server: ServerContext):
+	# Replies the state name (queued, starting, running or "not running") and the position in the queue (int32, -1 when not queued)
+	id_bytes: bytes = request.recv()
+	simulation_id: int = struct.unpack('<q', id_bytes)[0]
+	control: SimulationControl = running_simulations.get(simulation_id, None)
+	if control == None or control.is_aborted():
+		reply.send_string("not running")
+		reply.send(struct.pack("<i", -1))
+		return
+	reply.send_string(control.state.name.lower())
+	reply.send(struct.pack("<i", server.simulation_scheduler.get_queue_position(simulation_id)))
+
+def handle_import_file(request: RequestFrames, reply: ReplyFrames, server: ServerContext):
+	path = request.recv_string()
+	payload = ImportFileRequest(path)
+	while request.has_more():
+		option = request.recv_string()
+		payload.process_option(option)
+	response: ImportFileResponse = import_file(payload)
+	# First frame are atomic_numbers as uint8
+	atomic_numbers_buffer: bytes = b''
+	for atom in response.openmm_topology.atoms():
+		atomic_numbers_buffer += struct.pack("B", atom.element.atomic_number)
+	# Second frame are atoms positions as 3 consecutive doubles
+	positions_buffer: bytes = b''
+	logging.info(f"PoSiTiOnS: {response.positions}")
+	for pos in response.positions:
+		for i in range(3):
+			positions_buffer += struct.pack("d", pos[i])
+	# Third frame are bonds represented as 2 atom_ids(uint32) + byte order (uint8)
+	bonds_buffer: bytes = b''
+	logging.info(f"BONDS: {str(response.bonds)}")
+	for bond in response.bonds:
+		bonds_buffer += struct.pack("<I", bond.atom1.molecule_atom_index)
+		bonds_buffer += struct.pack("<I", bond.atom2.molecule_atom_index)
+		bonds_buffer += struct.pack("B", bond.bond_order)
+	reply.send(atomic_numbers_buffer)
+	reply.send(positions_buffer)
+	reply.send(bonds_buffer)
+
+def handle_export_file(request: RequestFrames, reply: ReplyFrames, server: ServerContext):
+	path = request.recv_string()
+	logging.info(f"Exporting file: {path}")
+	forcefield_list: str = request.recv_string()
+	header_bytes: bytes = request.recv()
+	header = PayloadHeaderReader(header_bytes)
+	topology_bytes: zmq.Frame = request.recv(copy=False)
+	topology_payload = PayloadTopologyReader(topology_bytes, header.molecules_count, header.atoms_count, header.bonds_count, forcefield_list)
+	reply.topology_payload = topology_payload
+	molecules: list[Molecule] = topology_payload.to_openff_molecules()
+	topology = Topology.from_molecules(molecules)
+	state_bytes: zmq.Frame = request.recv(copy=False)
+	state = PayloadStateReader(state_bytes, header.atoms_count, header.passivated_atoms_count)
+	openff_positions: np.ndarray = (state.positions[topology_payload.openff_atom_to_payload] * nanometer).value_in_unit(angstrom)
+	output_file = open(path, 'w')
+	PDBFile.writeFile(topology.to_openmm(), openff_positions, output_file)
+	output_file.close()
+	reply.send_string("SUCCESS")
+
+def handle_status(request: RequestFrames, reply: ReplyFrames, server: ServerContext):
+	# Replies the warm up state (warming_up, ready or failed) and a json object with the current step,
+	# the error when it failed and the startup timeline ([step, seconds since the server started])
+	reply.send_string(toolkits_warm_up.state.name.lower())
+	reply.send_string(json.dumps({
+		"step": toolkits_warm_up.step,
+		"error": toolkits_warm_up.error,
+		"timeline": startup_timeline.get_steps(),
+	}))
+
+def handle_get_process_id(request: RequestFrames, reply: ReplyFrames, server: ServerContext):
+	pid: int = os.getpid()
+	pid_buffer: bytes = b''
+	pid_buffer += struct.pack("<Q", pid)
+	reply.send(pid_buffer)
+
+def handle_quit(request: RequestFrames, reply: ReplyFrames, server: ServerContext):
+	for simulation_id in list(running_simulations.keys()):
+		control: SimulationControl = running_simulations.get(simulation_id, None)
+		if control != None and not control.is_aborted():
+			control.abort()
+	for progress in list(running_relaxes.values()):
+		progress.abort()
+	reply.send_string("ack")
+	reply.close_server = True
+
+def handle_unknown_request(request: RequestFrames, reply: ReplyFrames, server: ServerContext):
+	raise Exception(f"Unknown request instruction: {request.request_type}")
+
+# request type = (handler, runs on a worker thread), requests that run on a worker thread wait for the ToolkitsWarmUp
+REQUEST_HANDLERS: dict = {
+	b"Relax": (handle_relax, True),
+	b"AbortRelax": (handle_abort_relax, False),
+	b"Simulate": (handle_simulate, True),
+	b"AbortSimulation": (handle_abort_simulation, False),
+	b"UpdateSimulation": (handle_update_simulation, False),
+	b"SimulationStatus": (handle_simulation_status, False),
+	b"Import File": (handle_import_file, True),
+	b"Export File": (handle_export_file, True),
+	b"GetProcessID": (handle_get_process_id, False),
+	b"Status": (handle_status, False),
+	b"Quit": (handle_quit, False),
+}
+
+def process_request(request: RequestFrames, server: ServerContext) -> ReplyFrames:
+	handler, runs_on_worker = REQUEST_HANDLERS.get(request.request_type, (handle_unknown_request, False))
+	reply = ReplyFrames()
+	try:
+		if runs_on_worker:
+			toolkits_warm_up.wait_until_ready()
+		handler(request, reply, server)
+	except Exception as inst:
+		error_reply = ReplyFrames()
+		error_reply.send(b"err")
+		if reply.topology_payload != None:
+			# Packing atom ids map topology.openff_atom_to_payload
+			# It is necesary for identification of the actual problems in the model
+			error_reply.send(reply.topology_payload.pack_openff_atom_id_map())
+		else:
+			# Will not send IDs to remap
+			error_reply.send(b'')
+		error_reply.send_string(f"[b]{str(inst)}[/b]")
+		error_reply.send_string("\n[b]Traceback:[/b]")
+		error_reply.send_string(format_error_traceback(inst))
+		traceback.print_exc()
+		return error_reply
+	return reply
+
+async def serve_requests(router_socket: zmq.asyncio.Socket, server: ServerContext) -> None:
+	loop = asyncio.get_running_loop()
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=REQUEST_WORKERS_COUNT, thread_name_prefix="request")
+	# Keeps a reference to the requests being processed by workers
+	pending_requests: set = set()
+	async def reply_when_done(request: RequestFrames):
+		reply: ReplyFrames = await loop.run_in_executor(executor, process_request, request, server)
+		await router_socket.send_multipart(request.envelope + reply.frames)
+	while True:
+		frames: list[zmq.Frame] = await router_socket.recv_multipart(copy=False)
+		request = RequestFrames(frames)
+		_handler, runs_on_worker = REQUEST_HANDLERS.get(request.request_type, (None, False))
+		if runs_on_worker:
+			task: asyncio.Task = asyncio.create_task(reply_when_done(request))
+			pending_requests.add(task)
+			task.add_done_callback(pending_requests.discard)
+			continue
+		reply: ReplyFrames = process_request(request, server)
+		await router_socket.send_multipart(request.envelope + reply.frames)
+		if reply.close_server:
+			break
+	executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ServerSettings:
+	# Command line options of the request server
+	def __init__(self):
+		self.publisher_policy: PublisherPolicy = PublisherPolicy.DROP_OLDEST
+		self.publisher_queue_size: int = DEFAULT_PUBLISHER_QUEUE_SIZE
+		self.simulation_workers_count: int = DEFAULT_SIMULATION_WORKERS_COUNT
+		self.use_simulation_processes: bool = False
+		self.use_fork_server: bool = False
+	
+	def parse_arguments(self, arguments: list[str]) -> None:
+		for arg in arguments:
+			if arg[0:19] == "--publisher-policy=":
+				if arg[19:] in PUBLISHER_POLICY_ARGUMENTS:
+					self.publisher_policy = PUBLISHER_POLICY_ARGUMENTS[arg[19:]]
+				else:
+					logging.error(f"Unknown publisher policy '{arg[19:]}', valid policies are: {', '.join(PUBLISHER_POLICY_ARGUMENTS.keys())}. " +
+							f"Using {self.publisher_policy.name}")
+			if arg[0:23] == "--publisher-queue-size=":
+				self.publisher_queue_size = int(arg[23:])
+			if arg[0:31] == "--relax-context-pool-budget-mb=":
+				relax_context_pool.memory_budget_in_bytes = int(arg[31:]) * 1024 * 1024
+			if arg[0:21] == "--simulation-workers=":
+				self.simulation_workers_count = int(arg[21:])
+			if arg == "--simulation-processes":
+				self.use_simulation_processes = True
+			if arg == "--fork-server":
+				self.use_fork_server = True
+
+def run_request_server(address: str, settings: ServerSettings, bound_fd: int = -1) -> None:
+	# Binds the request and subscription sockets and serves requests until Quit.
+	# A byte is written to bound_fd once the sockets are bound (see run_fork_server)
+	context = zmq.Context(2)
+	# Requests are served by asyncio, the publisher thread keeps using a regular socket
+	async_context = zmq.asyncio.Context.shadow(context)
+	socket = async_context.socket(zmq.ROUTER)
+	socket_publish_simulation = context.socket(zmq.PUB)
+	socket.bind(address)
+	socket_publish_simulation.bind(address + "-subscription")
+	logging.info(f"Listening to IPC socket ({address}, {address}-subscription)")
+	startup_timeline.mark("sockets bound")
+	if bound_fd >= 0:
+		os.write(bound_fd, b'1')
+		os.close(bound_fd)
+	# Forked servers are already warm
+	toolkits_warm_up.start()
+	publisher = SimulationPublisher(socket_publish_simulation, settings.publisher_policy, settings.publisher_queue_size)
+	logging.info(f"Publishing simulation frames with policy {settings.publisher_policy.name}, queue size {settings.publisher_queue_size}")
+	simulation_scheduler = SimulationScheduler(settings.simulation_workers_count, settings.use_simulation_processes)
+	if simulation_scheduler.is_unbounded:
+		logging.info(f"Running every simulation as soon as it is requested")
+	else:
+		logging.info(f"Running {simulation_scheduler.workers_count} simulations at a time, {simulation_scheduler.cpu_threads_per_simulation} CPU threads each" \
+				+ (", in worker processes" if settings.use_simulation_processes else ""))
+
+	asyncio.run(serve_requests(socket, ServerContext(publisher, simulation_scheduler)))
+	# Lets the reply to Quit reach the client before exiting
+	socket.close(linger=1000)
+
+# Fork server (--fork-server, POSIX only)
+# The process started by the editor imports everything and prewarms once, then only supervises forked copies of
+# itself: the one serving requests and a hot spare that waits to be promoted. When the serving process crashes the
+# spare binds the IPC address right away, so the editor doesn't wait through a cold start again.
+# The supervisor never creates an OpenMM Context: GPU platforms (CUDA, OpenCL) can't be used by a process forked after
+# their driver was initialized, so it only prewarms the OpenFF parameterization (see prewarm_openmm_ff)
+FORK_SERVER_PROMOTION_TIMEOUT_IN_SECONDS = 10.0
+# Serving processes that crash sooner than this after being promoted count as a crash loop
+FORK_SERVER_MIN_UPTIME_IN_SECONDS = 5.0
+FORK_SERVER_MAX_CRASH_LOOP = 3
+
+class ForkedServer:
+	# A forked copy of the supervisor, blocked until promote() lets it bind the address and serve requests
+	def __init__(self, address: str, settings: ServerSettings):
+		fork_start: float = time.perf_counter()
+		promote_read_fd, self._promote_write_fd = os.pipe()
+		self._bound_read_fd, bound_write_fd = os.pipe()
+		supervisor_pid: int = os.getpid()
+		self.pid: int = os.fork()
+		if self.pid == 0:
+			os.close(self._promote_write_fd)
+			os.close(self._bound_read_fd)
+			exit_code: int = 0
+			try:
+				run_forked_server(address, settings, supervisor_pid, promote_read_fd, bound_write_fd)
+			except BaseException as e:
+				logging.error(f"Forked server {os.getpid()} failed: {e}")
+				traceback.print_exc()
+				exit_code = 1
+			# Never return into the supervisor code or run its exit handlers
+			os._exit(exit_code)
+		os.close(promote_read_fd)
+		os.close(bound_write_fd)
+		self.promoted_time: float = 0.0
+		logging.info(f"Forked server {self.pid} in {(time.perf_counter() - fork_start) * 1000.0:.1f} ms")
+	
+	def promote(self) -> bool:
+		# Returns once the sockets are bound, False if the process died or timed out first
+		os.write(self._promote_write_fd, b'1')
+		os.close(self._promote_write_fd)
+		readable, _writable, _errors = select.select([self._bound_read_fd], [], [], FORK_SERVER_PROMOTION_TIMEOUT_IN_SECONDS)
+		is_bound: bool = len(readable) > 0 and os.read(self._bound_read_fd, 1) == b'1'
+		os.close(self._bound_read_fd)
+		self.promoted_time = time.perf_counter()
+		return is_bound
+	
+	def kill(self) -> None:
+		self.close_pipes()
+		try:
+			os.kill(self.pid, signal.SIGKILL)
+			os.waitpid(self.pid, 0)
+		except (ProcessLookupError, ChildProcessError):
+			pass
+	
+	def close_pipes(self) -> None:
+		for fd in [self._promote_write_fd, self._bound_read_fd]:
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+def run_forked_server(address: str, settings: ServerSettings, supervisor_pid: int, promote_fd: int, bound_fd: int) -> None:
+	partial_charge_cache.reset_after_fork()
+	# The supervisor is the process the editor monitors (see start_monitoring_msep), forked servers leave with it
+	threading.Thread(target=exit_when_parent_dies, args=(supervisor_pid,), daemon=True).start()
+	# Empty when the supervisor exits without promoting this spare
+	if os.read(promote_fd, 1) != b'1':
+		return
+	os.close(promote_fd)
+	logging.info(f"Forked server {os.getpid()} is serving requests")
+	run_request_server(address, settings, bound_fd)
+
+def exit_when_parent_dies(parent_pid: int) -> None:
+	while os.getppid() == parent_pid:
+		time.sleep(pid_check_frequency)
+	os._exit(0)
+
+def run_fork_server(address: str, settings: ServerSettings) -> int:
+	# Returns the exit code of the supervisor: 0 when the serving process quit, 1 after a crash loop
+	active = ForkedServer(address, settings)
+	if not active.promote():
+		logging.error(f"Forked server {active.pid} could not bind {address}")
+		active.kill()
+		return 1
+	spare = ForkedServer(address, settings)
+	crash_loop: int = 0
+	while True:
+		pid, status = os.waitpid(-1, 0)
+		if pid == spare.pid:
+			logging.warning(f"Spare server {pid} exited with code {os.waitstatus_to_exitcode(status)}, forking a new one")
+			spare.close_pipes()
+			spare = ForkedServer(address, settings)
+			continue
+		if pid != active.pid:
+			# ie: simulation worker processes are children of the serving process, not of the supervisor
+			continue
+		exit_code: int = os.waitstatus_to_exitcode(status)
+		if exit_code == 0:
+			# Quit request
+			spare.kill()
+			return 0
+		crash_time: float = time.perf_counter()
+		uptime: float = crash_time - active.promoted_time
+		logging.error(f"Server {active.pid} crashed with code {exit_code} after {uptime:.1f} s, promoting spare {spare.pid}")
+		crash_loop = crash_loop + 1 if uptime < FORK_SERVER_MIN_UPTIME_IN_SECONDS else 0
+		if crash_loop >= FORK_SERVER_MAX_CRASH_LOOP:
+			logging.error(f"Server crashed {crash_loop} times in a row right after starting, giving up")
+			spare.kill()
+			return 1
+		active = spare
+		is_bound: bool = active.promote()
+		restart_latency: float = time.perf_counter() - crash_time
+		if is_bound:
+			logging.info(f"Server {active.pid} took over {address}, restart latency {restart_latency * 1000.0:.1f} ms")
+		else:
+			logging.error(f"Spare server {active.pid} could not bind {address} in {restart_latency:.1f} s")
+			active.kill()
+			return 1
+		spare = ForkedServer(address, settings)
+
 
 if __name__ == '__main__':
-	apply_all_patches()
+	startup_timeline.mark("loaded server module")
 	start_monitoring_msep()
-	prewarm_openmm_ff()
 	DEFAULT_SOCKET_NAME: str = "msep-one-socket"
 	ipc_socket: str = ""
 	for arg in sys.argv:
 		if arg[0:13] == "--ipc-socket=":
 			ipc_socket = "ipc://" + arg[13:]
-	context = zmq.Context(2)
-	socket = context.socket(zmq.REP)
-	socket_publish_simulation = context.socket(zmq.PUB)
-	socket_publick_lock = threading.Lock()
+	settings = ServerSettings()
+	settings.parse_arguments(sys.argv)
 
 	address = ipc_socket
 	if ipc_socket == "":
 			tmp_path = tempfile.gettempdir()
 			tmp_path = os.path.join(tmp_path, DEFAULT_SOCKET_NAME)
 			address = "ipc://" + tmp_path
-	socket.bind(address)
-	socket_publish_simulation.bind(address + "-subscription")
-	logging.info(f"Listening to IPC socket ({address}, {address}-subscription)")
-
-	while True:
-		try:
-			request_type = socket.recv()
-			match request_type:
-				case b"Relax":
-					logging.info(f"Server received a Relax request")
-					temperature_bytes = socket.recv()
-					temperature_in_kelvins: float = struct.unpack('d', temperature_bytes)[0]
-					forcefield_list: str = socket.recv_string()
-					header_bytes: bytes = socket.recv()
-					header = PayloadHeaderReader(header_bytes)
-					logging.info(f"Header: atoms_count={str(header.atoms_count)}, bonds_count={header.bonds_count}")
-					topology_bytes: bytes = socket.recv()
-					topology = PayloadTopologyReader(topology_bytes, header.molecules_count, header.atoms_count, header.bonds_count, forcefield_list)
-					atoms_str = "[" + ", ".join(periodic_table_symbols[item.element] for item in topology.atoms) + "]"
-					if DETAILED_LOGS:
-						logging.info(f"Topology: atoms={atoms_str} bonds={topology.bonds}")
-
-					# pregenerate openff molecules
-					topology.to_openff_molecules()
-					state_bytes: bytes = socket.recv()
-					state = PayloadStateReader(state_bytes, header.atoms_count, header.passivated_atoms_count)
-					if DETAILED_LOGS:
-						logging.info(f"state: positions={str(state.positions)}")
-
-					# Collect motors parameters
-					for m in range(header.virtual_objects_count):
-						json_object: dict = json.loads(socket.recv_string())
-						topology.add_virtual_object(json_object)
-					minimized_positions = minimize_energy(topology, state, temperature_in_kelvins, max_iterations=500)
-					new_state_buffer: bytes = b''
-					for pos in minimized_positions:
-						for i in range(3):
-							raw = pos[i] / nanometer
-							new_state_buffer += struct.pack("d", raw)
-					socket.send(new_state_buffer)
-
-				case b'Simulate':
-					logging.info(f"Server received a Simulation Start request")
-					id_bytes: bytes = socket.recv()
-					simulation_id: int = struct.unpack('<q', id_bytes)[0]
-					parameters_bytes: bytes = socket.recv()
-					parameters = PayloadSimulationParameters(parameters_bytes)
-					forcefield_list: str = socket.recv_string()
-					header_bytes: bytes = socket.recv()
-					header = PayloadHeaderReader(header_bytes)
-					logging.info(f"Header: atoms_count={str(header.atoms_count)}, bonds_count={header.bonds_count}")
-					topology_bytes: bytes = socket.recv()
-					topology = PayloadTopologyReader(topology_bytes, header.molecules_count, header.atoms_count, header.bonds_count, forcefield_list)
-					atoms_str = "[" + ", ".join(periodic_table_symbols[item.element] for item in topology.atoms) + "]"
-					if DETAILED_LOGS:
-						logging.info(f"Topology: atoms={atoms_str} bonds={topology.bonds}")
-					# pregenerate openff molecules
-					topology.to_openff_molecules()
-					state_bytes: bytes = socket.recv()
-					state = PayloadStateReader(state_bytes, header.atoms_count, header.passivated_atoms_count)
-					if DETAILED_LOGS:
-						logging.info(f"state: positions={str(state.positions)}")
-					# Collect motors parameters
-					for m in range(header.virtual_objects_count):
-						json_string: str = socket.recv_string()
-						json_object: dict = json.loads(json_string)
-						topology.add_virtual_object(json_object)
-					socket.send(b'Running')
-					running_simulations[simulation_id] = threading.Event()
-					threading.Thread(target=start_simulation, args=(socket_publish_simulation, socket_publick_lock, simulation_id, parameters, topology, state)).start()
-				case b'AbortSimulation':
-					id_bytes: bytes = socket.recv()
-					simulation_id: int = struct.unpack('<q', id_bytes)[0]
-					stop_trigger: threading.Event = running_simulations.get(simulation_id, None)
-					if stop_trigger != None and not stop_trigger.is_set():
-						logging.info(f"Server received an Abort Simulation request")
-						stop_trigger.set()
-					socket.send(b'ack')
-				case b'Import File':
-					path = socket.recv_string()
-					payload = ImportFileRequest(path)
-					while socket.getsockopt(zmq.RCVMORE):
-						option = socket.recv_string()
-						payload.process_option(option)
-					response: ImportFileResponse = import_file(payload)
-					# First frame are atomic_numbers as uint8
-					atomic_numbers_buffer: bytes = b''
-					for atom in response.openmm_topology.atoms():
-						atomic_numbers_buffer += struct.pack("B", atom.element.atomic_number)
-					# Second frame are atoms positions as 3 consecutive doubles
-					positions_buffer: bytes = b''
-					logging.info(f"PoSiTiOnS: {response.positions}")
-					for pos in response.positions:
-						for i in range(3):
-							positions_buffer += struct.pack("d", pos[i])
-					# Third frame are bonds represented as 2 atom_ids(uint32) + byte order (uint8)
-					bonds_buffer: bytes = b''
-					logging.info(f"BONDS: {str(response.bonds)}")
-					for bond in response.bonds:
-						bonds_buffer += struct.pack("<I", bond.atom1.molecule_atom_index)
-						bonds_buffer += struct.pack("<I", bond.atom2.molecule_atom_index)
-						bonds_buffer += struct.pack("B", bond.bond_order)
-					socket.send(atomic_numbers_buffer, zmq.SNDMORE)
-					socket.send(positions_buffer, zmq.SNDMORE)
-					socket.send(bonds_buffer)
-				case b'Export File':
-					path = socket.recv_string()
-					logging.info(f"Exporting file: {path}")
-					forcefield_list: str = socket.recv_string()
-					header_bytes: bytes = socket.recv()
-					header = PayloadHeaderReader(header_bytes)
-					topology_bytes: bytes = socket.recv()
-					topology_payload = PayloadTopologyReader(topology_bytes, header.molecules_count, header.atoms_count, header.bonds_count, forcefield_list)
-					molecules: list[Molecule] = topology_payload.to_openff_molecules()
-					topology = Topology.from_molecules(molecules)
-					state_bytes: bytes = socket.recv()
-					state = PayloadStateReader(state_bytes, header.atoms_count, header.passivated_atoms_count)
-					openff_positions: list[Vec3] = []
-					for i in range(len(state.positions)):
-						payload_atom_id = topology_payload.openff_atom_to_payload[i]
-						position = state.positions[payload_atom_id] * nanometer
-						openff_positions.append(position.value_in_unit(angstrom))
-					output_file = open(path, 'w')
-					PDBFile.writeFile(topology.to_openmm(), openff_positions, output_file)
-					output_file.close()
-					socket.send_string("SUCCESS")
-				case b"GetProcessID":
-					pid: int = os.getpid()
-					pid_buffer: bytes = b''
-					pid_buffer += struct.pack("<Q", pid)
-					socket.send(pid_buffer)
-				case b"Quit":
-					for simulation_id in running_simulations.keys():
-						stop_trigger: threading.Event = running_simulations.get(simulation_id, None)
-						if stop_trigger != None and not stop_trigger.isSet():
-							stop_trigger.set()
-					socket.send_string("ack")
-					sys.exit(0)
-				case _:
-					raise Exception(f"Unknown request instruction: {request_type}")
-		except Exception as inst:
-			while socket.getsockopt(zmq.RCVMORE):
-				discard: bytes = socket.recv()
-				logging.error(f"\tDISCARDED BYTES ON ERROR:{str(discard)}")
-			socket.send(b"err", zmq.SNDMORE)
-			if topology != None and hasattr(topology, 'openff_atom_to_payload'):
-				# Packing atom ids map topology.openff_atom_to_payload
-				# It is necesary for identification of the actual problems in the model
-				atom_id_buffer: bytes = b''
-				for openff_atom in topology.openff_atom_to_payload.keys():
-					atom_id_buffer += struct.pack("<I", openff_atom)
-					atom_id_buffer += struct.pack("<I", topology.openff_atom_to_payload[openff_atom])
-				socket.send(atom_id_buffer, zmq.SNDMORE)
-			else:
-				# Will not send IDs to remap
-				socket.send(b'', zmq.SNDMORE)
-			socket.send_string(f"[b]{str(inst)}[/b]", zmq.SNDMORE)
-			socket.send_string("\n[b]Traceback:[/b]", zmq.SNDMORE)
-
-			environment_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "msep.one")
-			trace: list = traceback.extract_tb(inst.__traceback__)
-			traceback_str = ""
-			for trace_data in trace:
-				full_path = trace_data[0]
-				short_path = full_path.replace(__file__, "openmm_server.py")
-				short_path = short_path.replace(environment_dir, "<env>")
-				line = trace_data[1]
-				module = trace_data[2]
-				trace_line = f"\n    File [url={full_path}@{line}]{short_path}:{line}[/url], in {module}\n"
-				for i in range(3, len(trace_data)):
-					code = trace_data[i]
-					trace_line += f"    {line-3+i}|   {code}\n"
-				traceback_str += trace_line
-			socket.send_string(traceback_str)
-			traceback.print_exc()
-			# raise inst
+	if settings.use_fork_server and hasattr(os, "fork"):
+		# Every forked server starts warm, without a Context so they can still use the GPU platforms
+		toolkits_warm_up.run(create_context=False)
+		sys.exit(run_fork_server(address, settings))
+	if settings.use_fork_server:
+		logging.warning(f"Fork server is not supported on {platform}, serving requests from this process")
+	run_request_server(address, settings)
+	# The reply to Quit was flushed when the socket closed. Request workers can still be relaxing (relaxes without
+	# a relax_id can't be aborted), exit without joining them like concurrent.futures does at interpreter exit
+	logging.shutdown()
+	os._exit(0)
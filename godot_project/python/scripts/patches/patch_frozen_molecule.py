@@ -16,6 +16,13 @@ TKR: TypeAlias = Union[ToolkitRegistry, ToolkitWrapper]
 
 
 are_molecules_isomorphic_original = None
+# Comparisons answered by the identity keys of the molecules, see openmm_server.MOLECULE_IDENTITY_KEY_PROPERTY
+identity_key_matches_count = 0
+
+def _object_to_identity_key(obj):
+	if isinstance(obj, FrozenMolecule):
+		return obj.properties.get("msep_identity_key", None)
+	return None
 
 def are_molecules_isomorphic_patched(
 		mol1: Union["FrozenMolecule", "_SimpleMolecule", nx.Graph],
@@ -60,6 +67,18 @@ def are_molecules_isomorphic_patched(
 				+ f"(Frozen)Molecule, not {type(obj)}"
 			)
 
+	# ----------- MSEP.one OPTIMIZATION! -----------
+	# openmm_server creates all copies of a molecule from the same representative (same atom order and charges)
+	# and tags them with the same identity key, so they can be matched without walking the molecules
+	identity_key1 = _object_to_identity_key(mol1)
+	if identity_key1 is not None and identity_key1 == _object_to_identity_key(mol2):
+		global identity_key_matches_count
+		identity_key_matches_count += 1
+		if return_atom_map:
+			return True, {i: i for i in range(mol1.n_atoms)}
+		else:
+			return True, None
+
 	# Quick number of atoms check. Important for large molecules
 	if _object_to_n_atoms(mol1) != _object_to_n_atoms(mol2):
 		return False, None